@@ -1,40 +1,27 @@
 
 import os
+import sys
 import json
-from langchain_openai import ChatOpenAI
-from langchain.prompts import PromptTemplate
-from langchain_core.output_parsers import JsonOutputParser
-from dotenv import load_dotenv
+from functools import lru_cache
 
-load_dotenv()
+# Add project root to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-def classify_query(query: str) -> dict:
-    """
-    Classifies the user query to determine the optimal search strategy.
-    
-    Args:
-        query (str): The user's search query.
-        
-    Returns:
-        dict: Classification results containing:
-            - type: explanation/factual/comparison
-            - has_temporal: bool (needs recent info?)
-            - search_strategy: "kb_only" / "web_only" / "hybrid"
-    """
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise ValueError("OPENAI_API_KEY not found in environment variables.")
+from utils.config import load_env
+from utils.deadline import (
+    run_with_timeout, CLASSIFY_TIMEOUT_S, MIN_CLASSIFY_S, SYNTH_RESERVE_S,
+    LLM_REQUEST_TIMEOUT_S, LLM_MAX_RETRIES
+)
+from utils.cache import get_kv, set_kv, normalize_query
+from utils.rate_limiter import call_with_rate_limit, estimate_tokens, RateLimitError
 
-    llm = ChatOpenAI(
-        model="gpt-4o-mini",
-        temperature=0,
-        api_key=api_key
-    )
+load_env()
 
-    parser = JsonOutputParser()
+CLASSIFICATION_TTL_HOURS = float(os.getenv("NEXUS_CLASSIFICATION_TTL_HOURS", "168"))
+# Completion tokens reserved per call in the tokens/min budget
+CLASSIFY_COMPLETION_TOKENS = 60
 
-    prompt_template = PromptTemplate(
-        template="""
+CLASSIFIER_PROMPT = """
         Analyze the following user query to determine the best information retrieval strategy.
 
         Query: "{query}"
@@ -53,23 +40,119 @@ def classify_query(query: str) -> dict:
             "has_temporal": boolean,
             "search_strategy": "kb_only|web_only|hybrid"
         }}
-        """,
+        """
+
+@lru_cache(maxsize=4)
+def get_classifier_chain(api_key: str):
+    """
+    Builds the classification chain once per API key.
+    
+    LangChain is imported here rather than at module load so that importing
+    the agents (e.g. on every Streamlit rerun) stays cheap.
+    """
+    from langchain_openai import ChatOpenAI
+    from langchain_core.prompts import PromptTemplate
+    from langchain_core.output_parsers import JsonOutputParser
+
+    llm = ChatOpenAI(
+        model="gpt-4o-mini",
+        temperature=0,
+        api_key=api_key,
+        timeout=LLM_REQUEST_TIMEOUT_S,
+        max_retries=LLM_MAX_RETRIES
+    )
+
+    prompt_template = PromptTemplate(
+        template=CLASSIFIER_PROMPT,
         input_variables=["query"],
     )
 
-    chain = prompt_template | llm | parser
+    return prompt_template | llm | JsonOutputParser()
+
+DEFAULT_CLASSIFICATION = {
+    "type": "general",
+    "has_temporal": False,
+    "search_strategy": "hybrid"
+}
+
+def get_cached_classification(query: str, touch: bool = True):
+    """
+    Returns the cached classification entry for a query, or None.
+    
+    Returns:
+        dict | None: {"classification": dict, "expires_at": datetime}.
+    """
+    cached = get_kv("classification", normalize_query(query), touch=touch)
+    if not cached:
+        return None
+    return {"classification": json.loads(cached["payload"]), "expires_at": cached["expires_at"]}
 
+def classify_query(query: str, deadline=None, use_cache: bool = True) -> dict:
+    """
+    Classifies the user query to determine the optimal search strategy.
+    
+    Args:
+        query (str): The user's search query.
+        deadline (Deadline): Optional request budget. If too little time is
+            left, classification is skipped (or abandoned) and the hybrid
+            default is returned.
+        use_cache (bool): Serve and store results in the classification
+            cache. The cache warmer passes False to force a refresh.
+        
+    Returns:
+        dict: Classification results containing:
+            - type: explanation/factual/comparison
+            - has_temporal: bool (needs recent info?)
+            - search_strategy: "kb_only" / "web_only" / "hybrid"
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY not found in environment variables.")
+
+    if use_cache:
+        cached = get_cached_classification(query)
+        if cached:
+            return cached["classification"]
+
+    chain = get_classifier_chain(api_key)
+
+    if deadline is not None:
+        # Leave enough budget for research and synthesis afterwards
+        timeout_s = min(CLASSIFY_TIMEOUT_S, deadline.remaining() - SYNTH_RESERVE_S)
+        if timeout_s < MIN_CLASSIFY_S:
+            deadline.degrade("skipped_classification")
+            return dict(DEFAULT_CLASSIFICATION)
+
+    # Queued behind the shared OpenAI limiter instead of failing on a 429
+    tokens = estimate_tokens(CLASSIFIER_PROMPT, query) + CLASSIFY_COMPLETION_TOKENS
     try:
-        result = chain.invoke({"query": query})
-        return result
+        if deadline is not None:
+            result = run_with_timeout(
+                call_with_rate_limit, timeout_s, "openai_chat", chain.invoke, {"query": query},
+                tokens=tokens, max_wait_s=timeout_s
+            )
+        else:
+            result = call_with_rate_limit("openai_chat", chain.invoke, {"query": query}, tokens=tokens)
+    except RateLimitError as e:
+        print(f"Classification rate limited: {e}")
+        if deadline is not None:
+            deadline.degrade("classification_rate_limited")
+        return dict(DEFAULT_CLASSIFICATION)
+    except TimeoutError as e:
+        print(f"Classification timed out: {e}")
+        if deadline is not None:
+            deadline.degrade("classification_timeout")
+        return dict(DEFAULT_CLASSIFICATION)
     except Exception as e:
         print(f"Error classifying query: {e}")
         # Default fallback
-        return {
-            "type": "general",
-            "has_temporal": False,
-            "search_strategy": "hybrid" 
-        }
+        return dict(DEFAULT_CLASSIFICATION)
+
+    set_kv(
+        "classification", normalize_query(query),
+        json.dumps(result).encode("utf-8"), ttl_hours=CLASSIFICATION_TTL_HOURS
+    )
+    return result
 
 if __name__ == "__main__":
     # Simple test
@@ -0,0 +1,139 @@
+
+import os
+import re
+
+# Upper bound on sub-queries per request (each one runs its own retrievals)
+MAX_SUB_QUERIES = int(os.getenv("NEXUS_MAX_SUB_QUERIES", "4"))
+
+# "X vs Y", "X versus Y", "How does X compare to/with Y", "X compared to Y",
+# "difference(s) between X and Y", "compare X and/with/to Y"
+_COMPARISON_PATTERNS = [
+    re.compile(r"^(?:what (?:is|are) the )?differences? between (?P<a>.+?) and (?P<b>.+)$", re.I),
+    re.compile(r"^(?:how )?(?:does|do|did|is|are) (?P<a>.+?) (?:compare|stack up|differ) (?:to|with|from|against) (?P<b>.+)$", re.I),
+    re.compile(r"^compare (?P<a>.+?) (?:and|with|to|against) (?P<b>.+)$", re.I),
+    re.compile(r"^(?P<a>.+?) (?:compared (?:to|with)|vs\.?|versus) (?P<b>.+)$", re.I),
+]
+
+# Separators between compared items ("X vs Y vs Z") and list separators on
+# either side of the comparison ("X, Y and Z")
+_COMPARISON_SEPARATOR = r"\s+(?:compared (?:to|with)|vs\.?|versus)\s+"
+_LEFT_SPLIT_RE = re.compile(r",\s*|" + _COMPARISON_SEPARATOR, re.I)
+_RIGHT_SPLIT_RE = re.compile(r",\s*(?:and\s+)?|\s+and\s+|" + _COMPARISON_SEPARATOR, re.I)
+
+# Trailing aspect shared by all sides: "... GPT-4 on reasoning benchmarks"
+_ASPECT_RE = re.compile(r"^(?P<b>.+?) (?P<aspect>(?:on|in terms of|for|regarding|in) .+)$", re.I)
+
+# Independent questions joined in one query: "What is X? How is it used?"
+# or "What is X and how does Y work?"
+_QUESTION_SPLIT_RE = re.compile(r"\?\s+|;\s+")
+_CONJUNCTION_SPLIT_RE = re.compile(
+    r",?\s+(?:and|also|plus)\s+(?=(?:what|how|why|when|where|which|who|is|are|does|do|can)\b)", re.I
+)
+_SUBJECT_RE = re.compile(r"^(?:what|who) (?:is|are) (?:the |a |an )?(?P<x>.+)$", re.I)
+_PRONOUN_RE = re.compile(r"\b(?:it|they|them)\b", re.I)
+
+# "Is X or Y better for Z?" (used when the classifier flags a comparison)
+_LEADING_VERB_RE = re.compile(r"^(?:is|are|which is|which are|should i use|should we use)\s+", re.I)
+_COMPARATIVE = r"(?:better|worse|faster|slower|cheaper|preferable|more \w+|less \w+)\b"
+_PREFERENCE_RE = re.compile(r"^(?P<b>.+?) " + _COMPARATIVE + r"(?P<aspect>.*)$", re.I)
+_LEADING_PREFERENCE_RE = re.compile(r"^" + _COMPARATIVE + r"(?P<aspect>[^,]*),\s*(?P<rest>.+)$", re.I)
+
+
+def _clean(text: str) -> str:
+    return text.strip().strip("?.!,;: ").strip()
+
+
+def _split_comparison(query: str) -> list:
+    """
+    Splits "X vs Y"-style queries into one sub-query per compared item,
+    including chains ("X vs Y vs Z") and lists ("X, Y and Z").
+    """
+    text = _clean(query)
+    for pattern in _COMPARISON_PATTERNS:
+        match = pattern.match(text)
+        if not match:
+            continue
+        a, b = _clean(match.group("a")), _clean(match.group("b"))
+        aspect = ""
+        aspect_match = _ASPECT_RE.match(b)
+        if aspect_match:
+            b, aspect = _clean(aspect_match.group("b")), _clean(aspect_match.group("aspect"))
+        sides = [_clean(side) for side in _LEFT_SPLIT_RE.split(a)]
+        sides += [_clean(side) for side in _RIGHT_SPLIT_RE.split(b)]
+        sides = [side for side in sides if side]
+        if aspect:
+            sides = [f"{side} {aspect}" for side in sides]
+        return sides
+    return []
+
+
+def _split_alternatives(query: str) -> list:
+    """
+    Splits "Is X or Y better for Z?" (or "Which is better for Z, X or Y?")
+    into "X for Z", "Y for Z".
+    """
+    text = _LEADING_VERB_RE.sub("", _clean(query))
+    aspect = ""
+    leading = _LEADING_PREFERENCE_RE.match(text)
+    if leading:
+        text, aspect = leading.group("rest"), _clean(leading.group("aspect"))
+    sides = [_clean(s) for s in re.split(r",\s*|\s+or\s+", text)]
+    trailing = _PREFERENCE_RE.match(sides[-1])
+    if trailing:
+        sides[-1] = _clean(trailing.group("b"))
+        aspect = _clean(trailing.group("aspect")) or aspect
+    if aspect:
+        sides = [f"{side} {aspect}" for side in sides]
+    return [side for side in sides if side]
+
+
+def _split_multi_part(query: str) -> list:
+    """
+    Splits a query made of several independent questions, replacing
+    pronouns in later parts with the subject of a leading "What is X".
+    """
+    parts = []
+    for question in _QUESTION_SPLIT_RE.split(query.strip()):
+        parts.extend(_CONJUNCTION_SPLIT_RE.split(question))
+    parts = [_clean(part) for part in parts if len(_clean(part).split()) >= 2]
+
+    subject = _SUBJECT_RE.match(parts[0]) if parts else None
+    if subject:
+        parts = [parts[0]] + [
+            _PRONOUN_RE.sub(subject.group("x"), part) for part in parts[1:]
+        ]
+    return parts
+
+
+def decompose_query(query: str, classification: dict = None, max_sub_queries: int = None) -> list:
+    """
+    Splits comparison and multi-part queries into focused sub-queries.
+
+    Rule-based, so it adds no model round trip: comparisons ("X vs Y",
+    "How does X compare to Y?") become one sub-query per compared item,
+    and several questions in one query become one sub-query each.
+
+    Args:
+        query (str): The user's query.
+        classification (dict): Classifier output; a "comparison" type is
+            decomposed even without an explicit comparison keyword match.
+        max_sub_queries (int): Cap on sub-queries (default NEXUS_MAX_SUB_QUERIES).
+
+    Returns:
+        list: The sub-queries, or [query] if it does not need decomposing.
+    """
+    limit = max_sub_queries or MAX_SUB_QUERIES
+    sub_queries = _split_comparison(query)
+    if not sub_queries:
+        sub_queries = _split_multi_part(query)
+    if len(sub_queries) < 2 and (classification or {}).get("type") == "comparison":
+        # The classifier saw a comparison our patterns missed: "X or Y?"
+        sub_queries = _split_alternatives(query)
+
+    unique = []
+    for sub_query in sub_queries:
+        if sub_query and sub_query.lower() not in {u.lower() for u in unique}:
+            unique.append(sub_query)
+    if len(unique) < 2:
+        return [query]
+    return unique[:limit]
@@ -2,69 +2,184 @@
 import os
 import sys
 import time
+import queue
+import threading
+import contextvars
 
 # Add project root to path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from agents.classifier import classify_query
+from agents.classifier import classify_query, get_classifier_chain
 from agents.research import research_agent
-from agents.synthesizer import synthesizer_agent
+from agents.synthesizer import (
+    synthesizer_agent, get_synthesis_chain, fast_extractive_answer, FAST_ANSWER_ENABLED
+)
+from utils.cache import ensure_cache
+from utils.vectordb import load_knowledge_base
+from utils.web_search import get_tavily_client
+from utils.profiling import get_profiler
+from utils.deadline import Deadline
+from utils.query_log import log_query
 
-def process_query(query: str, user_preference: str = "auto"):
+# Degradations after which the synthesizer answered extractively
+EXTRACTIVE_FALLBACKS = ("extractive_answer", "synthesis_timeout", "synthesis_rate_limited")
+
+def warm_up() -> dict:
+    """
+    Loads heavy dependencies and builds the shared, process-wide resources
+    (LLM chains, knowledge base, Tavily client, cache store) ahead of the
+    first query, so the first interaction does not pay for them.
+    
+    Failures (e.g. a missing API key) are reported and skipped; the same
+    error will surface normally when a query needs that resource.
+    
+    Returns:
+        dict: Milliseconds spent per resource, or the error message.
+    """
+    def openai_key():
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise ValueError("OPENAI_API_KEY not found in environment variables.")
+        return api_key
+
+    steps = [
+        ("cache", ensure_cache),
+        ("classifier_chain", lambda: get_classifier_chain(openai_key())),
+        ("synthesis_chain", lambda: get_synthesis_chain(openai_key())),
+        ("knowledge_base", load_knowledge_base),
+        ("tavily_client", get_tavily_client),
+    ]
+
+    report = {}
+    for name, step in steps:
+        step_start = time.perf_counter()
+        try:
+            step()
+            report[name] = int((time.perf_counter() - step_start) * 1000)
+        except Exception as e:
+            print(f"Warm-up skipped {name}: {e}")
+            report[name] = f"error: {e}"
+    return report
+
+def process_query(query: str, user_preference: str = "auto", profile: bool = None,
+                  deadline_ms: int = None, where: dict = None, where_document: dict = None,
+                  session=None, fast_answer: bool = None, on_event=None):
     """
     Main orchestration function to process a user query.
     
     Args:
         query (str): The user's query.
         user_preference (str): "auto", "kb_only", "web_only", or "hybrid".
+        profile (bool): Profile this request. None defers to the
+            NEXUS_PROFILE_SAMPLE_RATE sampling rate.
+        deadline_ms (int): End-to-end latency budget (default NEXUS_DEADLINE_MS).
+            Stages degrade gracefully as it runs out; see metadata["degradations"].
+        where (dict): Metadata filter for the knowledge base, e.g. from
+            utils.vectordb.build_where(sources=[...]).
+        where_document (dict): Document text filter for the knowledge base.
+        session (ConversationSession): The user's conversation. Follow-ups
+            are resolved against the previous turn, classified, and (unless
+            they ask for recent information) answered from earlier context
+            where it suffices; the turn is then recorded in the session.
+        fast_answer (bool): Answer kb_only queries whose top KB hit is
+            decisive by quoting it, skipping LLM synthesis. None defers to
+            NEXUS_FAST_ANSWER. metadata["answer_path"] records the path taken
+            ("extractive", "llm", or "extractive_fallback" under the deadline).
+        on_event: Optional callback receiving progress events (dicts with a
+            "type") as each stage finishes; see stream_query.
         
     Returns:
         dict: Final response containing answer, sources, and metadata.
     """
-    start_time = time.time()
+    start = time.perf_counter()
     
-    # Step 1: Classify (if auto)
-    if user_preference == "auto":
-        print(f"Classifying query: {query}")
-        classification = classify_query(query)
-        search_strategy = classification.get("search_strategy", "hybrid")
-        print(f"Detected intent: {classification.get('type')} | Strategy: {search_strategy}")
-    else:
-        search_strategy = user_preference
-        print(f"Using user preference: {search_strategy}")
-        
-    # Step 2: Research
-    print("Researching...")
-    research_results = research_agent(query, search_strategy)
+    def emit(event_type: str, **fields):
+        if on_event is not None:
+            on_event({"type": event_type, "elapsed_ms": int((time.perf_counter() - start) * 1000), **fields})
     
-    kb_results = research_results.get("kb_results", [])
-    web_results = research_results.get("web_results", [])
+    profiler = get_profiler(query, enabled=profile)
+    try:
+        result = _run_pipeline(
+            query, user_preference, profiler, Deadline(deadline_ms),
+            where=where, where_document=where_document, session=session,
+            fast_answer=FAST_ANSWER_ENABLED if fast_answer is None else fast_answer,
+            emit=emit
+        )
+    finally:
+        profile_info = profiler.finish()
     
-    # Step 3: Synthesize
-    print("Synthesizing answer...")
-    final_answer = synthesizer_agent(
-        query=query,
-        kb_results=kb_results,
-        web_results=web_results
-    )
+    if profile_info:
+        result["metadata"]["profile"] = profile_info
     
-    end_time = time.time()
-    latency_ms = int((end_time - start_time) * 1000)
+    log_query(result["metadata"]["resolved_query"], result["search_strategy_used"], result["metadata"]["latency_ms"])
+    emit("done", result=result)
+    return result
+
+def stream_query(query: str, user_preference: str = "auto", **kwargs):
+    """
+    Runs process_query on a worker thread and yields its events as they happen.
     
-    # Structure the sources for the UI
-    sources = []
+    Event types, in order (each a dict with "type" and "elapsed_ms"):
+        - "classification": classification, strategy, how it was decided
+          ("classifier" or "user"), resolved_query, follow_up.
+        - "kb_results" / "web_results": per (sub-)query as each retrieval
+          finishes: sub_query, sources, duration_ms, and "cache" for the web
+          ("hit", "stale", "miss" or "skipped"), or "context" for either
+          when answered from earlier turns.
+        - "sources": all deduplicated sources, before the answer is written.
+        - "token": text, for each synthesis token as the LLM streams it.
+        - "answer": the final answer and answer_path (replaces the tokens).
+        - "done": result, the full process_query response with timings.
     
-    # Add KB sources
+    Args:
+        query (str): The user's query.
+        user_preference (str): "auto", "kb_only", "web_only", or "hybrid".
+        **kwargs: Any other process_query argument.
+    
+    Yields:
+        dict: The events.
+    
+    Raises:
+        Exception: Whatever process_query raised, after the events before it.
+    """
+    events = queue.Queue()
+    
+    def run():
+        try:
+            process_query(query, user_preference, on_event=events.put, **kwargs)
+        except BaseException as e:
+            events.put({"type": "error", "error": e})
+        finally:
+            events.put(None)
+    
+    # The worker keeps this context (e.g. its rate-limit priority)
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(run,), name="nexus-query", daemon=True).start()
+    while True:
+        event = events.get()
+        if event is None:
+            return
+        if event["type"] == "error":
+            raise event["error"]
+        yield event
+
+def _kb_sources(kb_results: list) -> list:
+    """KB results as UI sources."""
+    sources = []
     for res in kb_results:
         metadata = res.get("metadata", {})
         sources.append({
             "type": "kb",
             "title": metadata.get("source", "Unknown Document"),
-            "score": res.get("score", 0), # Chroma might not return score in this specific dict structure depending on utils
+            "page": metadata.get("page"),
+            "score": res.get("score", 0), # Cosine relevance to the query (set by MMR selection)
             "content": res.get("content", "")[:100] + "..."
         })
-        
-    # Add Web sources
+    return sources
+
+def _web_sources(web_results: list) -> list:
+    """Web results as UI sources."""
+    sources = []
     for res in web_results:
         sources.append({
             "type": "web",
@@ -72,6 +187,103 @@ def process_query(query: str, user_preference: str = "auto"):
             "url": res.get("url", "#"),
             "content": res.get("content", "")[:100] + "..."
         })
+    return sources
+
+def _run_pipeline(query: str, user_preference: str, profiler, deadline,
+                  where: dict = None, where_document: dict = None, session=None,
+                  fast_answer: bool = False, emit=None):
+    """Runs classify -> research -> synthesize within the deadline, timing each stage."""
+    emit = emit or (lambda event_type, **fields: None)
+    start_time = time.time()
+    timings = {}
+    
+    # Step 0: Follow-ups are rewritten as standalone queries and may reuse earlier context
+    follow_up = session is not None and session.is_follow_up(query)
+    resolved_query = session.resolve(query) if follow_up else query
+    context = session.context(where=where, where_document=where_document) if follow_up else None
+    if follow_up:
+        print(f"Follow-up resolved as: {resolved_query}")
+    
+    # Step 1: Classify (if auto). Follow-ups are classified on their resolved
+    # form, since they may ask for something else (e.g. news about the topic).
+    stage_start = time.perf_counter()
+    if user_preference == "auto":
+        print(f"Classifying query: {resolved_query}")
+        with profiler.stage("classify"):
+            classification = classify_query(resolved_query, deadline=deadline)
+        search_strategy = classification.get("search_strategy", "hybrid")
+        decided_by = "classifier"
+        print(f"Detected intent: {classification.get('type')} | Strategy: {search_strategy}")
+    else:
+        classification = None
+        search_strategy = user_preference
+        decided_by = "user"
+        print(f"Using user preference: {search_strategy}")
+    timings["classify"] = int((time.perf_counter() - stage_start) * 1000)
+    if context is not None and (classification or {}).get("has_temporal"):
+        # Earlier results cannot answer "latest ..." questions
+        print("Temporal follow-up: retrieving fresh results instead of reusing context")
+        context = None
+    emit("classification", classification=classification, strategy=search_strategy, decided_by=decided_by,
+         resolved_query=resolved_query, follow_up=follow_up)
+        
+    # Step 2: Research (each retrieval is reported as soon as it finishes)
+    def on_research_event(event_type, results, **fields):
+        formatter = _kb_sources if event_type == "kb_results" else _web_sources
+        emit(event_type, sources=formatter(results), **fields)
+    
+    print("Researching...")
+    stage_start = time.perf_counter()
+    with profiler.stage("research"):
+        research_results = research_agent(
+            resolved_query, search_strategy, deadline=deadline, classification=classification,
+            where=where, where_document=where_document, context=context, on_event=on_research_event
+        )
+    timings["research"] = int((time.perf_counter() - stage_start) * 1000)
+    
+    kb_results = research_results.get("kb_results", [])
+    web_results = research_results.get("web_results", [])
+    sub_queries = research_results.get("sub_queries") or []
+    # Scores of reused chunks belong to the earlier query, not this one
+    reused = any(group.get("reused") for group in sub_queries)
+    
+    # Structure the sources for the UI (shown before the answer is written)
+    sources = _kb_sources(kb_results) + _web_sources(web_results)
+    emit("sources", sources=sources, sub_queries=[group["query"] for group in sub_queries])
+    
+    # Step 3: Answer straight from a decisive KB hit, else synthesize
+    stage_start = time.perf_counter()
+    final_answer = None
+    if fast_answer and search_strategy == "kb_only":
+        with profiler.stage("fast_answer"):
+            final_answer = fast_extractive_answer(resolved_query, kb_results, web_results, sub_queries)
+    if final_answer is not None:
+        print("Answered from a decisive KB hit (synthesis skipped).")
+        answer_path = "extractive"
+    else:
+        print("Synthesizing answer...")
+        with profiler.stage("synthesize"):
+            final_answer = synthesizer_agent(
+                query=resolved_query,
+                kb_results=kb_results,
+                web_results=web_results,
+                deadline=deadline,
+                sub_queries=sub_queries,
+                on_token=lambda text: emit("token", text=text)
+            )
+        fell_back = any(name in deadline.degradations for name in EXTRACTIVE_FALLBACKS)
+        answer_path = "extractive_fallback" if fell_back else "llm"
+    timings["answer"] = int((time.perf_counter() - stage_start) * 1000)
+    emit("answer", answer=final_answer, answer_path=answer_path)
+    
+    if session is not None:
+        session.add_turn(
+            query, resolved_query, classification, search_strategy,
+            kb_results, web_results, final_answer, where=where, where_document=where_document
+        )
+    
+    end_time = time.time()
+    latency_ms = int((end_time - start_time) * 1000)
     
     return {
         "answer": final_answer,
@@ -80,7 +292,17 @@ def process_query(query: str, user_preference: str = "auto"):
         "metadata": {
             "kb_sources": len(kb_results),
             "web_sources": len(web_results),
-            "latency_ms": latency_ms
+            "latency_ms": latency_ms,
+            "timings_ms": timings,
+            "deadline_ms": deadline.budget_ms,
+            "kb_filters": {"where": where, "where_document": where_document},
+            "sub_queries": [group["query"] for group in sub_queries],
+            "resolved_query": resolved_query,
+            "follow_up": follow_up,
+            "reused_sub_queries": [group["query"] for group in sub_queries if group.get("reused")],
+            "answer_path": answer_path,
+            "kb_top_score": None if reused else max((res.get("score") or 0.0 for res in kb_results), default=None),
+            "degradations": list(deadline.degradations)
         }
     }
 
@@ -1,99 +1,377 @@
 
 import os
 import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 
 # Add project root to path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from utils.vectordb import get_collection, search_collection
-from utils.web_search import tavily_search
-from utils.cache import init_cache, get_cached_results, save_to_cache
+from utils.vectordb import (
+    query_knowledge_base, embed_query, max_marginal_relevance, MMR_FETCH_K
+)
+from utils.web_search import tavily_search, WEB_TIMEOUT_S, WEB_PROVIDER, WEB_SEARCH_DEPTH
+from utils.cache import (
+    get_cached_entry, save_to_cache, choose_ttl_hours, normalize_query, DEFAULT_TTL_HOURS
+)
+from utils.deadline import MIN_WEB_S, MIN_KB_S, SYNTH_RESERVE_S
+from utils.rate_limiter import priority, PRIORITY_WARMER, RateLimitError
+from utils.profiling import bind_to_request
+from utils.conversation import covering_results
+from agents.decomposer import decompose_query
 
-# Initialize cache on module load
-init_cache()
+# Web results requested per strategy (kb_only only searches the web as a fallback)
+WEB_MAX_RESULTS = {"kb_only": 3, "web_only": 5, "hybrid": 3}
 
-def get_web_results(query: str, max_results: int = 3):
+# Background refreshes of stale cache entries (stale-while-revalidate)
+_refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="nexus-refresh")
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+# KB and web retrievals of one request (per source and per sub-query) run here concurrently
+_retrieval_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="nexus-retrieval")
+
+def refresh_web_results(query: str, max_results: int = 3, ttl_hours: float = DEFAULT_TTL_HOURS) -> list:
+    """Fetches live web results and writes them to the cache, ignoring any cached entry."""
+    results = tavily_search(query, max_results=max_results)
+    _save_web_results(query, results, max_results, ttl_hours)
+    return results
+
+def _refresh_web_cache(query: str, max_results: int, ttl_hours: float):
+    try:
+        # Background refreshes queue behind interactive searches
+        with priority(PRIORITY_WARMER):
+            refresh_web_results(query, max_results=max_results, ttl_hours=ttl_hours)
+        print(f"  [Cache Refreshed] for query: {query}")
+    except Exception as e:
+        print(f"  [Cache Refresh Failed] for query: {query}: {e}")
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(normalize_query(query))
+
+def schedule_refresh(query: str, max_results: int = 3, ttl_hours: float = DEFAULT_TTL_HOURS) -> bool:
+    """
+    Refreshes a query's web cache entry in the background.
+    
+    At most one refresh per query is in flight at a time.
+    
+    Returns:
+        bool: True if a new refresh was scheduled.
+    """
+    key = normalize_query(query)
+    with _refreshing_lock:
+        if key in _refreshing:
+            return False
+        _refreshing.add(key)
+    _refresh_executor.submit(_refresh_web_cache, query, max_results, ttl_hours)
+    return True
+
+def _save_web_results(query: str, results: list, max_results: int, ttl_hours: float):
+    save_to_cache(
+        query, results, ttl_hours=ttl_hours, max_results=max_results,
+        search_depth=WEB_SEARCH_DEPTH, provider=WEB_PROVIDER
+    )
+
+def get_web_results(query: str, max_results: int = 3, deadline=None, ttl_hours: float = DEFAULT_TTL_HOURS,
+                    on_cache=None):
     """
     Helper to get web results with caching.
+    
+    Expired entries within the staleness bound are served immediately and
+    refreshed in the background (stale-while-revalidate). With a deadline,
+    the live search only gets the budget left after reserving time for
+    synthesis; results that would arrive later are dropped.
+    
+    `on_cache`, if given, is called with how the results were served:
+    "hit", "stale", "miss" (live search) or "skipped" (no time left).
     """
-    cached = get_cached_results(query)
-    if cached:
-        print(f"  [Cache Hit] for query: {query}")
-        return cached
+    report = on_cache or (lambda status: None)
+    cached = get_cached_entry(
+        query, max_results=max_results, search_depth=WEB_SEARCH_DEPTH, provider=WEB_PROVIDER
+    )
+    if cached and cached["results"]:
+        if cached["stale"]:
+            print(f"  [Cache Stale] for query: {query} (refreshing in background)")
+            # Refresh at the entry's full size so it keeps serving larger requests
+            refresh_size = max(max_results, cached.get("max_results") or 0)
+            schedule_refresh(query, max_results=refresh_size, ttl_hours=ttl_hours)
+            report("stale")
+        else:
+            print(f"  [Cache Hit] for query: {query}")
+            report("hit")
+        return cached["results"]
+    
+    timeout = None
+    if deadline is not None:
+        timeout = min(WEB_TIMEOUT_S, deadline.remaining() - SYNTH_RESERVE_S)
+        if timeout < MIN_WEB_S:
+            deadline.degrade("skipped_web_search")
+            report("skipped")
+            return []
     
     print(f"  [Cache Miss] Searching web for: {query}")
-    results = tavily_search(query, max_results=max_results)
-    save_to_cache(query, results)
+    report("miss")
+    search_start = time.monotonic()
+    results = tavily_search(query, max_results=max_results, timeout=timeout)
+    if not results and timeout is not None and time.monotonic() - search_start >= timeout:
+        deadline.degrade("dropped_late_web_results")
+    _save_web_results(query, results, max_results, ttl_hours)
     return results
 
-def search_knowledge_base(query: str, top_k: int = 4):
+def _retrieval_budget(deadline) -> float:
+    """
+    Seconds retrievals may take: the budget left after reserving time for
+    synthesis, but at least NEXUS_MIN_KB_S (never past the deadline itself).
+    """
+    remaining = deadline.remaining()
+    return min(remaining, max(remaining - SYNTH_RESERVE_S, MIN_KB_S))
+
+def search_knowledge_base(query: str, top_k: int = 4, fetch_k: int = None,
+                          where: dict = None, where_document: dict = None, deadline=None):
     """
     Searches the stored documents in ChromaDB.
+    
+    The query is embedded once and served by the configured KB backend
+    (Chroma shards searched in parallel, or the read-only snapshot).
+    Fetches a wider candidate pool (fetch_k, default NEXUS_MMR_FETCH_K) with
+    embeddings and keeps at most top_k of them by Maximal Marginal
+    Relevance, so adjacent overlapping chunks do not crowd out other content.
+    
+    `where` (metadata, e.g. utils.vectordb.build_where) and `where_document`
+    (text) filters are applied inside the index, so the candidate pool only
+    holds matching chunks.
+    
+    With a deadline, embedding the query (rate-limit wait included) gets
+    the retrieval budget; if it runs out the KB results are dropped.
     """
     try:
-        collection = get_collection()
-        results = search_collection(collection, query_texts=[query], n_results=top_k)
+        timeout_s = _retrieval_budget(deadline) if deadline is not None else None
+        query_embedding = embed_query(query, timeout_s=timeout_s)
+        results = query_knowledge_base(
+            query_embedding,
+            n_results=max(fetch_k or MMR_FETCH_K, top_k),
+            include=["documents", "metadatas", "distances", "embeddings"],
+            where=where,
+            where_document=where_document
+        )
         
-        # ChromaDB returns a dict of lists (ids, documents, metadatas, etc.)
+        # Merged shard results keep ChromaDB's dict of lists (ids, documents, metadatas, etc.)
         # We need to structure this nicely
         docs = results.get("documents", [[]])[0]
         metadatas = results.get("metadatas", [[]])[0]
+        embeddings = results.get("embeddings")
+        embeddings = embeddings[0] if embeddings else []
+        
+        selected, scores = max_marginal_relevance(query_embedding, embeddings, top_k)
         
         structured_results = []
-        for i, doc in enumerate(docs):
+        for i, score in zip(selected, scores):
             structured_results.append({
-                "content": doc,
+                "content": docs[i],
                 "metadata": metadatas[i],
+                "score": round(score, 4),
                 "source": "knowledge_base"
             })
             
         return structured_results
+    except (TimeoutError, RateLimitError) as e:
+        print(f"Knowledge base search ran out of time: {e}")
+        if deadline is not None:
+            deadline.degrade("dropped_late_kb_results")
+        return []
     except Exception as e:
         print(f"Error searching knowledge base: {e}")
         return []
 
-def research_agent(query: str, strategy: str) -> dict:
+def _run_concurrently(calls: list, deadline=None) -> list:
+    """
+    Runs (fn, args, kwargs) calls on the retrieval pool; results in call order.
+    
+    Each call runs in a copy of the caller's context (rate-limit priority,
+    profiler; see bind_to_request). With a deadline, calls still running
+    when the retrieval budget is spent are abandoned and their result is
+    None.
+    """
+    if len(calls) == 1 and deadline is None:
+        fn, args, kwargs = calls[0]
+        return [fn(*args, **kwargs)]
+    futures = [
+        _retrieval_executor.submit(bind_to_request(fn), *args, **kwargs)
+        for fn, args, kwargs in calls
+    ]
+    done, _ = wait(futures, timeout=_retrieval_budget(deadline) if deadline is not None else None)
+    results = []
+    for future in futures:
+        if future in done:
+            results.append(future.result())
+        else:
+            future.cancel()
+            results.append(None)
+    return results
+
+def _reporting(fn, on_event, event_type: str, sub_query: str):
+    """
+    Wraps a KB or web retrieval so that on_event(event_type, ...) fires as
+    soon as it finishes, with its results, elapsed time and (for the web)
+    how the cache served it.
+    """
+    def call(*args, **kwargs):
+        fields = {}
+        if event_type == "web_results":
+            kwargs = dict(kwargs, on_cache=lambda status: fields.update(cache=status))
+        start = time.perf_counter()
+        results = fn(*args, **kwargs)
+        on_event(event_type, sub_query=sub_query, results=results,
+                 duration_ms=int((time.perf_counter() - start) * 1000), **fields)
+        return results
+    return call
+
+def _result_key(res: dict):
+    """Identity of a retrieved item, used to drop duplicates across sub-queries."""
+    if res.get("url"):
+        return ("web", res["url"])
+    metadata = res.get("metadata") or {}
+    if metadata.get("source") is not None and metadata.get("chunk_index") is not None:
+        return ("kb", metadata["source"], metadata["chunk_index"])
+    return ("content", res.get("title"), res.get("content"))
+
+def _dedupe_groups(groups: list, field: str):
+    """Drops items already retrieved by an earlier sub-query, in place."""
+    seen = set()
+    for group in groups:
+        unique = []
+        for res in group[field]:
+            key = _result_key(res)
+            if key not in seen:
+                seen.add(key)
+                unique.append(res)
+        group[field] = unique
+
+def _interleave(groups: list, field: str) -> list:
+    """Merges per-sub-query lists rank by rank, so each sub-query keeps its best results near the top."""
+    merged = []
+    for rank in range(max((len(g[field]) for g in groups), default=0)):
+        merged.extend(g[field][rank] for g in groups if rank < len(g[field]))
+    return merged
+
+def research_agent(query: str, strategy: str, deadline=None, classification: dict = None,
+                   where: dict = None, where_document: dict = None, context: dict = None,
+                   on_event=None) -> dict:
     """
     Executes the research strategy determined by the classifier.
     
+    Comparison and multi-part queries are split into sub-queries
+    (agents.decomposer). The KB and web retrievals of every sub-query (and
+    of the two sources in hybrid mode) run concurrently, so latency stays
+    close to a single retrieval. Results found by several sub-queries are
+    kept once, under the first sub-query that found them.
+    
+    With `context` (results from earlier turns of the conversation), each
+    sub-query it already covers is answered from it, and only the others
+    are retrieved fresh. Only the result types this strategy retrieves are
+    reused (no earlier KB chunks for web_only, no web results for kb_only).
+    
     Args:
         query (str): The search query.
         strategy (str): "kb_only", "web_only", or "hybrid".
+        deadline (Deadline): Optional request budget bounding web search.
+        classification (dict): Classifier output, used to pick the web cache TTL
+            and to detect comparisons.
+        where (dict): Metadata filter for the knowledge base search.
+        where_document (dict): Document text filter for the knowledge base search.
+        context (dict): Earlier "kb_results" and "web_results" to reuse.
+        on_event: Optional callback, on_event(event_type, **fields), called
+            with "kb_results" / "web_results" (sub_query, results,
+            duration_ms, and "cache" for the web) as each retrieval finishes,
+            possibly from a worker thread. Reused context is reported at
+            once, with cache="context".
         
     Returns:
-        dict: Combined results from KB and/or Web.
+        dict: Combined results from KB and/or Web. "sub_queries" lists each
+            sub-query with its own results (a single entry if not decomposed)
+            and whether they were "reused" from the context.
     """
     print(f"Executing Research Agent with strategy: {strategy}")
     
-    kb_results = []
-    web_results = []
+    ttl_hours = choose_ttl_hours(classification)
+    sub_queries = decompose_query(query, classification)
+    if len(sub_queries) > 1:
+        print(f"Decomposed into {len(sub_queries)} sub-queries: {sub_queries}")
     
-    # Strategy 1: KB Only
-    if strategy == "kb_only":
-        kb_results = search_knowledge_base(query)
-        
-        # Intelligent Fallback:
-        # If very few results, or results seem irrelevant (TODO: implement relevance score check), 
-        # we could fallback. For now, simple count check.
-        if not kb_results:
-            print("No KB results found. Falling back to web search.")
-            print("No KB results found. Falling back to web search.")
-            web_results = get_web_results(query, max_results=3)
-    
-    # Strategy 2: Web Only
-    elif strategy == "web_only":
-        web_results = get_web_results(query, max_results=5)
-    
-    # Strategy 3: Hybrid
-    else:  # hybrid or fallback
-        # In a real async environment, we'd do these in parallel
-        kb_results = search_knowledge_base(query, top_k=3)
-        web_results = get_web_results(query, max_results=3)
+    search_kb = strategy != "web_only"
+    search_web = strategy != "kb_only"  # hybrid or fallback
+    kb_kwargs = {"where": where, "where_document": where_document}
+    if deadline is not None:
+        kb_kwargs["deadline"] = deadline
+    if strategy not in ("kb_only", "web_only"):
+        kb_kwargs["top_k"] = 3
+    web_max_results = WEB_MAX_RESULTS.get(strategy, WEB_MAX_RESULTS["hybrid"])
+    web_kwargs = {"max_results": web_max_results, "deadline": deadline, "ttl_hours": ttl_hours}
+    
+    if context:
+        context = {
+            "kb_results": context.get("kb_results", []) if search_kb else [],
+            "web_results": context.get("web_results", []) if search_web else [],
+        }
+    
+    groups = [
+        {"query": sub_query, "kb_results": [], "web_results": [], "reused": False}
+        for sub_query in sub_queries
+    ]
+    def retrieval(fn, event_type, sub_query):
+        return _reporting(fn, on_event, event_type, sub_query) if on_event else fn
+    
+    calls, targets = [], []
+    for group in groups:
+        reused = covering_results(group["query"], context) if context else None
+        if reused:
+            print(f"  [Context Reused] for sub-query: {group['query']}")
+            group.update(reused, reused=True)
+            if on_event and search_kb:
+                on_event("kb_results", sub_query=group["query"], results=group["kb_results"],
+                         duration_ms=0, cache="context")
+            if on_event and search_web:
+                on_event("web_results", sub_query=group["query"], results=group["web_results"],
+                         duration_ms=0, cache="context")
+            continue
+        if search_kb:
+            calls.append((retrieval(search_knowledge_base, "kb_results", group["query"]), (group["query"],), kb_kwargs))
+            targets.append((group, "kb_results"))
+        if search_web:
+            calls.append((retrieval(get_web_results, "web_results", group["query"]), (group["query"],), web_kwargs))
+            targets.append((group, "web_results"))
+    for (group, field), results in zip(targets, _run_concurrently(calls, deadline) if calls else []):
+        if results is None:
+            deadline.degrade(f"dropped_late_{field}")
+            results = []
+        group[field] = results
+    
+    # Intelligent Fallback:
+    # If very few results, or results seem irrelevant (TODO: implement relevance score check), 
+    # we could fallback. For now, simple count check.
+    retrieved = [group for group in groups if not group["reused"]]
+    if strategy == "kb_only" and retrieved and not any(group["kb_results"] for group in retrieved):
+        print("No KB results found. Falling back to web search.")
+        web_kwargs["max_results"] = WEB_MAX_RESULTS["kb_only"]
+        fallback = _run_concurrently([
+            (retrieval(get_web_results, "web_results", group["query"]), (group["query"],), web_kwargs)
+            for group in retrieved
+        ], deadline)
+        for group, results in zip(retrieved, fallback):
+            if results is None:
+                deadline.degrade("dropped_late_web_results")
+                results = []
+            group["web_results"] = results
+    
+    _dedupe_groups(groups, "kb_results")
+    _dedupe_groups(groups, "web_results")
     
     return {
-        "kb_results": kb_results,
-        "web_results": web_results,
-        "strategy_used": strategy
+        "kb_results": _interleave(groups, "kb_results"),
+        "web_results": _interleave(groups, "web_results"),
+        "strategy_used": strategy,
+        "sub_queries": groups
     }
 
 if __name__ == "__main__":
@@ -1,12 +1,22 @@
 
 import os
-import json
-from langchain_openai import ChatOpenAI
-from langchain.prompts import PromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-from dotenv import load_dotenv
+import re
+import sys
+import threading
+from functools import lru_cache
 
-load_dotenv()
+# Add project root to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.config import load_env
+from utils.deadline import (
+    run_with_timeout, MIN_SYNTH_S, FULL_CONTEXT_S,
+    LLM_REQUEST_TIMEOUT_S, LLM_MAX_RETRIES
+)
+from utils.text import keywords
+from utils.rate_limiter import call_with_rate_limit, estimate_tokens, RateLimitError
+
+load_env()
 
 def format_kb_results(results):
     """Formats KB results for the prompt."""
@@ -33,33 +43,123 @@ def format_web_results(results):
         formatted.append(f"Source [{i+1}] (Web: {title} - {url}):\n{content}\n")
     return "\n".join(formatted)
 
-def synthesizer_agent(query: str, kb_results: list, web_results: list) -> str:
+def format_grouped_results(sub_queries, field, formatter):
     """
-    Synthesizes a final answer from KB and Web results using an LLM.
+    Formats results grouped under the sub-query that retrieved them.
+    
+    Args:
+        sub_queries (list): Dicts with "query" and per-source result lists.
+        field (str): "kb_results" or "web_results".
+        formatter: format_kb_results or format_web_results.
+    """
+    sections = []
+    for i, group in enumerate(sub_queries):
+        sections.append(f"Sub-question {i+1}: {group['query']}\n{formatter(group[field])}")
+    return "\n".join(sections)
+
+# Context kept when the deadline forces a smaller synthesis prompt
+SHRUNK_MAX_RESULTS = 2
+SHRUNK_MAX_CHARS = 600
+
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+def shrink_results(results: list, max_results: int = SHRUNK_MAX_RESULTS, max_chars: int = SHRUNK_MAX_CHARS) -> list:
+    """Keeps the top results and truncates their content to fit a smaller prompt."""
+    shrunk = []
+    for res in results[:max_results]:
+        res = dict(res)
+        content = res.get("content", "")
+        if len(content) > max_chars:
+            res["content"] = content[:max_chars].rsplit(" ", 1)[0] + "..."
+        shrunk.append(res)
+    return shrunk
+
+def extractive_answer(query: str, kb_results: list, web_results: list, max_sentences: int = 3) -> str:
+    """
+    Builds an answer without an LLM call by quoting the retrieved sentences
+    that best overlap the query, each with its citation.
     
     Args:
         query (str): The user's original query.
         kb_results (list): List of results from ChromaDB.
         web_results (list): List of results from Tavily.
+        max_sentences (int): Maximum number of quoted sentences.
         
     Returns:
-        str: The synthesized answer with citations.
+        str: The extractive answer with citations.
     """
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise ValueError("OPENAI_API_KEY not found in environment variables.")
+    query_terms = keywords(query)
+    candidates = []
+    sources = [(res, f"[KB: {res.get('metadata', {}).get('source', 'Unknown Doc')}]") for res in kb_results]
+    sources += [(res, f"[Web: {res.get('title', 'No Title')}]") for res in web_results]
+    
+    for rank, (res, citation) in enumerate(sources):
+        for sentence in _SENTENCE_RE.split(" ".join(res.get("content", "").split())):
+            if len(sentence) < 30:
+                continue
+            overlap = len(query_terms & keywords(sentence))
+            # Prefer overlap, then earlier (higher ranked) sources
+            candidates.append((overlap, -rank, sentence, citation))
+    
+    if not candidates:
+        return "No relevant information was found in the Knowledge Base or Web Search results."
+    
+    best = sorted(candidates, key=lambda c: (c[0], c[1]), reverse=True)[:max_sentences]
+    lines = [f"- {sentence} {citation}" for _, _, sentence, citation in best]
+    return "Key passages from the retrieved sources:\n\n" + "\n".join(lines)
 
-    llm = ChatOpenAI(
-        model="gpt-4o-mini",
-        temperature=0.3, # Slightly creative but grounded
-        api_key=api_key
-    )
+# Fast-answer path: when the top KB hit is at least this relevant (cosine)
+# and this far ahead of the runner-up, a kb_only query is answered by quoting
+# it instead of an LLM call. Off unless NEXUS_FAST_ANSWER=1 or requested.
+FAST_ANSWER_ENABLED = os.getenv("NEXUS_FAST_ANSWER", "0") == "1"
+FAST_ANSWER_MIN_SCORE = float(os.getenv("NEXUS_FAST_ANSWER_MIN_SCORE", "0.6"))
+FAST_ANSWER_MIN_MARGIN = float(os.getenv("NEXUS_FAST_ANSWER_MIN_MARGIN", "0.05"))
+
+def decisive_kb_result(kb_results: list, min_score: float = None, min_margin: float = None):
+    """
+    Returns the top KB result if it is very relevant and clearly ahead of
+    the rest, else None.
     
-    kb_text = format_kb_results(kb_results)
-    web_text = format_web_results(web_results)
+    Args:
+        kb_results (list): KB results with their cosine "score".
+        min_score (float): Minimum top score (default NEXUS_FAST_ANSWER_MIN_SCORE).
+        min_margin (float): Minimum lead over the second score
+            (default NEXUS_FAST_ANSWER_MIN_MARGIN).
+    """
+    min_score = FAST_ANSWER_MIN_SCORE if min_score is None else min_score
+    min_margin = FAST_ANSWER_MIN_MARGIN if min_margin is None else min_margin
+    if not kb_results:
+        return None
+    ranked = sorted(kb_results, key=lambda res: res.get("score") or 0.0, reverse=True)
+    top_score = ranked[0].get("score") or 0.0
+    runner_up = (ranked[1].get("score") or 0.0) if len(ranked) > 1 else 0.0
+    if top_score >= min_score and top_score - runner_up >= min_margin:
+        return ranked[0]
+    return None
+
+def fast_extractive_answer(query: str, kb_results: list, web_results: list, sub_queries: list = None):
+    """
+    Extractive answer from a decisive KB hit, skipping LLM synthesis.
     
-    prompt_template = PromptTemplate(
-        template="""
+    Only single-question, KB-only results qualify: comparisons, multi-part
+    queries and anything that needed the web still go to the LLM, as do
+    results reused from an earlier turn, whose scores were computed for
+    that turn's query.
+    
+    Returns:
+        str | None: The answer quoting the top chunk with its citation, or
+            None if the KB is not decisive.
+    """
+    if web_results or (sub_queries and len(sub_queries) > 1):
+        return None
+    if any(group.get("reused") for group in sub_queries or []):
+        return None
+    top = decisive_kb_result(kb_results)
+    if top is None:
+        return None
+    return extractive_answer(query, [top], [])
+
+SYNTHESIS_PROMPT = """
         You are Nexus, an advanced research assistant. You are analyzing a user query using information from a local Knowledge Base (KB) and Web Search results.
 
         USER QUERY: "{query}"
@@ -87,23 +187,135 @@ def synthesizer_agent(query: str, kb_results: list, web_results: list) -> str:
            - Start with a direct answer or definition.
            - Provide detailed explanation/key points.
            - If sources conflict, explicitly mention the discrepancy.
-        5. If NEITHER source provides relevant info, admit it honestly. Do not hallucinate.
+        5. If results are grouped by sub-question, cover each sub-question, then combine or compare them to answer the User Query.
+        6. If NEITHER source provides relevant info, admit it honestly. Do not hallucinate.
 
         FINAL ANSWER:
-        """,
+        """
+
+# Completion tokens reserved per call in the tokens/min budget
+SYNTH_COMPLETION_TOKENS = 800
+
+@lru_cache(maxsize=4)
+def get_synthesis_chain(api_key: str):
+    """
+    Builds the synthesis chain once per API key.
+    
+    LangChain is imported lazily to keep module import (and app cold start) cheap.
+    """
+    from langchain_openai import ChatOpenAI
+    from langchain_core.prompts import PromptTemplate
+    from langchain_core.output_parsers import StrOutputParser
+
+    llm = ChatOpenAI(
+        model="gpt-4o-mini",
+        temperature=0.3, # Slightly creative but grounded
+        api_key=api_key,
+        timeout=LLM_REQUEST_TIMEOUT_S,
+        max_retries=LLM_MAX_RETRIES
+    )
+
+    prompt_template = PromptTemplate(
+        template=SYNTHESIS_PROMPT,
         input_variables=["query", "kb_text", "web_text"],
     )
 
-    chain = prompt_template | llm | StrOutputParser()
+    return prompt_template | llm | StrOutputParser()
+
+def _stream_answer(chain, inputs: dict, on_token, closed: threading.Event) -> str:
+    """Streams the chain's output to on_token and returns the full text; stops once `closed` is set."""
+    parts = []
+    for chunk in chain.stream(inputs):
+        if closed.is_set():
+            break
+        parts.append(chunk)
+        on_token(chunk)
+    return "".join(parts)
+
+def synthesizer_agent(query: str, kb_results: list, web_results: list, deadline=None,
+                      sub_queries: list = None, on_token=None) -> str:
+    """
+    Synthesizes a final answer from KB and Web results using an LLM.
+    
+    Args:
+        query (str): The user's original query.
+        kb_results (list): List of results from ChromaDB.
+        web_results (list): List of results from Tavily.
+        deadline (Deadline): Optional request budget. When time runs short the
+            context is shrunk, and if the LLM cannot finish in time an
+            extractive answer is returned instead.
+        sub_queries (list): Per-sub-query results from research_agent. With
+            more than one, the context is grouped by sub-query.
+        on_token: Optional callback receiving each answer token as the LLM
+            streams it. Tokens stop once the deadline is hit, and the
+            returned answer (e.g. an extractive fallback) is authoritative.
+        
+    Returns:
+        str: The synthesized answer with citations.
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY not found in environment variables.")
+
+    if deadline is not None:
+        if not deadline.has(MIN_SYNTH_S):
+            deadline.degrade("extractive_answer")
+            return extractive_answer(query, kb_results, web_results)
+        if not deadline.has(FULL_CONTEXT_S):
+            deadline.degrade("shrunk_synthesis_context")
+            kb_results = shrink_results(kb_results)
+            web_results = shrink_results(web_results)
+            if sub_queries:
+                sub_queries = [
+                    {**group, "kb_results": shrink_results(group["kb_results"], max_results=1),
+                     "web_results": shrink_results(group["web_results"], max_results=1)}
+                    for group in sub_queries
+                ]
+
+    if sub_queries and len(sub_queries) > 1:
+        kb_text = format_grouped_results(sub_queries, "kb_results", format_kb_results)
+        web_text = format_grouped_results(sub_queries, "web_results", format_web_results)
+    else:
+        kb_text = format_kb_results(kb_results)
+        web_text = format_web_results(web_results)
+
+    chain = get_synthesis_chain(api_key)
+    inputs = {
+        "query": query,
+        "kb_text": kb_text,
+        "web_text": web_text
+    }
 
+    # Queued behind the shared OpenAI limiter instead of failing on a 429
+    tokens = estimate_tokens(SYNTHESIS_PROMPT, query, kb_text, web_text) + SYNTH_COMPLETION_TOKENS
+    closed = threading.Event()
+    if on_token is not None:
+        call, args = _stream_answer, (chain, inputs, on_token, closed)
+    else:
+        call, args = chain.invoke, (inputs,)
     try:
-        return chain.invoke({
-            "query": query,
-            "kb_text": kb_text,
-            "web_text": web_text
-        })
+        if deadline is not None:
+            remaining = deadline.remaining()
+            return run_with_timeout(
+                call_with_rate_limit, remaining, "openai_chat", call, *args,
+                tokens=tokens, max_wait_s=remaining
+            )
+        return call_with_rate_limit("openai_chat", call, *args, tokens=tokens)
+    except RateLimitError as e:
+        print(f"Synthesis rate limited: {e}")
+        if deadline is not None:
+            deadline.degrade("synthesis_rate_limited")
+        return extractive_answer(query, kb_results, web_results)
+    except TimeoutError as e:
+        print(f"Synthesis timed out: {e}")
+        if deadline is not None:
+            deadline.degrade("synthesis_timeout")
+        return extractive_answer(query, kb_results, web_results)
     except Exception as e:
         return f"Error synthesizing answer: {e}"
+    finally:
+        # A stream still running after a timeout must not emit late tokens
+        closed.set()
 
 if __name__ == "__main__":
     # Test Data Simulation
@@ -1,8 +1,7 @@
 
 import streamlit as st
-import time
 import os
-from agents.orchestrator import process_query
+import threading
 
 # Page Configuration
 st.set_page_config(
@@ -42,6 +41,41 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # Helper functions
+@st.cache_resource(show_spinner=False)
+def load_pipeline():
+    """
+    Imports the orchestrator once per server process (not on every rerun)
+    and warms the LLM chains, Chroma collection, Tavily client and cache in
+    the background while the page renders.
+    """
+    from agents import orchestrator
+    threading.Thread(target=orchestrator.warm_up, name="nexus-warm-up", daemon=True).start()
+    return orchestrator.stream_query
+
+stream_query = load_pipeline()
+
+if "conversation" not in st.session_state:
+    from utils.conversation import ConversationSession
+    st.session_state.conversation = ConversationSession()
+
+@st.cache_data(ttl=60, show_spinner=False)
+def load_shard_stats():
+    """Per-shard chunk counts for the sidebar, refreshed at most once a minute."""
+    from utils.vectordb import get_shard_stats, KB_PARTITION, KB_BACKEND
+    return get_shard_stats(), KB_PARTITION, KB_BACKEND
+
+@st.cache_data(ttl=60, show_spinner=False)
+def load_kb_sources():
+    """Source documents available as KB filters, refreshed at most once a minute."""
+    from utils.vectordb import list_sources
+    return list_sources()
+
+@st.cache_data(ttl=10, show_spinner=False)
+def load_cache_stats():
+    """Web cache size and eviction rate for the sidebar, refreshed at most every 10 seconds."""
+    from utils.cache import get_cache_stats
+    return get_cache_stats()
+
 def map_search_mode(selection):
     mapping = {
         "Auto (Recommended)": "auto",
@@ -66,11 +100,50 @@ with st.sidebar:
     if search_mode in ["Web Search Only", "Hybrid (Both)"]:
         max_web_results = st.slider("Max Web Results", 1, 5, 3)
     
+    from agents.synthesizer import FAST_ANSWER_ENABLED
+    fast_answer = st.checkbox(
+        "⚡ Fast answers",
+        value=FAST_ANSWER_ENABLED,
+        help="Answer knowledge-base questions by quoting a clearly matching passage, skipping LLM synthesis."
+    )
+    
+    if st.button("🧹 New conversation", help="Forget earlier questions so follow-ups start fresh."):
+        st.session_state.conversation.clear()
+    
+    profile_request = st.checkbox(
+        "Profile this request",
+        help="Records a flamegraph and per-stage wall/CPU timings for the next query."
+    )
+    
     st.divider()
     
     st.subheader("📚 Knowledge Base")
-    st.info(f"Loaded Collections: nexus_knowledge_base")
-    # In a real app, query DB for stats
+    try:
+        shard_stats, partition, backend = load_shard_stats()
+        st.info(
+            f"{len(shard_stats)} shard(s), partitioned by {partition}, served from {backend}: "
+            f"{sum(s['count'] for s in shard_stats)} chunks"
+        )
+        if len(shard_stats) > 1:
+            st.table(shard_stats)
+        selected_sources = st.multiselect(
+            "Filter by source",
+            load_kb_sources(),
+            help="Only search these documents. Leave empty to search the whole knowledge base."
+        )
+    except Exception as e:
+        selected_sources = []
+        st.warning(f"Knowledge base unavailable: {e}")
+    
+    try:
+        cache_stats = load_cache_stats()
+        st.caption(
+            f"Web cache: {cache_stats['entries']} entries, "
+            f"{cache_stats['payload_bytes'] / 1e6:.1f} / {cache_stats['max_bytes'] / 1e6:.0f} MB, "
+            f"eviction rate {cache_stats['eviction_rate']:.1%}"
+        )
+    except Exception as e:
+        st.caption(f"Web cache stats unavailable: {e}")
     
     st.divider()
     st.markdown("### ℹ️ About")
@@ -115,48 +188,10 @@ if not query:
             query = "Explain Transformers"
             # logic...
 
-# Processing
-if search_button and query:
-    start_time = time.time()
-    
-    with st.status("🤖 Orchestrating Agents...", expanded=True) as status:
-        st.write("🔍 Classifying query intent...")
-        time.sleep(0.5) # UI candy
-        
-        mode = map_search_mode(search_mode)
-        st.write(f"🚀 Executing usage strategy: **{mode}**")
-        
-        if mode == "auto":
-            st.write("🧠 Determining optimal data sources...")
-        elif mode == "kb_only":
-            st.write("📚 Searching Knowledge Base...")
-        elif mode == "web_only":
-            st.write("🌐 Searching the Web...")
-        else:
-            st.write("🔄 Performing Hybrid Search...")
-            
-        # Execute Pipeline
-        try:
-            result = process_query(query, mode)
-            status.update(label="✅ Research Complete!", state="complete", expanded=False)
-        except Exception as e:
-            status.update(label="❌ Error Occurred", state="error")
-            st.error(f"An error occurred: {e}")
-            st.stop()
-
-    # --- RESULTS DISPLAY ---
-    
-    # 1. Answer
-    st.markdown("### 📄 Synthesis")
-    st.markdown(result["answer"])
-    
-    st.divider()
-    
-    # 2. Sources
-    st.markdown("### 📚 References")
-    
-    kb_sources = [s for s in result["sources"] if s["type"] == "kb"]
-    web_sources = [s for s in result["sources"] if s["type"] == "web"]
+def render_sources(sources):
+    """Knowledge base and web references, one tab each."""
+    kb_sources = [s for s in sources if s["type"] == "kb"]
+    web_sources = [s for s in sources if s["type"] == "web"]
     
     tab1, tab2 = st.tabs([
         f"📁 Knowledge Base ({len(kb_sources)})", 
@@ -168,7 +203,8 @@ if search_button and query:
             st.markdown("*No knowledge base documents used.*")
         for i, source in enumerate(kb_sources):
             with st.container():
-                st.markdown(f"**{i+1}. {source['title']}**")
+                page = f" (p. {source['page']})" if source.get("page") else ""
+                st.markdown(f"**{i+1}. {source['title']}{page}**")
                 st.caption(source['content'])
                 st.markdown("---")
                 
@@ -181,12 +217,133 @@ if search_button and query:
                 st.caption(source['content'])
                 st.markdown("---")
 
-    # 3. Metadata
+STRATEGY_DECIDED_BY = {
+    "classifier": "classified",
+    "user": "selected",
+}
+WEB_CACHE_LABELS = {
+    "hit": "cached",
+    "stale": "cached, refreshing in background",
+    "miss": "live search",
+    "skipped": "skipped, out of time",
+    "context": "from earlier in the conversation",
+}
+
+# Processing
+if search_button and query:
+    mode = map_search_mode(search_mode)
+    result = None
+    
+    # Placeholders filled in as each stage of the pipeline reports back
+    status = st.status("🤖 Orchestrating Agents...", expanded=True)
+    st.markdown("### 📄 Synthesis")
+    notes_area = st.container()
+    answer_area = st.empty()
+    st.divider()
+    st.markdown("### 📚 References")
+    references_area = st.empty()
+    
+    # Execute Pipeline
+    try:
+        from utils.vectordb import build_where
+        answer = ""
+        for event in stream_query(
+            query, mode, profile=profile_request or None,
+            where=build_where(sources=selected_sources),
+            session=st.session_state.conversation,
+            fast_answer=fast_answer
+        ):
+            if event["type"] == "classification":
+                if event["follow_up"]:
+                    status.write(f"💬 Follow-up understood as: *{event['resolved_query']}*")
+                status.write(
+                    f"🧠 Strategy **{event['strategy']}** "
+                    f"({STRATEGY_DECIDED_BY[event['decided_by']]}, {event['elapsed_ms']}ms)"
+                )
+            elif event["type"] == "kb_results":
+                reused = " (from earlier in the conversation)" if event.get("cache") == "context" else ""
+                status.write(
+                    f"📚 Knowledge base: {len(event['sources'])} chunks for *{event['sub_query']}*{reused} "
+                    f"({event['duration_ms']}ms)"
+                )
+            elif event["type"] == "web_results":
+                cache = WEB_CACHE_LABELS.get(event.get("cache"), "live search")
+                status.write(
+                    f"🌐 Web: {len(event['sources'])} results for *{event['sub_query']}* "
+                    f"({cache}, {event['duration_ms']}ms)"
+                )
+            elif event["type"] == "sources":
+                with references_area.container():
+                    render_sources(event["sources"])
+                status.write("✍️ Writing the answer...")
+            elif event["type"] == "token":
+                answer += event["text"]
+                answer_area.markdown(answer + "▌")
+            elif event["type"] == "answer":
+                answer_area.markdown(event["answer"])
+            elif event["type"] == "done":
+                result = event["result"]
+        status.update(
+            label=f"✅ Research Complete! ({result['metadata']['latency_ms']}ms)",
+            state="complete", expanded=False
+        )
+    except Exception as e:
+        status.update(label="❌ Error Occurred", state="error")
+        st.error(f"An error occurred: {e}")
+        st.stop()
+
+    # --- RESULTS DISPLAY ---
+    
+    # 1. How the answer was produced
+    meta = result.get("metadata", {})
+    with notes_area:
+        if meta.get("follow_up"):
+            reused = meta.get("reused_sub_queries", [])
+            st.caption(
+                f"Follow-up understood as: *{meta['resolved_query']}*"
+                + (f" (reused earlier context for: {', '.join(reused)})" if reused else "")
+            )
+        if meta.get("answer_path") == "extractive":
+            st.caption(
+                f"⚡ Quoted from the best-matching knowledge base passage (relevance {meta['kb_top_score']:.2f}). "
+                "Untick **Fast answers** for a synthesized answer."
+            )
+        sub_queries = meta.get("sub_queries", [])
+        if len(sub_queries) > 1:
+            st.caption("Researched as: " + " · ".join(sub_queries))
+
+    # 2. Metadata
     with st.expander("🔧 System Metadata"):
         meta = result.get("metadata", {})
         c1, c2, c3 = st.columns(3)
         c1.metric("Latency", f"{meta.get('latency_ms', 0)}ms")
         c2.metric("KB Chunks", meta.get("kb_sources", 0))
         c3.metric("Web Results", meta.get("web_sources", 0))
+        if meta.get("degradations"):
+            st.warning(
+                f"Latency budget ({meta.get('deadline_ms', 0)}ms) forced: "
+                + ", ".join(meta["degradations"])
+            )
         st.json(result)
 
+    # 3. Profile (opt-in)
+    profile = result.get("metadata", {}).get("profile")
+    if profile:
+        with st.expander("⏱️ Request Profile"):
+            st.caption(
+                f"Wall {profile['total_wall_ms']:.0f}ms | CPU {profile['total_cpu_ms']:.0f}ms. "
+                "Wait time is the request thread blocked on network or locks."
+            )
+            st.table(profile["stages"])
+            with open(profile["flamegraph_path"], "rb") as f:
+                st.download_button(
+                    "Download flamegraph (speedscope)",
+                    data=f.read(),
+                    file_name=os.path.basename(profile["flamegraph_path"]),
+                    mime="application/json"
+                )
+            st.caption(
+                f"Open it at [speedscope.app](https://www.speedscope.app). "
+                f"Summary: `{profile['summary_path']}`"
+            )
+
@@ -0,0 +1,71 @@
+
+import os
+import sys
+import time
+import statistics
+import numpy as np
+
+# Add project root to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.vectordb import max_marginal_relevance
+
+DIM = 1536  # text-embedding-3-small
+
+# Target for the default pool (fetch_k=20, k=4): MMR must stay negligible next to retrieval
+BUDGET_MS = float(os.getenv("NEXUS_MMR_BUDGET_MS", "1.0"))
+
+def naive_mmr(query, candidates, k, lambda_mult=0.5):
+    """Reference implementation with per-pair Python loops, for comparison."""
+    def cos(a, b):
+        return sum(x * y for x, y in zip(a, b)) / (
+            (sum(x * x for x in a) ** 0.5) * (sum(y * y for y in b) ** 0.5)
+        )
+    relevance = [cos(query, c) for c in candidates]
+    selected = [max(range(len(candidates)), key=lambda i: relevance[i])]
+    while len(selected) < k:
+        best, best_score = None, float("-inf")
+        for i in range(len(candidates)):
+            if i in selected:
+                continue
+            redundancy = max(cos(candidates[i], candidates[j]) for j in selected)
+            score = lambda_mult * relevance[i] - (1 - lambda_mult) * redundancy
+            if score > best_score:
+                best, best_score = i, score
+        selected.append(best)
+    return selected
+
+def bench(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return statistics.mean(timings), timings[int(0.95 * (len(timings) - 1))]
+
+def main() -> bool:
+    """Prints the timing table; returns False if the default pool misses BUDGET_MS."""
+    within_budget = True
+    rng = np.random.default_rng(0)
+    print(f"MMR selection overhead (dim={DIM}), milliseconds")
+    print(f"{'fetch_k':>8} {'k':>3} {'numpy mean':>11} {'numpy p95':>10} {'naive mean':>11}")
+    for fetch_k in (10, 20, 50, 100):
+        for k in (3, 4):
+            query = rng.standard_normal(DIM).astype(np.float32)
+            candidates = rng.standard_normal((fetch_k, DIM)).astype(np.float32)
+            mean, p95 = bench(lambda: max_marginal_relevance(query, candidates, k), 500)
+            
+            naive_mean = float("nan")
+            if fetch_k <= 20:
+                q_list, c_list = query.tolist(), candidates.tolist()
+                naive_mean, _ = bench(lambda: naive_mmr(q_list, c_list, k), 5)
+            print(f"{fetch_k:>8} {k:>3} {mean:>11.3f} {p95:>10.3f} {naive_mean:>11.3f}")
+            if fetch_k == 20 and k == 4 and mean >= BUDGET_MS:
+                within_budget = False
+    
+    print(f"Default pool (fetch_k=20, k=4) {'within' if within_budget else 'OVER'} the {BUDGET_MS:g}ms budget.")
+    return within_budget
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -1,17 +1,19 @@
 import os
 import sys
+import time
 
 # Add project root to path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from utils.document_loader import process_document
-from utils.vectordb import get_collection, add_documents_to_collection
+from utils.document_loader import process_document_with_pages
+from utils.vectordb import get_shards, add_documents_to_shards, remove_stale_chunks, KB_PARTITION
+from utils.rate_limiter import priority, PRIORITY_BATCH
 
 DOCS_DIR = os.path.join(os.getcwd(), "data", "sample_docs")
 
 def init_knowledge_base():
     try:
-        collection = get_collection()
+        shards = get_shards()
     except ValueError as e:
         print(f"Error initializing ChromaDB client: {e}")
         return
@@ -33,24 +35,43 @@ def init_knowledge_base():
     all_metadatas = []
     all_ids = []
     
+    # Metadata recorded per chunk so searches can be filtered in the index
+    # (see utils.vectordb.build_where); ingested_at is a Unix timestamp so it
+    # supports range filters such as "ingested this quarter"
+    ingested_at = int(time.time())
+    
     for filename in files:
         file_path = os.path.join(DOCS_DIR, filename)
         print(f"Processing {filename}...")
         
-        chunks = process_document(file_path)
+        chunks = process_document_with_pages(file_path)
         print(f"  - Generated {len(chunks)} chunks.")
         
         for i, chunk in enumerate(chunks):
             # Simple unique ID
             doc_id = f"{filename}_{i}"
-            all_chunks.append(chunk)
-            all_metadatas.append({"source": filename, "chunk_index": i})
+            all_chunks.append(chunk["text"])
+            all_metadatas.append({
+                "source": filename,
+                "chunk_index": i,
+                "page": chunk["page"],
+                "doc_type": os.path.splitext(filename)[1].lstrip(".").lower(),
+                "ingested_at": ingested_at,
+            })
             all_ids.append(doc_id)
             
     if all_chunks:
-        print(f"Adding {len(all_chunks)} chunks to ChromaDB...")
+        print(f"Adding {len(all_chunks)} chunks to ChromaDB across {len(shards)} shard(s) "
+              f"(partitioned by {KB_PARTITION})...")
         try:
-            add_documents_to_collection(collection, all_chunks, all_metadatas, all_ids)
+            counts = add_documents_to_shards(all_chunks, all_metadatas, all_ids)
+            for name, count in sorted(counts.items()):
+                print(f"  - {name}: {count} chunks")
+            # Existing IDs were updated in place; drop chunks a document no longer
+            # has and copies left in a shard they no longer route to
+            removed = remove_stale_chunks(files, all_ids)
+            if removed:
+                print(f"  - Removed {removed} stale chunks")
             print("Knowledge base initialized successfully!")
         except Exception as e:
             print(f"Error adding documents to ChromaDB: {e}")
@@ -58,4 +79,6 @@ def init_knowledge_base():
         print("No content to add.")
 
 if __name__ == "__main__":
-    init_knowledge_base()
+    # Embedding calls yield to interactive queries sharing the quota
+    with priority(PRIORITY_BATCH):
+        init_knowledge_base()
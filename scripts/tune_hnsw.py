@@ -0,0 +1,209 @@
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+# Add project root to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.vectordb import (
+    get_shards, iter_collection, get_hnsw_settings, hnsw_configuration, set_search_ef, HNSW_SPACE
+)
+
+DEFAULT_M_GRID = [8, 16, 32]
+DEFAULT_CONSTRUCTION_EF_GRID = [64, 128, 256]
+DEFAULT_SEARCH_EF_GRID = [10, 20, 40, 80, 160]
+# Largest share of the corpus held out of the scratch indexes as queries
+HOLDOUT_MAX_FRACTION = 0.2
+
+def load_corpus(collections=None):
+    """Reads every chunk ID and embedding from the KB shards."""
+    ids = []
+    embeddings = []
+    for collection in (collections if collections is not None else get_shards()):
+        for doc_id, _, _, embedding in iter_collection(collection):
+            ids.append(doc_id)
+            embeddings.append(np.asarray(embedding, dtype=np.float32))
+    return ids, np.vstack(embeddings) if embeddings else np.zeros((0, 0), dtype=np.float32)
+
+def holdout_split(n: int, num_queries: int, seed: int = 0, max_fraction: float = HOLDOUT_MAX_FRACTION):
+    """
+    Picks the query rows, which are left out of the indexes being tuned, and
+    the rows to index.
+
+    A stored chunk used as its own query is always its exact nearest
+    neighbor and trivially easy for the graph to find, which inflates
+    recall; held-out chunks behave like unseen queries.
+
+    Returns:
+        tuple: (query rows, indexed rows), sorted and disjoint.
+    """
+    if n < 2:
+        raise ValueError("Tuning needs at least 2 chunks (queries are held out of the index).")
+    size = max(1, min(num_queries, int(n * max_fraction)))
+    order = np.random.default_rng(seed).permutation(n)
+    return np.sort(order[:size]), np.sort(order[size:])
+
+def exact_neighbors(corpus, queries, k: int, space: str = HNSW_SPACE):
+    """Brute-force top-k row indices per query in the given distance space."""
+    if space == "cosine":
+        corpus = corpus / np.maximum(np.linalg.norm(corpus, axis=1, keepdims=True), 1e-12)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        distances = -(queries @ corpus.T)
+    elif space == "ip":
+        distances = -(queries @ corpus.T)
+    else:
+        distances = (queries ** 2).sum(axis=1)[:, None] - 2 * queries @ corpus.T + (corpus ** 2).sum(axis=1)[None, :]
+    return np.argsort(distances, axis=1, kind="stable")[:, :k]
+
+def recall_at_k(found: list, expected: list) -> float:
+    """Mean fraction of the exact top-k that the index returned."""
+    hits = [len(set(f) & set(e)) / len(e) for f, e in zip(found, expected) if e]
+    return float(np.mean(hits)) if hits else 1.0
+
+def build_index(client, ids, corpus, space: str, m: int, construction_ef: int):
+    """Builds a scratch collection with the given HNSW build settings."""
+    name = f"nexus_tune_{space}_m{m}_ef{construction_ef}"
+    try:
+        client.delete_collection(name)
+    except Exception:
+        pass
+    collection = client.create_collection(
+        name=name,
+        configuration=hnsw_configuration(space=space, m=m, construction_ef=construction_ef),
+        embedding_function=None
+    )
+    for start in range(0, len(ids), 1000):
+        collection.add(ids=ids[start:start + 1000], embeddings=corpus[start:start + 1000])
+    return collection
+
+def measure(collection, queries, expected_ids, k: int, search_ef: int) -> dict:
+    """Runs every query one at a time and reports recall@k and latency."""
+    set_search_ef(collection, search_ef)
+    collection.query(query_embeddings=[queries[0]], n_results=k, include=[])  # load the index
+
+    latencies = []
+    found = []
+    for query in queries:
+        start = time.perf_counter()
+        results = collection.query(query_embeddings=[query], n_results=k, include=[])
+        latencies.append((time.perf_counter() - start) * 1000)
+        found.append(results["ids"][0])
+
+    return {
+        "recall": round(recall_at_k(found, expected_ids), 4),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+    }
+
+def recommend(rows: list, target_recall: float) -> dict:
+    """Fastest (p95) configuration meeting the recall target, else the most accurate."""
+    meeting = [row for row in rows if row["recall"] >= target_recall]
+    if meeting:
+        return min(meeting, key=lambda row: (row["p95_ms"], row["m"], row["construction_ef"], row["search_ef"]))
+    return max(rows, key=lambda row: (row["recall"], -row["p95_ms"]))
+
+def tune_hnsw(k: int = 5, num_queries: int = 200, target_recall: float = 0.95,
+              m_grid=None, construction_ef_grid=None, search_ef_grid=None,
+              space: str = HNSW_SPACE, seed: int = 0, collections=None, apply: bool = False) -> dict:
+    """
+    Measures recall@k against exact search and query latency over a grid of
+    HNSW settings on the real KB embeddings, and recommends a configuration.
+
+    Each (M, construction_ef) pair is built as a scratch in-memory collection
+    from the stored chunk embeddings; search_ef is swept on each. Queries are
+    a random sample of chunk embeddings held out of the scratch indexes (at
+    most HOLDOUT_MAX_FRACTION of the corpus, see holdout_split).
+
+    Args:
+        k (int): Results per query (recall@k).
+        num_queries (int): Number of held-out queries.
+        target_recall (float): Minimum recall for the recommendation.
+        space (str): Distance space to build the indexes in.
+        apply (bool): Persist the recommended search_ef on the KB shards.
+
+    Returns:
+        dict: Current settings, every grid row, and the recommended row.
+    """
+    import chromadb
+
+    shards = collections if collections is not None else get_shards()
+    ids, corpus = load_corpus(shards)
+    if not ids:
+        raise ValueError("The knowledge base is empty; ingest documents before tuning.")
+
+    query_rows, index_rows = holdout_split(len(ids), num_queries, seed)
+    queries = corpus[query_rows]
+    index_ids = [ids[i] for i in index_rows]
+    index_corpus = corpus[index_rows]
+    k = min(k, len(index_ids))
+    expected_ids = [[index_ids[i] for i in row] for row in exact_neighbors(index_corpus, queries, k, space)]
+
+    print(f"Tuning on {len(index_ids)} chunks, {len(queries)} held-out queries, "
+          f"recall@{k} target {target_recall}")
+    client = chromadb.EphemeralClient()
+    rows = []
+    for m in m_grid or DEFAULT_M_GRID:
+        for construction_ef in construction_ef_grid or DEFAULT_CONSTRUCTION_EF_GRID:
+            build_start = time.perf_counter()
+            collection = build_index(client, index_ids, index_corpus, space, m, construction_ef)
+            build_s = round(time.perf_counter() - build_start, 2)
+            for search_ef in search_ef_grid or DEFAULT_SEARCH_EF_GRID:
+                row = {"m": m, "construction_ef": construction_ef, "search_ef": search_ef, "build_s": build_s}
+                row.update(measure(collection, queries, expected_ids, k, max(search_ef, k)))
+                rows.append(row)
+                print(f"  M={m:<3} construction_ef={construction_ef:<4} search_ef={search_ef:<4} "
+                      f"recall={row['recall']:.3f} p50={row['p50_ms']:.2f}ms p95={row['p95_ms']:.2f}ms")
+            client.delete_collection(collection.name)
+
+    best = recommend(rows, target_recall)
+    print(f"\nCurrent: {[get_hnsw_settings(shard) for shard in shards]}")
+    print(f"Recommended (recall {best['recall']:.3f}, p95 {best['p95_ms']:.2f}ms):")
+    print(f"  NEXUS_HNSW_SPACE={space} NEXUS_HNSW_M={best['m']} "
+          f"NEXUS_HNSW_CONSTRUCTION_EF={best['construction_ef']} NEXUS_HNSW_SEARCH_EF={best['search_ef']}")
+    print("  (M and construction_ef apply to newly created collections: re-ingest to change them.)")
+    if apply:
+        changed = [shard.name for shard in shards if set_search_ef(shard, best["search_ef"])]
+        print(f"Applied search_ef={best['search_ef']} to {len(changed)} shard(s).")
+    return {
+        "current": [get_hnsw_settings(shard) for shard in shards],
+        "space": space,
+        "k": k,
+        "indexed": len(index_ids),
+        "queries": len(queries),
+        "rows": rows,
+        "recommended": best,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune HNSW recall vs. latency on the knowledge base.")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--m", type=int, nargs="+", default=DEFAULT_M_GRID)
+    parser.add_argument("--construction-ef", type=int, nargs="+", default=DEFAULT_CONSTRUCTION_EF_GRID)
+    parser.add_argument("--search-ef", type=int, nargs="+", default=DEFAULT_SEARCH_EF_GRID)
+    parser.add_argument("--space", default=HNSW_SPACE, choices=["cosine", "l2", "ip"])
+    parser.add_argument("--output", default=None, help="Write the full report as JSON.")
+    parser.add_argument("--apply", action="store_true",
+                        help="Persist the recommended search_ef on the knowledge base shards.")
+    args = parser.parse_args()
+
+    report = tune_hnsw(
+        k=args.k,
+        num_queries=args.queries,
+        target_recall=args.target_recall,
+        m_grid=args.m,
+        construction_ef_grid=args.construction_ef,
+        search_ef_grid=args.search_ef,
+        space=args.space,
+        apply=args.apply
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
@@ -0,0 +1,185 @@
+
+import os
+import sys
+import argparse
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+# Add project root to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.query_log import read_query_log
+from utils.cache import get_cached_entry, choose_ttl_hours
+from utils.vectordb import get_cached_embedding, embed_query
+from utils.web_search import WEB_PROVIDER, WEB_SEARCH_DEPTH
+from utils.rate_limiter import priority, PRIORITY_WARMER
+from agents.classifier import classify_query, get_cached_classification
+from agents.decomposer import decompose_query
+from agents.research import refresh_web_results, WEB_MAX_RESULTS
+
+# Estimated cost per upstream call (USD), used to stay within the spend budget
+COST_WEB_SEARCH_USD = float(os.getenv("NEXUS_COST_WEB_SEARCH_USD", "0.008"))
+COST_CLASSIFY_USD = float(os.getenv("NEXUS_COST_CLASSIFY_USD", "0.0002"))
+COST_EMBED_USD = float(os.getenv("NEXUS_COST_EMBED_USD", "0.00001"))
+
+class SpendBudget:
+    """Tracks estimated API spend against a fixed budget."""
+
+    def __init__(self, budget_usd: float):
+        self.budget_usd = budget_usd
+        self.spent_usd = 0.0
+
+    def try_spend(self, cost_usd: float) -> bool:
+        if self.spent_usd + cost_usd > self.budget_usd:
+            return False
+        self.spent_usd += cost_usd
+        return True
+
+def find_hot_queries(records, now: datetime, window_hours: float, top_n: int) -> list:
+    """
+    Ranks logged queries by recent volume, boosted when they are rising.
+
+    Args:
+        records: Query log records covering the last two windows.
+        now (datetime): Reference time.
+        window_hours (float): Length of the "recent" window.
+        top_n (int): Maximum number of queries to return.
+
+    Returns:
+        list: Dicts with query, count, previous count, growth, score and
+            the most common strategy, highest score first.
+    """
+    window_start = now - timedelta(hours=window_hours)
+    recent = Counter()
+    previous = Counter()
+    strategies = defaultdict(Counter)
+
+    for record in records:
+        query = record["query"]
+        if record["ts"] >= window_start:
+            recent[query] += 1
+            strategies[query][record.get("strategy") or "hybrid"] += 1
+        else:
+            previous[query] += 1
+
+    ranked = []
+    for query, count in recent.items():
+        growth = count / (previous[query] + 1)
+        ranked.append({
+            "query": query,
+            "count": count,
+            "previous": previous[query],
+            "growth": round(growth, 2),
+            "score": count * max(growth, 1.0),
+            "strategy": strategies[query].most_common(1)[0][0],
+        })
+    ranked.sort(key=lambda item: item["score"], reverse=True)
+    return ranked[:top_n]
+
+def warm_query(item: dict, budget: SpendBudget, refresh_before: datetime, dry_run: bool = False) -> list:
+    """
+    Refreshes the classification of one hot query, and the web cache and
+    query embedding of each of its sub-queries (agents.decomposer), if they
+    are missing or expire before `refresh_before`.
+
+    Returns:
+        list: Names of the entries that were (or, on a dry run, would be)
+            refreshed; entries of a decomposed query's sub-queries are
+            suffixed with the sub-query, e.g. "web:python".
+    """
+    query = item["query"]
+    strategy = item["strategy"]
+    actions = []
+
+    cached = get_cached_classification(query, touch=False)
+    classification = cached["classification"] if cached else None
+    if (not cached or cached["expires_at"] <= refresh_before) and budget.try_spend(COST_CLASSIFY_USD):
+        actions.append("classification")
+        if not dry_run:
+            classification = classify_query(query, use_cache=False)
+
+    # The research agent retrieves per sub-query, so those are the cache keys
+    for sub_query in decompose_query(query, classification):
+        suffix = "" if sub_query == query else f":{sub_query}"
+
+        if strategy in ("web_only", "hybrid"):
+            max_results = WEB_MAX_RESULTS[strategy]
+            entry = get_cached_entry(
+                sub_query, max_results=max_results, search_depth=WEB_SEARCH_DEPTH,
+                provider=WEB_PROVIDER, touch=False
+            )
+            if (not entry or entry["expires_at"] <= refresh_before) and budget.try_spend(COST_WEB_SEARCH_USD):
+                actions.append("web" + suffix)
+                if not dry_run:
+                    refresh_web_results(sub_query, max_results=max_results, ttl_hours=choose_ttl_hours(classification))
+
+        if strategy in ("kb_only", "hybrid"):
+            embedding = get_cached_embedding(sub_query, touch=False)
+            if (not embedding or embedding["expires_at"] <= refresh_before) and budget.try_spend(COST_EMBED_USD):
+                actions.append("embedding" + suffix)
+                if not dry_run:
+                    embed_query(sub_query, use_cache=False)
+
+    return actions
+
+def warm_cache(window_hours: float = 24, top_n: int = 50, budget_usd: float = 0.50,
+               horizon_hours: float = 2, log_path: str = None, dry_run: bool = False) -> dict:
+    """
+    Pre-warms caches for hot and rising queries from the query log.
+
+    Args:
+        window_hours (float): Recent window used to rank queries (the window
+            before it is the baseline for "rising").
+        top_n (int): Number of queries to consider.
+        budget_usd (float): Maximum estimated API spend for this run.
+        horizon_hours (float): Refresh entries that expire within this horizon.
+        log_path (str): Query log to read (default NEXUS_QUERY_LOG_PATH).
+        dry_run (bool): Report what would be refreshed without calling APIs.
+
+    Returns:
+        dict: Summary with per-query actions and the estimated spend.
+    """
+    now = datetime.now()
+    records = read_query_log(log_path, since=now - timedelta(hours=2 * window_hours))
+    hot = find_hot_queries(records, now, window_hours, top_n)
+
+    budget = SpendBudget(budget_usd)
+    refresh_before = now + timedelta(hours=horizon_hours)
+    report = []
+
+    for item in hot:
+        try:
+            # Warming only uses quota that interactive queries leave free
+            with priority(PRIORITY_WARMER):
+                actions = warm_query(item, budget, refresh_before, dry_run=dry_run)
+        except Exception as e:
+            print(f"Error warming '{item['query']}': {e}")
+            continue
+        report.append({**item, "actions": actions})
+        print(f"{item['query'][:60]:<60} x{item['count']:<4} growth {item['growth']:<5} -> {', '.join(actions) or 'fresh'}")
+        if budget.spent_usd >= budget.budget_usd:
+            print("Spend budget exhausted.")
+            break
+
+    print(f"Warmed {sum(1 for r in report if r['actions'])} of {len(hot)} hot queries; "
+          f"estimated spend ${budget.spent_usd:.4f} of ${budget.budget_usd:.2f}.")
+    return {"queries": report, "spent_usd": budget.spent_usd, "dry_run": dry_run}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-warm caches for hot queries from the query log.")
+    parser.add_argument("--window-hours", type=float, default=24)
+    parser.add_argument("--top", type=int, default=50)
+    parser.add_argument("--budget-usd", type=float, default=0.50)
+    parser.add_argument("--horizon-hours", type=float, default=2)
+    parser.add_argument("--log", default=None)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    warm_cache(
+        window_hours=args.window_hours,
+        top_n=args.top,
+        budget_usd=args.budget_usd,
+        horizon_hours=args.horizon_hours,
+        log_path=args.log,
+        dry_run=args.dry_run
+    )
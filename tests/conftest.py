@@ -0,0 +1,15 @@
+
+import sys
+import os
+import pytest
+from unittest.mock import patch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture(autouse=True)
+def isolated_data_files(tmp_path):
+    """Keeps the cache database and query log of each test out of data/."""
+    with patch("utils.cache.CACHE_DB_PATH", str(tmp_path / "cache.db")), \
+         patch("utils.cache.REAP_INTERVAL_S", 0), \
+         patch("utils.query_log.QUERY_LOG_PATH", str(tmp_path / "query_log.jsonl")):
+        yield
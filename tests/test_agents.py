@@ -2,38 +2,35 @@
 import pytest
 import sys
 import os
+import time
 from unittest.mock import patch, MagicMock
 
 # Add project root to path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from agents.classifier import classify_query
-from agents.research import research_agent
-from agents.synthesizer import synthesizer_agent
+from agents.research import research_agent, get_web_results, search_knowledge_base
+from agents.synthesizer import synthesizer_agent, decisive_kb_result, fast_extractive_answer
 
 # --- Classifier Tests ---
 def test_classifier_temporal_detection():
     """Test if classifier detects temporal queries correctly."""
-    # Mocking the LLM response to avoid API calls during unit tests
-    with patch("agents.classifier.ChatOpenAI") as MockChat:
+    # Mock the cached chain to avoid API calls during unit tests
+    with patch("agents.classifier.get_classifier_chain") as mock_get_chain, \
+         patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}):
         mock_chain = MagicMock()
         mock_chain.invoke.return_value = {
             "type": "factual",
             "has_temporal": True,
             "search_strategy": "web_only"
         }
+        mock_get_chain.return_value = mock_chain
         
-        # We need to mock the entire chain construction
-        # Depending on implementation, this can be tricky.
-        # Ideally, we refactor to allow dependency injection, 
-        # but for now we'll mock the internal chain invoke if possible or rely on patching.
+        result = classify_query("Latest news about OpenAI")
         
-        # Simpler approach for this specific codebase structure:
-        # Patch the `chain.invoke` inside the function.
-        pass # Skipping complex mock setup for this example, focusing on logic
-        
-        # Real logic test (skipping actually calling OpenAI to save costs/time in this env)
-        # In a real CI/CD, we might use VCR.py or similar.
+        assert result["has_temporal"] is True
+        assert result["search_strategy"] == "web_only"
+        mock_get_chain.assert_called_once_with("test-key")
         
 def test_classifier_structure():
     """Verify classifier returns correct keys."""
@@ -69,7 +66,7 @@ def test_research_agent_web_only(mock_kb, mock_web):
     assert len(result["web_results"]) == 1
     mock_kb.assert_not_called()
 
-@patch("agents.research.get_cached_results")
+@patch("agents.research.get_cached_entry")
 @patch("agents.research.tavily_search")
 @patch("agents.research.search_knowledge_base")
 def test_research_agent_hybrid(mock_kb, mock_web, mock_cache):
@@ -95,3 +92,218 @@ def test_synthesizer_format():
     answer = synthesizer_agent("Explain context", kb_res, web_res)
     assert isinstance(answer, str)
     assert len(answer) > 0
+
+@patch("agents.research.schedule_refresh")
+@patch("agents.research.get_cached_entry")
+@patch("agents.research.tavily_search")
+def test_web_results_stale_while_revalidate(mock_web, mock_cache, mock_refresh):
+    """A stale entry is served immediately and refreshed in the background."""
+    mock_cache.return_value = {"results": [{"title": "old news"}], "stale": True, "max_results": 3}
+    
+    results = get_web_results("latest ai news", max_results=3, ttl_hours=1)
+    
+    assert results == [{"title": "old news"}]
+    mock_web.assert_not_called()
+    mock_refresh.assert_called_once_with("latest ai news", max_results=3, ttl_hours=1)
+
+@patch("agents.research.embed_query")
+@patch("agents.research.query_knowledge_base")
+def test_search_knowledge_base_uses_mmr(mock_query_kb, mock_embed):
+    """KB search fetches a wide pool with embeddings and returns a diverse top-k."""
+    mock_embed.return_value = [1.0, 0.0, 0.0]
+    mock_query_kb.return_value = {
+        "documents": [["chunk a", "chunk a (overlap)", "chunk b"]],
+        "metadatas": [[{"source": "a.pdf"}, {"source": "a.pdf"}, {"source": "b.pdf"}]],
+        "distances": [[0.1, 0.12, 0.4]],
+        "embeddings": [[[0.95, 0.31, 0.0], [0.94, 0.34, 0.0], [0.80, 0.0, 0.60]]],
+    }
+    
+    results = search_knowledge_base("query", top_k=2, fetch_k=10)
+    
+    assert [r["content"] for r in results] == ["chunk a", "chunk b"]
+    assert all("score" in r for r in results)
+    call = mock_query_kb.call_args.kwargs
+    assert call["n_results"] == 10
+    assert "embeddings" in call["include"]
+
+@patch("agents.research.search_knowledge_base")
+@patch("agents.research.get_web_results")
+def test_research_agent_passes_kb_filters(mock_web, mock_kb):
+    mock_kb.return_value = []
+    mock_web.return_value = []
+    where = {"source": {"$in": ["llama.pdf"]}}
+    
+    research_agent("llama results", "hybrid", where=where, where_document={"$contains": "Llama"})
+    
+    mock_kb.assert_called_once_with("llama results", top_k=3, where=where, where_document={"$contains": "Llama"})
+
+@patch("agents.research.get_web_results")
+@patch("agents.research.search_knowledge_base")
+def test_research_agent_decomposes_concurrently(mock_kb, mock_web):
+    """Sub-query retrievals run in parallel and duplicates are kept once."""
+    import threading
+    
+    # Every retrieval waits for the other three: run one at a time, they break the barrier
+    all_in_flight = threading.Barrier(4, timeout=5)
+    
+    def slow_kb(query, **kwargs):
+        all_in_flight.wait()
+        shared = {"content": "both", "metadata": {"source": "survey.pdf", "chunk_index": 0}}
+        return [{"content": query, "metadata": {"source": f"{query}.pdf", "chunk_index": 0}}, shared]
+    
+    def slow_web(query, **kwargs):
+        all_in_flight.wait()
+        return [{"title": query, "url": f"https://{query}"}]
+    
+    mock_kb.side_effect = slow_kb
+    mock_web.side_effect = slow_web
+    
+    result = research_agent("How does Llama-3 compare to GPT-4?", "hybrid")
+    
+    assert [g["query"] for g in result["sub_queries"]] == ["Llama-3", "GPT-4"]
+    assert mock_kb.call_count == 2 and mock_web.call_count == 2
+    assert [r["content"] for r in result["kb_results"]] == ["Llama-3", "GPT-4", "both"]
+    assert len(result["sub_queries"][1]["kb_results"]) == 1
+    assert len(result["web_results"]) == 2
+
+def test_synthesizer_groups_context_by_sub_query():
+    sub_queries = [
+        {"query": "Llama-3", "kb_results": [{"content": "Llama facts", "metadata": {"source": "llama.pdf"}}], "web_results": []},
+        {"query": "GPT-4", "kb_results": [], "web_results": [{"title": "GPT-4", "url": "u", "content": "GPT facts"}]},
+    ]
+    with patch("agents.synthesizer.get_synthesis_chain") as mock_get_chain, \
+         patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}):
+        mock_get_chain.return_value.invoke.return_value = "answer"
+        
+        synthesizer_agent("How does Llama-3 compare to GPT-4?", [], [], sub_queries=sub_queries)
+        
+        inputs = mock_get_chain.return_value.invoke.call_args.args[0]
+        assert inputs["kb_text"].startswith("Sub-question 1: Llama-3")
+        assert "Sub-question 2: GPT-4" in inputs["web_text"]
+        assert "GPT facts" in inputs["web_text"]
+
+@patch("agents.research.get_web_results")
+@patch("agents.research.search_knowledge_base")
+def test_research_agent_retrieves_only_uncovered_sub_queries(mock_kb, mock_web):
+    """Sub-queries covered by earlier context are reused; the rest are retrieved."""
+    mock_kb.return_value = [{"content": "Fine-tuning updates weights", "metadata": {"source": "ft.pdf", "chunk_index": 0}}]
+    mock_web.return_value = []
+    context = {
+        "kb_results": [
+            {"content": "RAG retrieves documents", "metadata": {"source": "rag.pdf", "chunk_index": 0}},
+            {"content": "RAG grounds generation", "metadata": {"source": "rag.pdf", "chunk_index": 1}},
+        ],
+        "web_results": [],
+    }
+    
+    result = research_agent("how does RAG compare to fine-tuning?", "hybrid", context=context)
+    
+    mock_kb.assert_called_once()
+    assert mock_kb.call_args.args == ("fine-tuning",)
+    assert [g["reused"] for g in result["sub_queries"]] == [True, False]
+    assert len(result["kb_results"]) == 3
+
+def test_decisive_kb_result_requires_score_and_margin():
+    """Only a relevant top hit clearly ahead of the runner-up is decisive."""
+    top = {"content": "RAG retrieves documents before generating an answer.", "metadata": {"source": "rag.pdf"}, "score": 0.72}
+    close = {"content": "other", "metadata": {"source": "b.pdf"}, "score": 0.70}
+    far = {"content": "other", "metadata": {"source": "b.pdf"}, "score": 0.50}
+    
+    assert decisive_kb_result([far, top], min_score=0.6, min_margin=0.05) is top
+    assert decisive_kb_result([top, close], min_score=0.6, min_margin=0.05) is None
+    assert decisive_kb_result([far], min_score=0.6, min_margin=0.05) is None
+    assert decisive_kb_result([], min_score=0.6, min_margin=0.05) is None
+
+def test_fast_extractive_answer_quotes_top_chunk_only_for_single_kb_queries():
+    top = {"content": "Retrieval-Augmented Generation (RAG) combines a retriever with a generator model.",
+           "metadata": {"source": "rag.pdf"}, "score": 0.9}
+    web = [{"title": "RAG news", "url": "u", "content": "Recent RAG work."}]
+    sub_queries = [{"query": "a"}, {"query": "b"}]
+    
+    answer = fast_extractive_answer("What is RAG?", [top], [])
+    assert "combines a retriever" in answer and "[KB: rag.pdf]" in answer
+    assert fast_extractive_answer("What is RAG?", [top], web) is None
+    assert fast_extractive_answer("What is RAG?", [top], [], sub_queries=sub_queries) is None
+
+@patch("agents.research.get_web_results")
+@patch("agents.research.search_knowledge_base")
+def test_research_agent_reports_each_retrieval(mock_kb, mock_web):
+    """on_event fires per retrieval with its results and, for the web, the cache status."""
+    mock_kb.return_value = [{"content": "kb", "metadata": {"source": "a.pdf"}}]
+    def web(query, on_cache=None, **kwargs):
+        on_cache("hit")
+        return [{"title": "t", "url": "u", "content": "web"}]
+    mock_web.side_effect = web
+    events = []
+    
+    research_agent("What is RAG?", "hybrid", on_event=lambda event_type, **fields: events.append((event_type, fields)))
+    
+    by_type = dict(events)
+    assert set(by_type) == {"kb_results", "web_results"}
+    assert by_type["kb_results"]["results"] == mock_kb.return_value
+    assert by_type["web_results"]["cache"] == "hit"
+    assert by_type["kb_results"]["sub_query"] == "What is RAG?"
+
+def test_synthesizer_streams_tokens():
+    with patch("agents.synthesizer.get_synthesis_chain") as mock_get_chain, \
+         patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}):
+        mock_get_chain.return_value.stream.return_value = iter(["RAG ", "combines ", "retrieval."])
+        tokens = []
+        
+        answer = synthesizer_agent("What is RAG?", [], [], on_token=tokens.append)
+        
+        assert tokens == ["RAG ", "combines ", "retrieval."]
+        assert answer == "RAG combines retrieval."
+        mock_get_chain.return_value.invoke.assert_not_called()
+
+@patch("agents.research.get_web_results")
+@patch("agents.research.search_knowledge_base")
+def test_research_drops_kb_results_past_the_deadline(mock_kb, mock_web):
+    """A KB leg still running when the retrieval budget is spent is abandoned and recorded."""
+    from utils.deadline import Deadline
+    
+    def slow_kb(query, **kwargs):
+        time.sleep(1.0)
+        return [{"content": "late", "metadata": {}}]
+    
+    mock_kb.side_effect = slow_kb
+    mock_web.return_value = [{"title": "web", "url": "https://example.com"}]
+    deadline = Deadline(300)
+    
+    with patch("agents.research.SYNTH_RESERVE_S", 0.1), patch("agents.research.MIN_KB_S", 0.05):
+        result = research_agent("What is RAG?", "hybrid", deadline=deadline)
+    
+    assert result["kb_results"] == []
+    assert len(result["web_results"]) == 1
+    assert "dropped_late_kb_results" in deadline.degradations
+    assert mock_kb.call_args.kwargs["deadline"] is deadline
+
+@patch("agents.research.query_knowledge_base")
+@patch("agents.research.embed_query")
+def test_kb_search_bounds_the_query_embedding(mock_embed, mock_query_kb):
+    """The query embedding gets the remaining budget; running out drops the KB results."""
+    from utils.deadline import Deadline
+    
+    mock_embed.side_effect = TimeoutError("query embedding exceeded 1.00s")
+    deadline = Deadline(10000)
+    
+    assert search_knowledge_base("What is RAG?", deadline=deadline) == []
+    
+    assert 0 < mock_embed.call_args.kwargs["timeout_s"] <= 10
+    assert deadline.degradations == ["dropped_late_kb_results"]
+    mock_query_kb.assert_not_called()
+
+def test_embed_query_waits_no_longer_than_its_timeout():
+    """The rate-limit wait and the embedding request share the caller's timeout."""
+    from utils import vectordb
+    
+    with patch("utils.vectordb.get_cached_embedding", return_value=None), \
+         patch("utils.vectordb.call_with_rate_limit") as mock_call:
+        mock_call.side_effect = TimeoutError("slow")
+        with pytest.raises(TimeoutError):
+            vectordb.embed_query("What is RAG?", timeout_s=2.0)
+    
+    args, kwargs = mock_call.call_args
+    assert kwargs["max_wait_s"] == 2.0
+    assert args[1] is vectordb._request_embedding
+    assert args[3] > time.monotonic()
@@ -0,0 +1,203 @@
+
+import sys
+import os
+import json
+import sqlite3
+import threading
+import pytest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import cache
+
+@pytest.fixture
+def cache_db(tmp_path):
+    """Points the cache at a fresh database for the test."""
+    path = str(tmp_path / "cache.db")
+    with patch("utils.cache.CACHE_DB_PATH", path), patch("utils.cache.REAP_INTERVAL_S", 0):
+        yield path
+
+def test_cache_ttl_policy_and_staleness(cache_db):
+    """Temporal queries get short TTLs; expired entries are stale within the bound."""
+    assert cache.choose_ttl_hours({"has_temporal": True}) == cache.TEMPORAL_TTL_HOURS
+    assert cache.choose_ttl_hours({"type": "explanation", "has_temporal": False}) == cache.EVERGREEN_TTL_HOURS
+    assert cache.choose_ttl_hours(None) == cache.DEFAULT_TTL_HOURS
+    
+    cache.save_to_cache("ai news", [{"title": "news"}], ttl_hours=1)
+    assert cache.get_cached_entry("ai news")["stale"] is False
+    
+    with patch("utils.cache.datetime") as mock_dt:
+        mock_dt.fromisoformat = datetime.fromisoformat
+        mock_dt.now.return_value = datetime.now() + timedelta(minutes=90)
+        assert cache.get_cached_entry("ai news")["stale"] is True
+        assert cache.get_cached_results("ai news") is None
+        
+        # Past expiry by more than the entry's own TTL: a real miss
+        mock_dt.now.return_value = datetime.now() + timedelta(hours=3)
+        assert cache.get_cached_entry("ai news") is None
+
+def test_payload_is_compressed(cache_db):
+    """Results are stored as compressed blobs and round-trip intact."""
+    results = [{"title": "doc", "content": "attention " * 500}]
+    cache.save_to_cache("compress me", results)
+    
+    assert cache.get_cached_results("compress me") == results
+    stats = cache.get_cache_stats()
+    assert stats["entries"] == 1
+    assert stats["payload_bytes"] < len(json.dumps(results)) / 10
+
+def test_lru_eviction_by_bytes(cache_db):
+    """Writes beyond the byte bound evict the least recently used entries."""
+    entries = [[{"content": os.urandom(250).hex()}] for _ in range(4)]
+    entry_bytes = len(cache._encode(entries[0]))
+    max_bytes = int(entry_bytes * 3.5)
+    
+    with patch("utils.cache.MAX_CACHE_BYTES", max_bytes):
+        for i in range(3):
+            cache.save_to_cache(f"query {i}", entries[i])
+        # Touch query 0 so query 1 is the least recently used
+        assert cache.get_cached_results("query 0") is not None
+        cache.save_to_cache("query 3", entries[3])
+    
+    assert cache.get_cached_results("query 1") is None
+    assert cache.get_cached_results("query 0") is not None
+    stats = cache.get_cache_stats()
+    assert stats["payload_bytes"] <= max_bytes
+    assert stats["evictions"] >= 1
+
+def test_reap_expired_rows(cache_db):
+    """Rows past expiry plus the staleness bound are deleted."""
+    cache.save_to_cache("old", [{"title": "old"}], ttl_hours=-(cache.MAX_STALE_HOURS + 1))
+    cache.save_to_cache("fresh", [{"title": "fresh"}])
+    
+    assert cache.reap_expired() == 1
+    assert cache.get_cache_stats()["entries"] == 1
+
+def test_migrates_uncompressed_rows(cache_db):
+    """Rows written by the original uncompressed schema are carried over."""
+    expires_at = (datetime.now() + timedelta(hours=1)).isoformat()
+    conn = sqlite3.connect(cache_db)
+    conn.execute("""
+        CREATE TABLE search_cache (
+            query_hash TEXT PRIMARY KEY, query_text TEXT, results JSON,
+            timestamp DATETIME, expires_at DATETIME
+        )
+    """)
+    conn.execute(
+        "INSERT INTO search_cache VALUES (?, ?, ?, ?, ?)",
+        (cache.get_query_hash("legacy"), "legacy", json.dumps([{"title": "legacy"}]),
+         datetime.now().isoformat(), expires_at)
+    )
+    conn.commit()
+    conn.close()
+    
+    assert cache.get_cached_results("legacy") == [{"title": "legacy"}]
+
+def test_normalized_parameter_aware_keys():
+    """Trivial spelling differences share a key; search parameters do not."""
+    assert cache.make_cache_key("What is RAG?") == cache.make_cache_key("  what   is rag ")
+    assert cache.make_cache_key("What is RAG?") != cache.make_cache_key("What is RAG?", search_depth="advanced")
+    assert cache.make_cache_key("What is RAG?") != cache.make_cache_key("What is RAG?", provider="other")
+
+def test_subset_reuse_by_max_results(cache_db):
+    """A 5-result entry serves a 3-result request, but not the other way round."""
+    five = [{"title": f"r{i}"} for i in range(5)]
+    cache.save_to_cache("llm news", five, max_results=5)
+    
+    assert cache.get_cached_results("LLM news?", max_results=3) == five[:3]
+    assert cache.get_cached_results("llm news", max_results=5) == five
+    
+    cache.save_to_cache("rag news", five[:3], max_results=3)
+    assert cache.get_cached_results("rag news", max_results=5) is None
+    
+    # Fewer results than requested means the provider had no more to give
+    cache.save_to_cache("rare topic", five[:2], max_results=5)
+    assert cache.get_cached_results("rare topic", max_results=4) == five[:2]
+
+def test_smaller_write_keeps_fresh_larger_entry(cache_db):
+    """A 3-result write does not clobber a fresh 5-result entry."""
+    five = [{"title": f"r{i}"} for i in range(5)]
+    cache.save_to_cache("llm news", five, max_results=5)
+    cache.save_to_cache("llm news", five[:3], max_results=3)
+    
+    assert cache.get_cached_results("llm news", max_results=5) == five
+
+def test_migrates_legacy_keys(cache_db):
+    """v1 rows keyed by MD5 are re-keyed, merging queries that now normalize alike."""
+    cache.init_cache()
+    conn = sqlite3.connect(cache_db)
+    conn.execute("PRAGMA user_version = 1")
+    conn.execute("DROP TABLE search_cache")
+    cache._create_schema_v1(conn.cursor())
+    now = datetime.now()
+    for text, n, hours in [("What is RAG?", 3, 1), ("what is rag", 5, 2)]:
+        payload = cache._encode([{"title": str(i)} for i in range(n)])
+        conn.execute(
+            "INSERT INTO search_cache VALUES (?, ?, ?, ?, ?, ?, ?, 0)",
+            (cache.get_query_hash(text), text, payload, len(payload), now.isoformat(),
+             (now + timedelta(hours=hours)).isoformat(), now.isoformat())
+        )
+    conn.commit()
+    conn.close()
+    cache._initialized_paths.discard(cache_db)
+    
+    assert len(cache.get_cached_results("What is RAG", max_results=5)) == 5
+    assert cache.get_cache_stats()["entries"] == 1
+
+def test_byte_total_tracks_writes_and_evictions(cache_db):
+    """The running payload total matches the stored rows after upserts, evictions and reaping."""
+    def stored_bytes():
+        conn = sqlite3.connect(cache_db)
+        total = sum(conn.execute(f"SELECT COALESCE(SUM(size_bytes), 0) FROM {t}").fetchone()[0]
+                    for t in ("search_cache", "kv_cache"))
+        tracked = conn.execute("SELECT value FROM cache_stats WHERE name = 'payload_bytes'").fetchone()[0]
+        conn.close()
+        return total, tracked
+    
+    entries = [[{"content": os.urandom(250).hex()}] for _ in range(6)]
+    with patch("utils.cache.MAX_CACHE_BYTES", int(len(cache._encode(entries[0])) * 3.5)):
+        for i, entry in enumerate(entries):
+            cache.save_to_cache(f"query {i}", entry)
+        cache.save_to_cache("query 5", entries[0][:1] * 2)
+        cache.save_to_cache("query 5", entries[5], max_results=0)  # ignored: smaller than the fresh entry
+        cache.set_kv("embedding", "k", os.urandom(200))
+    cache.save_to_cache("old", [{"title": "old"}], ttl_hours=-(cache.MAX_STALE_HOURS + 1))
+    cache.reap_expired()
+    
+    total, tracked = stored_bytes()
+    assert tracked == total
+    assert cache.get_cache_stats()["evictions"] >= 1
+
+def test_concurrent_init_migrates_once(cache_db):
+    """Processes opening an old database at once do not run its migrations twice."""
+    conn = sqlite3.connect(cache_db)
+    conn.execute("""
+        CREATE TABLE search_cache (
+            query_hash TEXT PRIMARY KEY, query_text TEXT, results JSON,
+            timestamp DATETIME, expires_at DATETIME
+        )
+    """)
+    conn.execute(
+        "INSERT INTO search_cache VALUES (?, ?, ?, ?, ?)",
+        (cache.get_query_hash("legacy"), "legacy", json.dumps([{"title": "legacy"}]),
+         datetime.now().isoformat(), (datetime.now() + timedelta(hours=1)).isoformat())
+    )
+    conn.commit()
+    conn.close()
+    
+    errors = []
+    def init():
+        try:
+            cache.init_cache()
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=init) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    
+    assert errors == []
+    assert cache.get_cached_results("legacy") == [{"title": "legacy"}]
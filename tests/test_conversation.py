@@ -0,0 +1,99 @@
+
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.conversation import ConversationSession, covering_results
+
+def _session_with(query, kb_results=(), web_results=()):
+    session = ConversationSession(max_turns=2)
+    session.add_turn(query, query, {"type": "explanation"}, "hybrid", list(kb_results), list(web_results), "answer")
+    return session
+
+def test_follow_up_detection():
+    session = ConversationSession()
+    assert not session.is_follow_up("and how does that compare to fine-tuning?")
+    
+    session = _session_with("What is RAG?")
+    assert session.is_follow_up("and how does that compare to fine-tuning?")
+    assert session.is_follow_up("What about its limitations?")
+    assert not session.is_follow_up("Explain the transformer architecture")
+
+def test_relative_that_and_dummy_it_are_not_follow_ups():
+    """Only pronouns that must refer back to the previous topic make a follow-up."""
+    session = _session_with("What is RAG?")
+    
+    assert not session.is_follow_up("What is the attention mechanism that transformers use?")
+    assert not session.is_follow_up("Is it true that GPT-4 is multimodal?")
+    assert not session.is_follow_up("Is it possible to fine-tune Llama on one GPU?")
+    assert not session.is_follow_up("Does that model work well?")
+    assert session.is_follow_up("What are its limitations?")
+    assert session.is_follow_up("How is it evaluated?")
+
+def test_resolve_never_substitutes_relative_that_or_dummy_it():
+    session = _session_with("What is RAG?")
+    
+    assert session.resolve("and what models use that?") == "what models use RAG?"
+    assert session.resolve("and is it true that it scales?") == "is it true that RAG scales?"
+    assert session.resolve("and the retriever that it uses?") == "the retriever that RAG uses?"
+
+def test_resolve_substitutes_previous_topic():
+    session = _session_with("What is RAG?")
+    
+    assert session.resolve("and how does that compare to fine-tuning?") == "how does RAG compare to fine-tuning?"
+    assert session.resolve("What about its limitations?") == "What about RAG's limitations?"
+    assert session.resolve("what about latency?") == "what about latency (RAG)"
+
+def test_covering_results_requires_enough_matching_context():
+    context = {
+        "kb_results": [
+            {"content": "RAG combines retrieval with generation."},
+            {"content": "Retrieval-augmented generation (RAG) grounds answers."},
+            {"content": "Transformers use attention."},
+        ],
+        "web_results": [],
+    }
+    
+    covered = covering_results("RAG", context)
+    assert len(covered["kb_results"]) == 2
+    assert covering_results("fine-tuning", context) is None
+
+def test_session_keeps_recent_turns_most_recent_first():
+    session = _session_with("first", kb_results=[{"content": "one"}])
+    session.add_turn("second", "second", None, "kb_only", [{"content": "two"}], [], "a")
+    session.add_turn("third", "third", None, "kb_only", [{"content": "three"}], [], "a")
+    
+    assert len(session) == 2
+    assert [r["content"] for r in session.context()["kb_results"]] == ["three", "two"]
+
+def test_context_only_from_turns_with_the_same_filters():
+    session = ConversationSession()
+    session.add_turn("a", "a", None, "kb_only", [{"content": "all"}], [], "x")
+    session.add_turn("b", "b", None, "kb_only", [{"content": "filtered"}], [], "x",
+                     where={"source": "a.pdf"})
+    
+    assert [r["content"] for r in session.context()["kb_results"]] == ["all"]
+    assert [r["content"] for r in session.context(where={"source": "a.pdf"})["kb_results"]] == ["filtered"]
+    assert session.context(where_document={"$contains": "x"})["kb_results"] == []
+
+def test_leading_conjunction_alone_is_not_a_follow_up():
+    """Conjunctions are stripped (even before a comma); the topic is only appended to "what about X"."""
+    session = _session_with("What is RAG?")
+    
+    assert not session.is_follow_up("So what is BERT?")
+    assert session.resolve("So what is BERT?") == "what is BERT?"
+    assert session.resolve("Also, what is attention?") == "what is attention?"
+    assert session.resolve("Then explain transformers in detail please") == "explain transformers in detail please"
+    assert session.is_follow_up("Also, how is it evaluated in practice on long documents with many tables?")
+
+def test_chained_follow_ups_keep_the_original_topic():
+    session = ConversationSession()
+    session.add_turn("What is RAG?", "What is RAG?", None, "kb_only", [], [], "a")
+    follow_up = "What are its limitations?"
+    resolved = session.resolve(follow_up)
+    session.add_turn(follow_up, resolved, None, "kb_only", [], [], "a")
+    
+    assert resolved == "What are RAG's limitations?"
+    assert session.resolve("and what about its cost?") == "what about RAG's cost?"
+    assert session.resolve("how about latency?") == "how about latency (RAG)"
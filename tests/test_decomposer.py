@@ -0,0 +1,34 @@
+
+import sys
+import os
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agents.decomposer import decompose_query
+
+@pytest.mark.parametrize("query, expected", [
+    ("How does Llama-3 compare to GPT-4?", ["Llama-3", "GPT-4"]),
+    ("Llama-3 vs GPT-4 on reasoning benchmarks", ["Llama-3 on reasoning benchmarks", "GPT-4 on reasoning benchmarks"]),
+    ("What is the difference between RAG and fine-tuning?", ["RAG", "fine-tuning"]),
+    ("Compare BERT, GPT-2 and T5", ["BERT", "GPT-2", "T5"]),
+    ("Llama vs GPT-4 vs Claude", ["Llama", "GPT-4", "Claude"]),
+    ("Llama vs. GPT-4 versus  Claude vs Mistral on coding", [
+        "Llama on coding", "GPT-4 on coding", "Claude on coding", "Mistral on coding"
+    ]),
+    ("What is RAG? How is it evaluated?", ["What is RAG", "How is RAG evaluated"]),
+])
+def test_decomposes_comparisons_and_multi_part_queries(query, expected):
+    assert decompose_query(query) == expected
+
+def test_single_questions_are_left_alone():
+    assert decompose_query("What is the attention mechanism?") == ["What is the attention mechanism?"]
+    assert decompose_query("pros and cons of RAG") == ["pros and cons of RAG"]
+
+def test_classifier_comparison_splits_alternatives():
+    comparison = {"type": "comparison"}
+    assert decompose_query("Is Llama or Mistral better for code?", comparison) == ["Llama for code", "Mistral for code"]
+    assert decompose_query("Which is faster, vLLM or TGI?", comparison) == ["vLLM", "TGI"]
+
+def test_sub_queries_are_capped():
+    assert len(decompose_query("Compare A1, B2, C3, D4, E5 and F6", max_sub_queries=3)) == 3
@@ -0,0 +1,19 @@
+
+import sys
+import os
+from unittest.mock import patch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.document_loader import process_document_with_pages
+
+@patch("utils.document_loader.load_pdf_pages")
+def test_chunks_record_their_start_page(mock_pages):
+    """Each chunk is tagged with the page its text starts on; empty pages are skipped."""
+    mock_pages.return_value = ["alpha " * 30, "", "beta " * 30]
+    
+    chunks = process_document_with_pages("doc.pdf", chunk_size=100, chunk_overlap=0)
+    
+    assert chunks[0]["page"] == 1
+    assert chunks[-1]["page"] == 3
+    assert all(("beta" in c["text"]) == (c["page"] == 3) for c in chunks)
@@ -0,0 +1,37 @@
+
+import sys
+import os
+import json
+import subprocess
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cold import budget for the agent layer (seconds). Heavy SDKs must load lazily.
+IMPORT_BUDGET_S = float(os.getenv("NEXUS_IMPORT_BUDGET_S", "1.0"))
+
+HEAVY_MODULES = ["langchain", "langchain_core", "langchain_openai", "chromadb", "tavily", "numpy"]
+
+def _import_in_fresh_interpreter(module: str) -> dict:
+    code = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "elapsed = time.perf_counter() - start\n"
+        f"heavy = [m for m in {HEAVY_MODULES!r} if m in sys.modules]\n"
+        "print(json.dumps({'elapsed': elapsed, 'heavy': heavy}))\n"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=PROJECT_ROOT, capture_output=True, text=True, check=True
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def test_orchestrator_import_is_lazy():
+    """Importing the orchestrator must not pull in LangChain, Chroma or Tavily."""
+    result = _import_in_fresh_interpreter("agents.orchestrator")
+    assert result["heavy"] == []
+
+def test_orchestrator_import_within_budget():
+    """Cold import of the agent layer stays within the import-time budget."""
+    result = _import_in_fresh_interpreter("agents.orchestrator")
+    assert result["elapsed"] < IMPORT_BUDGET_S, f"import took {result['elapsed']:.3f}s"
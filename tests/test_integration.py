@@ -2,11 +2,12 @@
 import pytest
 import sys
 import os
-from unittest.mock import patch, MagicMock
+import time
+from unittest.mock import patch, MagicMock, ANY
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from agents.orchestrator import process_query
+from agents.orchestrator import process_query, stream_query
 
 @patch("agents.orchestrator.classify_query")
 @patch("agents.orchestrator.research_agent")
@@ -34,7 +35,8 @@ def test_process_query_kb_only(mock_synth, mock_research, mock_classify):
     assert result["metadata"]["web_sources"] == 0
     
     mock_classify.assert_called_once()
-    mock_research.assert_called_with("What is RAG?", "kb_only")
+    mock_research.assert_called_with("What is RAG?", "kb_only", deadline=ANY, classification=mock_classify.return_value,
+                                     where=None, where_document=None, context=None, on_event=ANY)
     mock_synth.assert_called_once()
 
 
@@ -55,5 +57,290 @@ def test_process_query_manual_override():
         
         # Classifier should NOT be called if manual override is used
         # (This logic is implicit in process_query structure)
-        mock_research.assert_called_with("Query", "web_only")
+        mock_research.assert_called_with("Query", "web_only", deadline=ANY, classification=None,
+                                         where=None, where_document=None, context=None, on_event=ANY)
 
+
+@patch("agents.orchestrator.research_agent")
+@patch("agents.orchestrator.synthesizer_agent")
+def test_process_query_profiling(mock_synth, mock_research, tmp_path):
+    """Opt-in profiling writes a speedscope flamegraph and a stage summary."""
+    import json
+    
+    def slow_research(*args, **kwargs):
+        time.sleep(0.05)
+        return {"kb_results": [], "web_results": []}
+    
+    mock_research.side_effect = slow_research
+    mock_synth.return_value = "Answer"
+    
+    with patch("utils.profiling.PROFILE_DIR", str(tmp_path)):
+        result = process_query("Query", "web_only", profile=True)
+    
+    profile = result["metadata"]["profile"]
+    assert [s["name"] for s in profile["stages"]] == ["research", "synthesize"]
+    assert profile["stages"][0]["wait_ms"] > 0
+    
+    with open(profile["summary_path"]) as f:
+        summary = json.load(f)
+    assert summary["sample_count"] > 0
+    with open(profile["flamegraph_path"]) as f:
+        assert json.load(f)["profiles"][0]["type"] == "sampled"
+
+def _burn_cpu(seconds):
+    """Spins in pure Python for about `seconds` of CPU time."""
+    end = time.thread_time() + seconds
+    total = 0
+    while time.thread_time() < end:
+        total += sum(range(1000))
+    return total
+
+@patch("agents.orchestrator.research_agent")
+@patch("agents.orchestrator.synthesizer_agent")
+@patch("agents.classifier.get_classifier_chain")
+def test_profiling_counts_worker_thread_cpu(mock_chain, mock_synth, mock_research, tmp_path):
+    """CPU burnt by a classifier chain on its deadline worker thread is sampled and counted."""
+    import json
+    
+    def cpu_bound_classify(inputs):
+        _burn_cpu(0.2)
+        return {"search_strategy": "kb_only", "type": "explanation", "has_temporal": False}
+    
+    mock_chain.return_value.invoke.side_effect = cpu_bound_classify
+    mock_research.return_value = {"kb_results": [], "web_results": []}
+    mock_synth.return_value = "Answer"
+    
+    with patch("utils.profiling.PROFILE_DIR", str(tmp_path)), \
+         patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}):
+        result = process_query("Query", "auto", profile=True, deadline_ms=10000)
+    
+    profile = result["metadata"]["profile"]
+    classify = next(s for s in profile["stages"] if s["name"] == "classify")
+    assert classify["cpu_ms"] >= 150
+    assert classify["cpu_ms"] >= 0.6 * classify["wall_ms"]
+    assert profile["total_cpu_ms"] >= classify["cpu_ms"]
+    
+    with open(profile["flamegraph_path"]) as f:
+        frames = json.load(f)["shared"]["frames"]
+    assert any(frame["name"].startswith("_burn_cpu") for frame in frames)
+
+def test_process_query_profiling_off_by_default():
+    """Without opt-in, no profile is attached to the response."""
+    with patch("agents.orchestrator.research_agent") as mock_research, \
+         patch("agents.orchestrator.synthesizer_agent") as mock_synth:
+        mock_research.return_value = {"kb_results": [], "web_results": []}
+        mock_synth.return_value = "Answer"
+        
+        result = process_query("Query", "web_only")
+        
+        assert "profile" not in result["metadata"]
+
+@patch("agents.orchestrator.research_agent")
+@patch("agents.classifier.get_classifier_chain")
+@patch("agents.synthesizer.get_synthesis_chain")
+def test_process_query_deadline_degradation(mock_synth_chain, mock_classifier_chain, mock_research):
+    """With almost no budget left, LLM stages are skipped and recorded in metadata."""
+    mock_research.return_value = {
+        "kb_results": [{"content": "RAG combines retrieval with generation to ground answers in documents.",
+                        "metadata": {"source": "rag.pdf"}}],
+        "web_results": []
+    }
+    
+    with patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}):
+        result = process_query("What is RAG?", "auto", deadline_ms=100)
+    
+    meta = result["metadata"]
+    assert result["search_strategy_used"] == "hybrid"
+    assert meta["deadline_ms"] == 100
+    assert meta["degradations"] == ["skipped_classification", "extractive_answer"]
+    assert "[KB: rag.pdf]" in result["answer"]
+    mock_classifier_chain.return_value.invoke.assert_not_called()
+    mock_synth_chain.return_value.invoke.assert_not_called()
+
+@patch("agents.orchestrator.classify_query")
+@patch("agents.orchestrator.research_agent")
+@patch("agents.orchestrator.synthesizer_agent")
+def test_follow_up_reuses_session_context(mock_synth, mock_research, mock_classify):
+    """A follow-up is resolved against the previous turn and classified in its resolved form."""
+    from utils.conversation import ConversationSession
+    
+    mock_classify.return_value = {"search_strategy": "hybrid", "type": "explanation"}
+    rag_chunk = {"content": "RAG retrieves documents", "metadata": {"source": "rag.pdf", "chunk_index": 0}}
+    mock_research.return_value = {"kb_results": [rag_chunk], "web_results": []}
+    mock_synth.return_value = "Answer"
+    session = ConversationSession()
+    
+    process_query("What is RAG?", "auto", session=session)
+    result = process_query("and how does that compare to fine-tuning?", "auto", session=session)
+    
+    assert mock_classify.call_count == 2
+    assert mock_classify.call_args.args[0] == "how does RAG compare to fine-tuning?"
+    args, kwargs = mock_research.call_args
+    assert args == ("how does RAG compare to fine-tuning?", "hybrid")
+    assert kwargs["context"]["kb_results"] == [rag_chunk]
+    assert result["metadata"]["follow_up"] is True
+    assert result["metadata"]["resolved_query"] == "how does RAG compare to fine-tuning?"
+    assert len(session) == 2
+
+@patch("agents.orchestrator.classify_query")
+@patch("agents.orchestrator.research_agent")
+@patch("agents.orchestrator.synthesizer_agent")
+def test_fast_answer_skips_synthesis_for_decisive_kb_hit(mock_synth, mock_research, mock_classify):
+    """A decisive kb_only hit is quoted directly; otherwise synthesis runs as usual."""
+    mock_classify.return_value = {"search_strategy": "kb_only", "type": "explanation"}
+    decisive = [
+        {"content": "Retrieval-Augmented Generation (RAG) grounds a model's answer in retrieved documents.",
+         "metadata": {"source": "rag.pdf"}, "score": 0.91},
+        {"content": "Unrelated chunk about tokenizers and their vocabularies.", "metadata": {"source": "tok.pdf"}, "score": 0.42},
+    ]
+    mock_research.return_value = {"kb_results": decisive, "web_results": [], "sub_queries": []}
+    mock_synth.return_value = "Synthesized Answer"
+    
+    result = process_query("What is RAG?", "auto", fast_answer=True)
+    
+    mock_synth.assert_not_called()
+    assert "[KB: rag.pdf]" in result["answer"]
+    assert result["metadata"]["answer_path"] == "extractive"
+    assert result["metadata"]["kb_top_score"] == 0.91
+    
+    # Same results without the fast path go to the LLM
+    result = process_query("What is RAG?", "auto", fast_answer=False)
+    mock_synth.assert_called_once()
+    assert result["metadata"]["answer_path"] == "llm"
+    
+    # Not decisive: the runner-up is too close
+    decisive[1]["score"] = 0.9
+    result = process_query("What is RAG?", "auto", fast_answer=True)
+    assert mock_synth.call_count == 2
+    assert result["metadata"]["answer_path"] == "llm"
+
+@patch("agents.orchestrator.classify_query")
+@patch("agents.orchestrator.research_agent")
+@patch("agents.orchestrator.synthesizer_agent")
+def test_stream_query_yields_stage_events_in_order(mock_synth, mock_research, mock_classify):
+    """Stages are reported as they finish: sources before any answer token, completion last."""
+    mock_classify.return_value = {"search_strategy": "kb_only", "type": "explanation"}
+    kb = [{"content": "doc", "metadata": {"source": "rag.pdf"}}]
+    
+    def research(query, strategy, on_event=None, **kwargs):
+        on_event("kb_results", sub_query=query, results=kb, duration_ms=5)
+        return {"kb_results": kb, "web_results": [], "sub_queries": [{"query": query}]}
+    
+    def synthesize(on_token=None, **kwargs):
+        for token in ["RAG ", "retrieves."]:
+            on_token(token)
+        return "RAG retrieves."
+    
+    mock_research.side_effect = research
+    mock_synth.side_effect = synthesize
+    
+    events = list(stream_query("What is RAG?", "auto", fast_answer=False))
+    
+    assert [e["type"] for e in events] == [
+        "classification", "kb_results", "sources", "token", "token", "answer", "done"
+    ]
+    assert events[0]["strategy"] == "kb_only" and events[0]["decided_by"] == "classifier"
+    assert events[1]["sources"][0]["title"] == "rag.pdf"
+    assert "".join(e["text"] for e in events if e["type"] == "token") == "RAG retrieves."
+    assert events[-1]["result"]["answer"] == "RAG retrieves."
+    assert set(events[-1]["result"]["metadata"]["timings_ms"]) == {"classify", "research", "answer"}
+    assert all(a["elapsed_ms"] <= b["elapsed_ms"] for a, b in zip(events, events[1:]))
+
+@patch("agents.orchestrator.research_agent")
+def test_stream_query_raises_pipeline_errors(mock_research):
+    mock_research.side_effect = RuntimeError("KB down")
+    
+    stream = stream_query("What is RAG?", "kb_only")
+    assert next(stream)["type"] == "classification"
+    with pytest.raises(RuntimeError, match="KB down"):
+        list(stream)
+
+@patch("agents.orchestrator.classify_query")
+@patch("agents.orchestrator.research_agent")
+@patch("agents.orchestrator.synthesizer_agent")
+def test_temporal_follow_up_is_reclassified_and_retrieves_fresh(mock_synth, mock_research, mock_classify):
+    """"Latest news about it" after a kb_only turn goes to the web, not the earlier KB context."""
+    from utils.conversation import ConversationSession
+    
+    mock_classify.side_effect = [
+        {"search_strategy": "kb_only", "type": "explanation", "has_temporal": False},
+        {"search_strategy": "web_only", "type": "factual", "has_temporal": True},
+    ]
+    mock_research.return_value = {"kb_results": [{"content": "RAG retrieves documents", "metadata": {}}], "web_results": []}
+    mock_synth.return_value = "Answer"
+    session = ConversationSession()
+    
+    process_query("What is RAG?", "auto", session=session)
+    result = process_query("what's the latest news about it?", "auto", session=session)
+    
+    args, kwargs = mock_research.call_args
+    assert args == ("what's the latest news about RAG?", "web_only")
+    assert kwargs["context"] is None
+    assert result["search_strategy_used"] == "web_only"
+    assert result["metadata"]["follow_up"] is True
+
+@patch("agents.orchestrator.classify_query")
+@patch("agents.orchestrator.synthesizer_agent")
+@patch("agents.research.get_web_results")
+@patch("agents.research.search_knowledge_base")
+def test_follow_up_reuses_only_what_its_strategy_fetches(mock_kb, mock_web, mock_synth, mock_classify):
+    """A web_only follow-up to a kb_only turn searches the web instead of answering from old KB chunks."""
+    from utils.conversation import ConversationSession
+    
+    mock_classify.side_effect = [
+        {"search_strategy": "kb_only", "type": "explanation", "has_temporal": False},
+        {"search_strategy": "web_only", "type": "explanation", "has_temporal": False},
+    ]
+    mock_kb.return_value = [
+        {"content": "RAG limitations include retrieval errors.", "metadata": {"source": "rag.pdf", "chunk_index": i}}
+        for i in range(2)
+    ]
+    mock_web.return_value = [{"title": "RAG limitations", "url": "https://example.com", "content": "..."}]
+    mock_synth.return_value = "Answer"
+    session = ConversationSession()
+    
+    process_query("What is RAG?", "auto", session=session)
+    result = process_query("What are its limitations?", "auto", session=session)
+    
+    mock_web.assert_called_once()
+    assert result["metadata"]["reused_sub_queries"] == []
+    assert result["metadata"]["web_sources"] == 1
+
+@patch("agents.orchestrator.classify_query")
+@patch("agents.orchestrator.synthesizer_agent")
+@patch("agents.research.search_knowledge_base")
+def test_fast_answer_skipped_for_reused_context(mock_kb, mock_synth, mock_classify):
+    """Chunks reused from an earlier turn carry that turn's scores, so they never count as decisive."""
+    from utils.conversation import ConversationSession
+    
+    mock_classify.return_value = {"search_strategy": "kb_only", "type": "explanation", "has_temporal": False}
+    mock_kb.return_value = [
+        {"content": "RAG limitations include retrieval errors.", "metadata": {"source": "rag.pdf", "chunk_index": 0},
+         "score": 0.9},
+        {"content": "RAG limitations include stale indexes.", "metadata": {"source": "rag.pdf", "chunk_index": 1},
+         "score": 0.5},
+    ]
+    mock_synth.return_value = "Synthesized Answer"
+    session = ConversationSession()
+    
+    process_query("What is RAG?", "auto", session=session, fast_answer=True)
+    mock_synth.reset_mock()
+    result = process_query("What are its limitations?", "auto", session=session, fast_answer=True)
+    
+    assert mock_kb.call_count == 1
+    assert result["metadata"]["reused_sub_queries"] == ["What are RAG's limitations?"]
+    assert result["metadata"]["answer_path"] == "llm"
+    assert result["metadata"]["kb_top_score"] is None
+    mock_synth.assert_called_once()
+
+def test_abandoned_calls_do_not_delay_later_requests():
+    """Calls left running after a timeout hold their own threads, not a shared pool."""
+    from utils.deadline import run_with_timeout
+    
+    for _ in range(12):
+        with pytest.raises(TimeoutError):
+            run_with_timeout(time.sleep, 0.01, 1.0)
+    
+    start = time.monotonic()
+    assert run_with_timeout(lambda: "answer", 0.5) == "answer"
+    assert time.monotonic() - start < 0.1
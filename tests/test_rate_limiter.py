@@ -0,0 +1,104 @@
+
+import sys
+import os
+import time
+import threading
+import pytest
+from unittest.mock import patch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.rate_limiter import (
+    ProviderLimiter, RateLimitError, call_with_rate_limit, priority, current_priority,
+    PRIORITY_INTERACTIVE, PRIORITY_BATCH, PRIORITY_WARMER
+)
+from utils.deadline import run_with_timeout
+
+class ThrottledError(Exception):
+    """Stands in for a provider 429 response."""
+    status_code = 429
+
+def test_bucket_queues_instead_of_failing():
+    """Calls beyond the requests/min bucket wait for the refill rather than erroring."""
+    limiter = ProviderLimiter("test", rpm=600, reserve=0)  # 10 requests/s
+    limiter.requests.level = 1
+
+    assert limiter.acquire(timeout=1) < 0.01
+    waited = limiter.acquire(timeout=1)
+    assert 0.05 < waited < 0.5
+    assert limiter.get_stats()["queued"] == 1
+
+def test_tokens_per_minute_limit():
+    """A call needing more tokens than are left waits for the token bucket."""
+    limiter = ProviderLimiter("test", rpm=1000, tpm=6000, reserve=0)  # 100 tokens/s
+    limiter.tokens.level = 0
+
+    with pytest.raises(RateLimitError):
+        limiter.acquire(tokens=50, timeout=0.1)
+    assert limiter.acquire(tokens=50, timeout=1) > 0
+    assert limiter.get_stats()["timeouts"] == 1
+
+def test_interactive_served_before_queued_batch():
+    """When both are queued, an interactive call gets the next slot ahead of earlier batch calls."""
+    limiter = ProviderLimiter("test", rpm=300, reserve=0)  # one slot per 0.2s
+    limiter.requests.level = 0
+    order = []
+
+    def worker(name, level):
+        limiter.acquire(level=level, timeout=5)
+        order.append(name)
+
+    threads = [threading.Thread(target=worker, args=(f"batch{i}", PRIORITY_BATCH)) for i in range(2)]
+    for t in threads:
+        t.start()
+    time.sleep(0.05)
+    interactive = threading.Thread(target=worker, args=("interactive", PRIORITY_INTERACTIVE))
+    interactive.start()
+    for t in threads + [interactive]:
+        t.join()
+
+    assert order[0] == "interactive"
+
+def test_batch_leaves_reserve_for_interactive():
+    """Batch calls stop at the reserved share of the bucket; interactive calls may use it."""
+    limiter = ProviderLimiter("test", rpm=10, reserve=0.2)
+    for _ in range(8):
+        limiter.acquire(level=PRIORITY_WARMER, timeout=0.1)
+
+    with pytest.raises(RateLimitError):
+        limiter.acquire(level=PRIORITY_WARMER, timeout=0.05)
+    limiter.acquire(level=PRIORITY_INTERACTIVE, timeout=0.05)
+
+@patch("utils.rate_limiter.RATE_LIMIT_BACKOFF_S", 0.01)
+def test_throttled_call_is_retried_after_pause():
+    """A 429 pauses the provider queue and the call is retried."""
+    calls = []
+    def flaky():
+        calls.append(1)
+        if len(calls) == 1:
+            raise ThrottledError("429 Too Many Requests")
+        return "ok"
+
+    with patch("utils.rate_limiter.get_limiter", return_value=ProviderLimiter("test", rpm=1000)) as get_limiter:
+        assert call_with_rate_limit("test", flaky) == "ok"
+    assert len(calls) == 2
+    assert get_limiter.return_value.get_stats()["throttled"] == 1
+
+def test_other_errors_are_not_retried():
+    """Errors other than throttling propagate on the first attempt."""
+    calls = []
+    def broken():
+        calls.append(1)
+        raise ValueError("bad request")
+
+    with patch("utils.rate_limiter.get_limiter", return_value=ProviderLimiter("test", rpm=1000)):
+        with pytest.raises(ValueError):
+            call_with_rate_limit("test", broken)
+    assert len(calls) == 1
+
+def test_priority_propagates_to_worker_threads():
+    """run_with_timeout workers keep the caller's priority class."""
+    assert current_priority() == PRIORITY_INTERACTIVE
+    with priority(PRIORITY_BATCH):
+        assert run_with_timeout(current_priority, 1.0) == PRIORITY_BATCH
+    assert run_with_timeout(current_priority, 1.0) == PRIORITY_INTERACTIVE
@@ -0,0 +1,146 @@
+
+import sys
+import os
+import numpy as np
+import pytest
+from unittest.mock import MagicMock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.snapshot import KBSnapshot, export_snapshot
+
+def _fake_collection(name, embeddings, start=0):
+    """Collection stub whose get() pages through the given embeddings."""
+    ids = [f"{name}_{start + i}" for i in range(len(embeddings))]
+    collection = MagicMock()
+    collection.name = name
+    collection.count.return_value = len(embeddings)
+
+    def get(include, limit, offset):
+        page = slice(offset, offset + limit)
+        return {
+            "ids": ids[page],
+            "documents": [f"chunk {i} – ünïcode" for i in ids[page]],
+            "metadatas": [
+                {"source": f"{name}.pdf", "chunk_index": i, "doc_type": "pdf", "ingested_at": 1700000000 + i}
+                for i in range(len(ids))
+            ][page],
+            "embeddings": list(embeddings[page]),
+        }
+
+    collection.get.side_effect = get
+    return collection
+
+def _export(tmp_path, dtype="float32", ann=False, n=200, dim=32):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((n, dim)).astype(np.float32)
+    collections = [
+        _fake_collection("kb_shard00", vectors[: n // 2]),
+        _fake_collection("kb_shard01", vectors[n // 2:], start=n // 2),
+    ]
+    path = str(tmp_path / "snapshot")
+    manifest = export_snapshot(path, dtype=dtype, ann=ann, collections=collections)
+    return KBSnapshot(path), manifest, vectors
+
+def _exact_top(vectors, query, k):
+    normed = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return list(np.argsort(-(normed @ (query / np.linalg.norm(query))))[:k])
+
+def test_snapshot_round_trip_matches_brute_force(tmp_path, monkeypatch):
+    monkeypatch.setattr("utils.snapshot.EXPORT_BATCH_SIZE", 7)
+    snapshot, manifest, vectors = _export(tmp_path)
+    query = vectors[5] + 0.1
+
+    results = snapshot.query(query, n_results=5, include=["documents", "metadatas", "distances", "embeddings"])
+
+    expected = _exact_top(vectors, query, 5)
+    assert results["ids"][0] == [f"kb_shard0{i // 100}_{i}" for i in expected]
+    assert results["documents"][0][0].endswith("ünïcode")
+    assert results["distances"][0] == sorted(results["distances"][0])
+    assert len(results["embeddings"][0]) == 5
+    assert manifest["count"] == 200
+    assert snapshot.shard_stats() == [{"name": "kb_shard00", "count": 100}, {"name": "kb_shard01", "count": 100}]
+
+def test_int8_snapshot_preserves_ranking(tmp_path):
+    snapshot, manifest, vectors = _export(tmp_path, dtype="int8")
+    query = vectors[42]
+
+    results = snapshot.query(query, n_results=3, include=["distances"])
+
+    assert manifest["dtype"] == "int8"
+    assert results["ids"][0][0] == "kb_shard00_42"
+    assert abs(results["distances"][0][0]) < 1e-3
+
+def test_ivf_snapshot_probes_lists(tmp_path):
+    snapshot, manifest, vectors = _export(tmp_path, ann=True)
+    query = vectors[150]
+    nlist = manifest["ann"]["nlist"]
+
+    exhaustive = snapshot.query(query, n_results=5, nprobe=nlist)
+    approximate = snapshot.query(query, n_results=5, nprobe=2)
+
+    assert exhaustive["ids"][0] == [f"kb_shard0{i // 100}_{i}" for i in _exact_top(vectors, query, 5)]
+    assert approximate["ids"][0][0] == "kb_shard01_150"
+
+def test_export_replaces_previous_snapshot(tmp_path):
+    _export(tmp_path, n=10)
+    snapshot, manifest, _ = _export(tmp_path, n=20)
+
+    assert len(snapshot) == 20
+    assert not os.path.exists(str(tmp_path / "snapshot.tmp"))
+
+def test_matches_where_operators():
+    from utils.snapshot import matches_where, matches_where_document
+    metadata = {"source": "llama.pdf", "page": 3, "ingested_at": 1700000000}
+    
+    assert matches_where(metadata, {"source": "llama.pdf"})
+    assert matches_where(metadata, {"source": {"$in": ["llama.pdf", "gpt.pdf"]}})
+    assert matches_where(metadata, {"$and": [{"page": {"$gte": 3}}, {"ingested_at": {"$lt": 1800000000}}]})
+    assert matches_where(metadata, {"$or": [{"source": "gpt.pdf"}, {"page": {"$ne": 1}}]})
+    assert not matches_where(metadata, {"doc_type": {"$gt": 1}})
+    assert matches_where_document("Llama 2 results", {"$contains": "Llama"})
+    assert not matches_where_document("Llama 2 results", {"$not_contains": "Llama"})
+
+def test_snapshot_filters_before_scoring(tmp_path):
+    """Filtered queries only return matching chunks, even when IVF lists hold too few."""
+    snapshot, manifest, vectors = _export(tmp_path, ann=True)
+    query = vectors[5]  # lives in kb_shard00.pdf
+
+    results = snapshot.query(query, n_results=5, nprobe=1, where={"source": "kb_shard01.pdf"},
+                             include=["metadatas", "distances"])
+
+    assert len(results["ids"][0]) == 5
+    assert all(m["source"] == "kb_shard01.pdf" for m in results["metadatas"][0])
+    assert snapshot.sources() == ["kb_shard00.pdf", "kb_shard01.pdf"]
+    
+    empty = snapshot.query(query, where={"source": "missing.pdf"})
+    assert empty["ids"] == [[]]
+
+def test_column_filters_skip_metadata_decoding(tmp_path, monkeypatch):
+    """source/doc_type/ingested_at filters are answered from the mmapped columns."""
+    snapshot, manifest, vectors = _export(tmp_path, dtype="int8")
+    monkeypatch.setattr(snapshot, "metadatas", MagicMock(side_effect=AssertionError("decoded metadata")))
+    where = {"$and": [
+        {"source": {"$in": ["kb_shard01.pdf"]}}, {"doc_type": "pdf"}, {"ingested_at": {"$gte": 1700000090}}
+    ]}
+
+    results = snapshot.query(vectors[150], n_results=20, where=where, include=["metadatas"])
+
+    assert manifest["columns"]["source"] == {"type": "category", "values": ["kb_shard00.pdf", "kb_shard01.pdf"]}
+    assert len(results["ids"][0]) == 10
+    assert all(m["source"] == "kb_shard01.pdf" and m["chunk_index"] >= 90 for m in results["metadatas"][0])
+    assert snapshot.query(vectors[0], where={"doc_type": {"$ne": "pdf"}})["ids"] == [[]]
+
+def test_other_filters_fall_back_to_metadata(tmp_path):
+    snapshot, _, vectors = _export(tmp_path)
+
+    results = snapshot.query(vectors[3], n_results=3, where={"chunk_index": 3}, include=["metadatas"])
+
+    assert results["ids"][0] == ["kb_shard00_3", "kb_shard01_103"]
+
+def test_export_fails_if_collection_changes(tmp_path):
+    collection = _fake_collection("kb_shard00", np.ones((5, 4), dtype=np.float32))
+    collection.count.return_value = 6
+
+    with pytest.raises(ValueError):
+        export_snapshot(str(tmp_path / "snapshot"), collections=[collection])
@@ -0,0 +1,82 @@
+
+import sys
+import os
+import numpy as np
+from unittest.mock import MagicMock, patch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scripts.tune_hnsw import exact_neighbors, recall_at_k, recommend, tune_hnsw, holdout_split
+from utils import vectordb
+from utils.vectordb import hnsw_configuration, set_search_ef
+
+def test_exact_neighbors_per_space():
+    corpus = np.array([[1.0, 0.0], [10.0, 1.0], [0.0, 1.0]], dtype=np.float32)
+    query = np.array([[1.0, -0.05]], dtype=np.float32)
+    
+    assert list(exact_neighbors(corpus, query, 1, "cosine")[0]) == [0]
+    assert list(exact_neighbors(corpus, query, 1, "ip")[0]) == [1]
+    assert list(exact_neighbors(corpus, query, 2, "l2")[0]) == [0, 2]
+
+def test_recall_at_k():
+    assert recall_at_k([["a", "b"], ["c", "x"]], [["a", "b"], ["c", "d"]]) == 0.75
+
+def test_recommend_picks_fastest_config_meeting_target():
+    rows = [
+        {"m": 8, "construction_ef": 64, "search_ef": 10, "recall": 0.80, "p95_ms": 0.5},
+        {"m": 16, "construction_ef": 64, "search_ef": 40, "recall": 0.97, "p95_ms": 1.2},
+        {"m": 32, "construction_ef": 256, "search_ef": 160, "recall": 1.00, "p95_ms": 3.0},
+    ]
+    
+    assert recommend(rows, 0.95)["search_ef"] == 40
+    assert recommend(rows, 1.01)["search_ef"] == 160
+
+def test_set_search_ef_only_modifies_on_change():
+    collection = MagicMock()
+    collection.configuration = hnsw_configuration(search_ef=100)
+    
+    assert set_search_ef(collection, 100) is False
+    assert set_search_ef(collection, 40) is True
+    collection.modify.assert_called_once_with(configuration={"hnsw": {"ef_search": 40}})
+
+def test_tune_hnsw_on_small_corpus():
+    """End to end on an in-memory corpus: small grids still reach full recall."""
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((60, 16)).astype(np.float32)
+    source = MagicMock()
+    source.name = "kb"
+    source.configuration = hnsw_configuration()
+    source.get.side_effect = lambda include, limit, offset: {
+        "ids": [f"c{i}" for i in range(len(vectors))][offset:offset + limit],
+        "documents": [""] * len(vectors[offset:offset + limit]),
+        "metadatas": [{}] * len(vectors[offset:offset + limit]),
+        "embeddings": list(vectors[offset:offset + limit]),
+    }
+    
+    report = tune_hnsw(
+        k=3, num_queries=20, m_grid=[8], construction_ef_grid=[64],
+        search_ef_grid=[10, 100], collections=[source]
+    )
+    
+    assert len(report["rows"]) == 2
+    assert report["recommended"]["recall"] >= 0.95
+    assert report["queries"] == 12 and report["indexed"] == 48
+    source.modify.assert_not_called()
+
+def test_holdout_queries_are_not_indexed():
+    queries, indexed = holdout_split(100, num_queries=200, seed=1)
+    
+    assert len(queries) == 20
+    assert len(indexed) == 80
+    assert not set(queries) & set(indexed)
+
+def test_opening_a_collection_does_not_rewrite_its_config():
+    """Reads never persist HNSW settings; only creation and tuning set search_ef."""
+    client = MagicMock()
+    with patch("utils.vectordb.get_chroma_client", return_value=client), \
+         patch("utils.vectordb.get_embedding_function"):
+        collection = vectordb._open_collection.__wrapped__("kb")
+        vectordb.search_collection(collection, query_embeddings=[[1.0, 0.0]])
+    
+    assert client.get_or_create_collection.call_args.kwargs["configuration"] == hnsw_configuration()
+    collection.modify.assert_not_called()
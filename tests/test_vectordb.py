@@ -0,0 +1,156 @@
+
+import sys
+import os
+import numpy as np
+from unittest.mock import MagicMock, patch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import vectordb
+from utils.vectordb import max_marginal_relevance
+
+def test_mmr_prefers_diverse_candidates():
+    """After the most relevant chunk, a distinct chunk beats a near-copy of it."""
+    query = [1.0, 0.0, 0.0]
+    candidates = [
+        [0.95, 0.31, 0.0],   # most relevant
+        [0.94, 0.34, 0.0],   # near-duplicate of the first
+        [0.80, 0.0, 0.60],   # relevant and different
+    ]
+    
+    selected, scores = max_marginal_relevance(query, candidates, k=2, lambda_mult=0.5)
+    
+    assert selected == [0, 2]
+    assert scores[0] > scores[1]
+
+def test_mmr_drops_exact_duplicates():
+    """Chunks above the duplicate threshold are never selected, so fewer than k return."""
+    selected, _ = max_marginal_relevance([1.0, 0.0], [[1.0, 0.0], [1.0, 0.0]], k=2)
+    assert selected == [0]
+
+def test_mmr_pure_relevance_matches_top_k():
+    """With lambda=1 MMR reduces to plain top-k by similarity."""
+    rng = np.random.default_rng(1)
+    query = rng.standard_normal(64)
+    candidates = rng.standard_normal((30, 64))
+    
+    selected, _ = max_marginal_relevance(query, candidates, k=5, lambda_mult=1.0)
+    
+    normed = candidates / np.linalg.norm(candidates, axis=1, keepdims=True)
+    expected = list(np.argsort(-(normed @ query))[:5])
+    assert selected == expected
+
+def test_mmr_handles_empty_pool():
+    assert max_marginal_relevance([1.0, 0.0], [], k=3) == ([], [])
+
+def _fake_shard(name, ids, distances):
+    shard = MagicMock()
+    shard.name = name
+    shard.query.return_value = {
+        "ids": [ids],
+        "documents": [[f"doc {i}" for i in ids]],
+        "metadatas": [[{"source": f"{i}.pdf"} for i in ids]],
+        "distances": [distances],
+    }
+    return shard
+
+@patch("utils.vectordb.get_shards")
+def test_search_shards_merges_by_distance(mock_get_shards):
+    """Each shard is queried with the shared embedding and the global top-k is kept."""
+    mock_get_shards.return_value = [
+        _fake_shard("kb_shard00", ["a", "b"], [0.1, 0.5]),
+        _fake_shard("kb_shard01", ["c", "d"], [0.2, 0.3]),
+    ]
+    
+    results = vectordb.search_shards([1.0, 0.0], n_results=3, include=["documents", "metadatas"])
+    
+    assert results["ids"] == [["a", "c", "d"]]
+    assert results["distances"] == [[0.1, 0.2, 0.3]]
+    assert results["shards"] == [["kb_shard00", "kb_shard01", "kb_shard01"]]
+    assert results["documents"] == [["doc a", "doc c", "doc d"]]
+    for shard in mock_get_shards.return_value:
+        assert shard.query.call_args.kwargs["query_embeddings"] == [[1.0, 0.0]]
+
+@patch("utils.vectordb.get_shards")
+def test_search_shards_skips_failed_shard(mock_get_shards):
+    broken = _fake_shard("kb_shard01", [], [])
+    broken.query.side_effect = RuntimeError("index unavailable")
+    mock_get_shards.return_value = [_fake_shard("kb_shard00", ["a"], [0.1]), broken]
+    
+    results = vectordb.search_shards([1.0, 0.0], n_results=2)
+    
+    assert results["ids"] == [["a"]]
+
+def test_shard_routing_is_stable_and_partitioned_by_source():
+    names = [f"kb_shard{i:02d}" for i in range(4)]
+    with patch("utils.vectordb.get_shard_names", return_value=names), \
+         patch("utils.vectordb.KB_PARTITION", "source"):
+        shard = vectordb.shard_for("paper.pdf", "paper.pdf_0")
+        assert all(vectordb.shard_for("paper.pdf", f"paper.pdf_{i}") == shard for i in range(20))
+    with patch("utils.vectordb.get_shard_names", return_value=names), \
+         patch("utils.vectordb.KB_PARTITION", "hash"):
+        assert len({vectordb.shard_for("paper.pdf", f"paper.pdf_{i}") for i in range(20)}) > 1
+
+def test_build_where_combines_clauses():
+    assert vectordb.build_where() is None
+    assert vectordb.build_where(sources=["a.pdf"]) == {"source": {"$in": ["a.pdf"]}}
+    assert vectordb.build_where(sources=["a.pdf"], ingested_after=1700000000.5) == {"$and": [
+        {"source": {"$in": ["a.pdf"]}}, {"ingested_at": {"$gte": 1700000000}}
+    ]}
+
+@patch("utils.vectordb.get_shards")
+def test_search_shards_pushes_filters_into_each_shard(mock_get_shards):
+    mock_get_shards.return_value = [_fake_shard("kb_shard00", ["a"], [0.1]), _fake_shard("kb_shard01", [], [])]
+    where = {"source": {"$in": ["a.pdf"]}}
+    
+    vectordb.search_shards([1.0, 0.0], n_results=2, where=where, where_document={"$contains": "llama"})
+    
+    for shard in mock_get_shards.return_value:
+        call = shard.query.call_args.kwargs
+        assert call["where"] == where
+        assert call["where_document"] == {"$contains": "llama"}
+
+def test_reingest_upserts_existing_ids():
+    """Re-adding an existing chunk ID updates its metadata instead of being skipped."""
+    collection = MagicMock()
+    
+    vectordb.add_documents_to_collection(collection, ["text"], [{"source": "a.pdf", "page": 3}], ["a.pdf_0"])
+    
+    collection.upsert.assert_called_once_with(
+        documents=["text"], metadatas=[{"source": "a.pdf", "page": 3}], ids=["a.pdf_0"]
+    )
+    collection.add.assert_not_called()
+
+@patch("utils.vectordb.get_shards")
+def test_remove_stale_chunks_keeps_reingested_ids(mock_get_shards):
+    shard = MagicMock()
+    shard.name = vectordb.KB_COLLECTION_NAME
+    shard.get.return_value = {"ids": ["a.pdf_0", "a.pdf_1", "a.pdf_2"], "metadatas": [{"source": "a.pdf"}] * 3}
+    mock_get_shards.return_value = [shard]
+    
+    assert vectordb.remove_stale_chunks(["a.pdf"], ["a.pdf_0", "a.pdf_1"]) == 1
+    
+    assert shard.get.call_args.kwargs["where"] == {"source": {"$in": ["a.pdf"]}}
+    shard.delete.assert_called_once_with(ids=["a.pdf_2"])
+
+@patch("utils.vectordb.get_shards")
+def test_remove_stale_chunks_drops_copies_in_the_wrong_shard(mock_get_shards):
+    """After a shard count change, a kept ID survives only in the shard it now routes to."""
+    with patch("utils.vectordb.KB_NUM_SHARDS", 2), patch("utils.vectordb.KB_PARTITION", "hash"):
+        names = vectordb.get_shard_names()
+        ids = [f"a.pdf_{i}" for i in range(6)]
+        shards = []
+        for name in names:
+            shard = MagicMock()
+            shard.name = name
+            # Both shards hold a copy of every chunk: the new and the old routing
+            shard.get.return_value = {"ids": ids, "metadatas": [{"source": "a.pdf"}] * len(ids)}
+            shards.append(shard)
+        mock_get_shards.return_value = shards
+        
+        assert vectordb.remove_stale_chunks(["a.pdf"], ids) == len(ids)
+        
+        for shard in shards:
+            deleted = shard.delete.call_args.kwargs["ids"]
+            assert all(vectordb.shard_for("a.pdf", doc_id) != shard.name for doc_id in deleted)
+            assert len(deleted) == sum(vectordb.shard_for("a.pdf", doc_id) != shard.name for doc_id in ids)
@@ -0,0 +1,76 @@
+
+import sys
+import os
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.query_log import log_query, read_query_log
+from utils.cache import save_to_cache
+from scripts.warm_cache import find_hot_queries, warm_cache
+
+def test_query_log_round_trip():
+    """Queries are logged normalized and read back with timestamps."""
+    log_query("  What is RAG? ", "kb_only", 1200)
+    
+    records = list(read_query_log())
+    assert len(records) == 1
+    assert records[0]["query"] == "what is rag"
+    assert records[0]["strategy"] == "kb_only"
+    assert isinstance(records[0]["ts"], datetime)
+
+def test_find_hot_queries_ranks_rising_queries():
+    """A query that is rising outranks one with steady, slightly higher volume."""
+    now = datetime.now()
+    recent, old = now - timedelta(hours=1), now - timedelta(hours=30)
+    records = (
+        [{"query": "steady", "strategy": "hybrid", "ts": recent}] * 4
+        + [{"query": "steady", "strategy": "hybrid", "ts": old}] * 4
+        + [{"query": "rising", "strategy": "web_only", "ts": recent}] * 3
+    )
+    
+    hot = find_hot_queries(records, now, window_hours=24, top_n=10)
+    
+    assert [h["query"] for h in hot] == ["rising", "steady"]
+    assert hot[0]["strategy"] == "web_only"
+
+@patch("scripts.warm_cache.embed_query")
+@patch("scripts.warm_cache.refresh_web_results")
+@patch("scripts.warm_cache.classify_query")
+def test_warm_cache_refreshes_within_budget(mock_classify, mock_refresh, mock_embed):
+    """Only missing or expiring entries are refreshed, and spend stops at the budget."""
+    mock_classify.return_value = {"type": "factual", "has_temporal": True, "search_strategy": "hybrid"}
+    for _ in range(3):
+        log_query("ai news", "hybrid", 900)
+    log_query("llm benchmarks", "web_only", 900)
+    # A fresh web entry needs no refresh
+    save_to_cache("llm benchmarks", [{"title": f"r{i}"} for i in range(5)], ttl_hours=24, max_results=5)
+    
+    with patch("scripts.warm_cache.COST_WEB_SEARCH_USD", 0.01), \
+         patch("scripts.warm_cache.COST_CLASSIFY_USD", 0.001), \
+         patch("scripts.warm_cache.COST_EMBED_USD", 0.0):
+        report = warm_cache(budget_usd=0.012)
+    
+    actions = {r["query"]: r["actions"] for r in report["queries"]}
+    assert actions["ai news"] == ["classification", "web", "embedding"]
+    assert actions["llm benchmarks"] == ["classification"]
+    assert report["spent_usd"] <= 0.012
+    mock_refresh.assert_called_once()
+    assert mock_refresh.call_args.kwargs["ttl_hours"] == 1
+
+@patch("scripts.warm_cache.embed_query")
+@patch("scripts.warm_cache.refresh_web_results")
+@patch("scripts.warm_cache.classify_query")
+def test_warm_cache_warms_each_sub_query(mock_classify, mock_refresh, mock_embed):
+    """A comparison is warmed under the sub-query keys the research agent fetches."""
+    mock_classify.return_value = {"type": "comparison", "has_temporal": False, "search_strategy": "hybrid"}
+    log_query("python vs rust", "hybrid", 900)
+    
+    report = warm_cache(budget_usd=1.0)
+    
+    assert report["queries"][0]["actions"] == [
+        "classification", "web:python", "embedding:python", "web:rust", "embedding:rust"
+    ]
+    assert [c.args[0] for c in mock_refresh.call_args_list] == ["python", "rust"]
+    assert [c.args[0] for c in mock_embed.call_args_list] == ["python", "rust"]
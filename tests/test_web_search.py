@@ -0,0 +1,136 @@
+
+import sys
+import os
+import time
+import threading
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.web_search import ResilientSearchClient, CircuitBreaker, WebSearchError, CircuitOpenError
+from utils.rate_limiter import ProviderLimiter
+
+def make_client(search_fn, **kwargs):
+    defaults = dict(timeout_s=2.0, retries=2, backoff_s=0.01, hedge_default_s=0.05, negative_ttl_s=60)
+    defaults.update(kwargs)
+    return ResilientSearchClient(search_fn, **defaults)
+
+def test_retries_transient_failure():
+    """A transient error is retried and the later success is returned."""
+    calls = []
+    def flaky(query, max_results, timeout_s):
+        calls.append(timeout_s)
+        if len(calls) == 1:
+            raise ConnectionError("reset")
+        return [{"title": "ok"}]
+    
+    client = make_client(flaky)
+    assert client.search("q") == [{"title": "ok"}]
+    assert client.get_stats()["retries"] == 1
+    assert all(t <= 2.0 for t in calls)
+
+def test_hedges_slow_primary():
+    """A primary slower than the hedge delay is raced by a duplicate request."""
+    calls = []
+    def slow_then_fast(query, max_results, timeout_s):
+        calls.append(1)
+        if len(calls) == 1:
+            time.sleep(0.5)
+            return [{"title": "slow"}]
+        return [{"title": "fast"}]
+    
+    client = make_client(slow_then_fast)
+    assert client.search("q") == [{"title": "fast"}]  # returned before the primary finished
+    assert client.get_stats()["hedges"] == 1
+
+def test_deadline_and_negative_cache():
+    """A hung upstream fails by the deadline, then fails fast from the negative cache."""
+    calls, finished = [], []
+    released = threading.Event()
+    def hang(query, max_results, timeout_s):
+        calls.append(1)
+        released.wait(5)
+        finished.append(1)
+        return []
+    
+    client = make_client(hang, timeout_s=0.1, retries=0)
+    with pytest.raises(WebSearchError):
+        client.search("q")
+    assert calls and not finished  # gave up while upstream was still hanging
+    
+    n_calls = len(calls)
+    with pytest.raises(WebSearchError):
+        client.search("q")
+    assert len(calls) == n_calls
+    assert client.get_stats()["negative_hits"] == 1
+    released.set()
+
+def test_circuit_breaker_opens():
+    """Consecutive failures open the breaker so later calls skip upstream."""
+    calls = []
+    def down(query, max_results, timeout_s):
+        calls.append(1)
+        raise ConnectionError("down")
+    
+    client = make_client(down, retries=0, breaker=CircuitBreaker(threshold=2, cooldown_s=60))
+    for q in ["a", "b"]:
+        with pytest.raises(WebSearchError):
+            client.search(q)
+    with pytest.raises(CircuitOpenError):
+        client.search("c")
+    assert len(calls) == 2
+    assert client.get_stats()["breaker_state"] == "open"
+
+def test_rate_limit_backpressure_is_not_an_upstream_failure():
+    """Timing out in our own limiter queue neither trips the breaker nor negative-caches."""
+    calls = []
+    def search(query, max_results, timeout_s):
+        calls.append(1)
+        return [{"title": "ok"}]
+    
+    limiter = ProviderLimiter("test", rpm=60, reserve=0)
+    limiter.requests.level = 0
+    client = make_client(search, timeout_s=0.1, limiter=limiter, breaker=CircuitBreaker(threshold=1))
+    
+    with pytest.raises(WebSearchError):
+        client.search("q")
+    assert not calls
+    assert client.breaker.state == "closed"
+    assert client.get_stats()["rate_limited"] == 1
+    
+    limiter.requests.level = 1
+    assert client.search("q") == [{"title": "ok"}]  # not served from the negative cache
+
+def test_no_hedge_without_spare_rate_limit_slot():
+    """A slow primary is not hedged when the limiter has no free slot."""
+    calls = []
+    def slow(query, max_results, timeout_s):
+        calls.append(1)
+        time.sleep(0.2)
+        return [{"title": "slow"}]
+    
+    limiter = ProviderLimiter("test", rpm=60, reserve=0)
+    limiter.requests.level = 1
+    client = make_client(slow, limiter=limiter)
+    
+    assert client.search("q") == [{"title": "slow"}]
+    assert len(calls) == 1
+    assert client.get_stats()["hedges"] == 0
+
+def test_caller_budget_timeout_is_not_an_upstream_failure():
+    """A timeout under a caller's short budget neither trips the breaker nor negative-caches."""
+    calls = []
+    def slow(query, max_results, timeout_s):
+        calls.append(timeout_s)
+        time.sleep(0.2)
+        return [{"title": "slow"}]
+    
+    client = make_client(slow, retries=0, hedge_default_s=1.0, breaker=CircuitBreaker(threshold=1))
+    with pytest.raises(WebSearchError):
+        client.search("q", timeout=0.05)
+    assert client.breaker.state == "closed"
+    
+    n_calls = len(calls)
+    assert client.search("q") == [{"title": "slow"}]  # not served from the negative cache
+    assert len(calls) > n_calls
+    assert client.get_stats()["negative_hits"] == 0
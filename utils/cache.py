@@ -3,86 +3,571 @@ import sqlite3
 import json
 import hashlib
 import os
+import re
+import unicodedata
+import time
+import zlib
+import threading
 from datetime import datetime, timedelta
 
 CACHE_DB_PATH = os.path.join(os.getcwd(), "data", "cache.db")
 
-def init_cache():
-    """Initializes the SQLite cache database."""
-    os.makedirs(os.path.dirname(CACHE_DB_PATH), exist_ok=True)
-    
-    conn = sqlite3.connect(CACHE_DB_PATH)
-    cursor = conn.cursor()
-    
+# TTL policy (hours), chosen per query from the classifier output
+DEFAULT_TTL_HOURS = float(os.getenv("NEXUS_CACHE_TTL_HOURS", "24"))
+TEMPORAL_TTL_HOURS = float(os.getenv("NEXUS_CACHE_TEMPORAL_TTL_HOURS", "1"))
+EVERGREEN_TTL_HOURS = float(os.getenv("NEXUS_CACHE_EVERGREEN_TTL_HOURS", "168"))
+# How long past expiry an entry may still be served while it is refreshed
+MAX_STALE_HOURS = float(os.getenv("NEXUS_CACHE_MAX_STALE_HOURS", "24"))
+
+# Size bound and housekeeping
+MAX_CACHE_BYTES = int(os.getenv("NEXUS_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+EVICTION_POLICY = os.getenv("NEXUS_CACHE_EVICTION", "lru").lower()  # "lru" or "lfu"
+REAP_INTERVAL_S = float(os.getenv("NEXUS_CACHE_REAP_INTERVAL_S", "300"))
+# Evict down to this fraction of the bound so every write does not evict
+EVICTION_LOW_WATER = 0.9
+
+# Bump when normalize_query or the key layout changes; stale keys then miss
+KEY_VERSION = "v2"
+
+# Paths whose schema has already been created in this process
+_initialized_paths = set()
+_init_lock = threading.Lock()
+_reaper_started = threading.Event()
+
+def _encode(results: list) -> bytes:
+    """Serializes results as zlib-compressed compact JSON."""
+    return zlib.compress(json.dumps(results, separators=(",", ":")).encode("utf-8"), 6)
+
+def _decode(payload: bytes) -> list:
+    return json.loads(zlib.decompress(payload).decode("utf-8"))
+
+def _create_schema_v1(cursor):
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS search_cache (
             query_hash TEXT PRIMARY KEY,
             query_text TEXT,
-            results JSON,
+            payload BLOB,
+            size_bytes INTEGER,
             timestamp DATETIME,
-            expires_at DATETIME
+            expires_at DATETIME,
+            last_access DATETIME,
+            hit_count INTEGER DEFAULT 0
         )
     """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_search_cache_expires_at ON search_cache (expires_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_search_cache_last_access ON search_cache (last_access)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS cache_stats (
+            name TEXT PRIMARY KEY,
+            value INTEGER
+        )
+    """)
+
+def _migrate_to_v1(cursor):
+    """
+    Moves rows from the original uncompressed table (results JSON column)
+    into the compressed, size-tracked v1 table.
+    """
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(search_cache)")]
+    if "results" not in columns:
+        _create_schema_v1(cursor)
+        return
+
+    cursor.execute("ALTER TABLE search_cache RENAME TO search_cache_v0")
+    _create_schema_v1(cursor)
+    for query_hash, query_text, results_json, timestamp, expires_at in cursor.execute(
+        "SELECT query_hash, query_text, results, timestamp, expires_at FROM search_cache_v0"
+    ).fetchall():
+        payload = _encode(json.loads(results_json))
+        cursor.execute("""
+            INSERT OR REPLACE INTO search_cache
+                (query_hash, query_text, payload, size_bytes, timestamp, expires_at, last_access, hit_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+        """, (query_hash, query_text, payload, len(payload), timestamp, expires_at, timestamp))
+    cursor.execute("DROP TABLE search_cache_v0")
+
+def _migrate_to_v2(cursor):
+    """
+    Re-keys rows with the versioned, parameter-aware cache key and records
+    how many results each entry covers.
+    
+    The requested max_results of legacy rows is unknown, so it is taken to be
+    the number of results stored (they can still serve smaller requests).
+    Rows whose queries normalize to the same key are merged, keeping the
+    one that covers the most results and expires last.
+    """
+    cursor.execute("ALTER TABLE search_cache ADD COLUMN max_results INTEGER")
+    rows = cursor.execute("""
+        SELECT query_hash, query_text, payload, size_bytes, timestamp,
+               expires_at, last_access, hit_count
+        FROM search_cache
+    """).fetchall()
+    
+    best = {}
+    for row in rows:
+        query_text, payload, expires_at = row[1], row[2], row[5]
+        key = make_cache_key(query_text or "")
+        candidate = (len(_decode(payload)), expires_at, row)
+        if key not in best or candidate[:2] > best[key][:2]:
+            best[key] = candidate
     
+    cursor.execute("DELETE FROM search_cache")
+    for key, (max_results, _, row) in best.items():
+        cursor.execute("""
+            INSERT INTO search_cache
+                (query_hash, query_text, payload, size_bytes, timestamp,
+                 expires_at, last_access, hit_count, max_results)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (key,) + tuple(row[1:]) + (max_results,))
+
+def _migrate_to_v3(cursor):
+    """Adds the key/value table used by the classification and embedding caches."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS kv_cache (
+            namespace TEXT,
+            key TEXT,
+            payload BLOB,
+            size_bytes INTEGER,
+            timestamp DATETIME,
+            expires_at DATETIME,
+            last_access DATETIME,
+            hit_count INTEGER DEFAULT 0,
+            PRIMARY KEY (namespace, key)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_kv_cache_expires_at ON kv_cache (expires_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_kv_cache_last_access ON kv_cache (last_access)")
+
+# Tables that share the byte bound, eviction and reaping
+_CACHE_TABLES = ("search_cache", "kv_cache")
+
+def _migrate_to_v4(cursor):
+    """
+    Keeps the payload byte total of both tables in cache_stats
+    ("payload_bytes"), maintained by triggers, so the size bound is checked
+    without summing every row on each write.
+    """
+    for table in _CACHE_TABLES:
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_bytes_insert AFTER INSERT ON {table} BEGIN
+                UPDATE cache_stats SET value = value + COALESCE(NEW.size_bytes, 0)
+                WHERE name = 'payload_bytes';
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_bytes_update AFTER UPDATE OF size_bytes ON {table} BEGIN
+                UPDATE cache_stats SET value = value + COALESCE(NEW.size_bytes, 0) - COALESCE(OLD.size_bytes, 0)
+                WHERE name = 'payload_bytes';
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_bytes_delete AFTER DELETE ON {table} BEGIN
+                UPDATE cache_stats SET value = value - COALESCE(OLD.size_bytes, 0)
+                WHERE name = 'payload_bytes';
+            END
+        """)
+    total = sum(
+        cursor.execute(f"SELECT COALESCE(SUM(size_bytes), 0) FROM {table}").fetchone()[0]
+        for table in _CACHE_TABLES
+    )
+    cursor.execute("INSERT OR REPLACE INTO cache_stats (name, value) VALUES ('payload_bytes', ?)", (total,))
+
+# Ordered schema migrations, applied based on PRAGMA user_version
+_MIGRATIONS = [
+    (1, _migrate_to_v1),
+    (2, _migrate_to_v2),
+    (3, _migrate_to_v3),
+    (4, _migrate_to_v4),
+]
+
+def init_cache():
+    """
+    Initializes the SQLite cache database, migrating older schemas.
+    
+    The version check and every migration run in one exclusive (BEGIN
+    IMMEDIATE) transaction, so concurrent processes opening an old
+    database migrate it once; the others wait, re-read user_version and
+    find nothing left to do.
+    """
+    os.makedirs(os.path.dirname(CACHE_DB_PATH), exist_ok=True)
+    
+    conn = sqlite3.connect(CACHE_DB_PATH, timeout=10, isolation_level=None)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        for target, migrate in _MIGRATIONS:
+            if version < target:
+                migrate(cursor)
+                cursor.execute(f"PRAGMA user_version = {target}")
+                version = target
+        cursor.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            cursor.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+def ensure_cache():
+    """
+    Creates the cache schema on first use, once per process and database path,
+    and starts the background reaper for expired rows.
+    
+    This replaces initializing the cache at import time.
+    """
+    if CACHE_DB_PATH not in _initialized_paths:
+        with _init_lock:
+            if CACHE_DB_PATH not in _initialized_paths:
+                init_cache()
+                _initialized_paths.add(CACHE_DB_PATH)
+    if REAP_INTERVAL_S > 0 and not _reaper_started.is_set():
+        _reaper_started.set()
+        threading.Thread(target=_reaper_loop, name="nexus-cache-reaper", daemon=True).start()
+
+def _connect():
+    """Opens a connection to the (lazily initialized) cache database."""
+    ensure_cache()
+    return sqlite3.connect(CACHE_DB_PATH, timeout=10)
+
+def _bump_stats(cursor, **increments):
+    for name, amount in increments.items():
+        cursor.execute("""
+            INSERT INTO cache_stats (name, value) VALUES (?, ?)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+        """, (name, amount))
+
+def reap_expired() -> int:
+    """
+    Deletes rows that are past expiry by more than the staleness bound
+    (so can never be served again). Uses the expires_at index.
+    
+    Returns:
+        int: Number of rows deleted.
+    """
+    cutoff = datetime.now() - timedelta(hours=MAX_STALE_HOURS)
+    conn = _connect()
+    cursor = conn.cursor()
+    reaped = 0
+    for table in _CACHE_TABLES:
+        cursor.execute(f"DELETE FROM {table} WHERE expires_at < ?", (cutoff.isoformat(),))
+        reaped += cursor.rowcount
+    if reaped:
+        _bump_stats(cursor, reaped=reaped)
     conn.commit()
     conn.close()
+    return reaped
+
+def _reaper_loop():
+    while True:
+        time.sleep(REAP_INTERVAL_S)
+        try:
+            reaped = reap_expired()
+            if reaped:
+                print(f"  [Cache] Reaped {reaped} expired entries")
+        except Exception as e:
+            print(f"  [Cache] Reaper error: {e}")
+
+def _enforce_size_limit(cursor, max_bytes: int = None):
+    """
+    Evicts entries (LRU by last access, or LFU by hit count) until the
+    payload total is under the low-water mark of the byte bound.
+    """
+    if max_bytes is None:
+        max_bytes = MAX_CACHE_BYTES
+    # Running total kept by the v4 triggers
+    total = cursor.execute("SELECT value FROM cache_stats WHERE name = 'payload_bytes'").fetchone()[0]
+    if total <= max_bytes:
+        return
+    
+    to_free = total - int(max_bytes * EVICTION_LOW_WATER)
+    if EVICTION_POLICY == "lfu":
+        order_by = "hit_count ASC, last_access ASC"
+    else:
+        order_by = "last_access ASC"
+    
+    candidates = " UNION ALL ".join(
+        f"SELECT '{table}' AS tbl, rowid, size_bytes, last_access, hit_count FROM {table}"
+        for table in _CACHE_TABLES
+    )
+    victims = {table: [] for table in _CACHE_TABLES}
+    freed = 0
+    for table, rowid, size_bytes in cursor.execute(
+        f"SELECT tbl, rowid, size_bytes FROM ({candidates}) ORDER BY {order_by}"
+    ).fetchall():
+        victims[table].append((rowid,))
+        freed += size_bytes or 0
+        if freed >= to_free:
+            break
+    
+    for table, rowids in victims.items():
+        cursor.executemany(f"DELETE FROM {table} WHERE rowid = ?", rowids)
+    _bump_stats(cursor, evictions=sum(len(r) for r in victims.values()), evicted_bytes=freed)
+
+def get_cache_stats() -> dict:
+    """
+    Returns current size and housekeeping counters for the web cache.
+    
+    Returns:
+        dict: entries, payload bytes, file bytes, expired entries, and the
+            eviction/reap counters with the eviction rate per write.
+    """
+    conn = _connect()
+    cursor = conn.cursor()
+    entries, payload_bytes = cursor.execute(
+        "SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM search_cache"
+    ).fetchone()
+    expired = cursor.execute(
+        "SELECT COUNT(*) FROM search_cache WHERE expires_at < ?", (datetime.now().isoformat(),)
+    ).fetchone()[0]
+    kv_entries, kv_bytes = cursor.execute(
+        "SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM kv_cache"
+    ).fetchone()
+    counters = dict(cursor.execute("SELECT name, value FROM cache_stats").fetchall())
+    conn.close()
+    
+    writes = counters.get("writes", 0)
+    return {
+        "entries": entries,
+        "payload_bytes": payload_bytes + kv_bytes,
+        "kv_entries": kv_entries,
+        "file_bytes": os.path.getsize(CACHE_DB_PATH),
+        "max_bytes": MAX_CACHE_BYTES,
+        "expired_entries": expired,
+        "writes": writes,
+        "hits": counters.get("hits", 0),
+        "evictions": counters.get("evictions", 0),
+        "evicted_bytes": counters.get("evicted_bytes", 0),
+        "reaped": counters.get("reaped", 0),
+        "eviction_rate": counters.get("evictions", 0) / writes if writes else 0.0,
+    }
 
 def get_query_hash(query: str) -> str:
-    """Returns MD5 hash of the query."""
+    """Returns MD5 hash of the query (the legacy, pre-v2 cache key)."""
     return hashlib.md5(query.strip().lower().encode()).hexdigest()
 
-def get_cached_results(query: str):
+_WHITESPACE_RE = re.compile(r"\s+")
+_TRAILING_PUNCT_RE = re.compile(r"[\s?!.]+$")
+
+def normalize_query(query: str) -> str:
     """
-    Retrieves cached results for a query if they exist and haven't expired.
+    Canonical form of a query for cache keys: Unicode NFKC, lowercase,
+    collapsed whitespace, no surrounding quotes or trailing ?/!/. marks.
+    """
+    text = unicodedata.normalize("NFKC", query).lower()
+    text = _WHITESPACE_RE.sub(" ", text).strip().strip("\"'")
+    return _TRAILING_PUNCT_RE.sub("", text)
+
+def make_cache_key(query: str, search_depth: str = "basic", provider: str = "tavily") -> str:
+    """
+    Returns the versioned cache key for a web search.
+    
+    The key covers everything that changes the result set except
+    max_results, which is stored with the entry so that a larger cached
+    result set can serve a smaller request.
+    """
+    raw = "|".join([KEY_VERSION, provider, search_depth, normalize_query(query)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def choose_ttl_hours(classification: dict = None) -> float:
+    """
+    Picks a cache TTL from the classifier output.
+    
+    Temporal (news) queries go stale quickly; explanation-style queries
+    about established concepts are evergreen.
+    """
+    if not classification:
+        return DEFAULT_TTL_HOURS
+    if classification.get("has_temporal"):
+        return TEMPORAL_TTL_HOURS
+    if classification.get("type") == "explanation" or classification.get("search_strategy") == "kb_only":
+        return EVERGREEN_TTL_HOURS
+    return DEFAULT_TTL_HOURS
+
+def get_cached_entry(query: str, max_results: int = None, max_stale_hours: float = None,
+                     search_depth: str = "basic", provider: str = "tavily", touch: bool = True):
+    """
+    Retrieves a cached entry, including one that expired recently.
+    
+    An entry serves a request for `max_results` if it was fetched with at
+    least that many results (or the provider returned fewer than it was
+    asked for, i.e. the result set is complete); it is truncated to fit.
+    
+    An expired entry is still returned (flagged stale) until it is past its
+    expiry by the staleness bound: `max_stale_hours` (default
+    NEXUS_CACHE_MAX_STALE_HOURS), capped at the entry's own TTL so that
+    short-lived news results are not served for long after expiry.
+    
+    `touch=False` reads without counting a hit (used by the cache warmer so
+    it does not distort LRU/LFU eviction).
+    
+    Returns:
+        dict | None: {"results": list, "stale": bool, "max_results": int,
+            "expires_at": datetime}, or None on a miss.
     """
-    query_hash = get_query_hash(query)
+    if max_stale_hours is None:
+        max_stale_hours = MAX_STALE_HOURS
+    query_hash = make_cache_key(query, search_depth=search_depth, provider=provider)
     
-    conn = sqlite3.connect(CACHE_DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     
     cursor.execute(
-        "SELECT results, expires_at FROM search_cache WHERE query_hash = ?", 
+        "SELECT payload, timestamp, expires_at, max_results FROM search_cache WHERE query_hash = ?", 
         (query_hash,)
     )
     row = cursor.fetchone()
-    conn.close()
     
+    entry = None
     if row:
-        results_json, expires_at_str = row
+        payload, timestamp_str, expires_at_str, cached_max = row
         expires_at = datetime.fromisoformat(expires_at_str)
+        now = datetime.now()
         
-        if datetime.now() < expires_at:
-            # Cache hit
-            return json.loads(results_json)
-        else:
-            # Cache expired
-            return None
-            
-    return None
+        ttl = expires_at - datetime.fromisoformat(timestamp_str)
+        stale_bound = min(timedelta(hours=max_stale_hours), ttl)
+        results = _decode(payload) if now < expires_at + stale_bound else None
+        covers = results is not None and (
+            max_results is None or cached_max >= max_results or len(results) < cached_max
+        )
+        if covers:
+            if max_results is not None:
+                results = results[:max_results]
+            entry = {
+                "results": results,
+                "stale": now >= expires_at,
+                "max_results": cached_max,
+                "expires_at": expires_at
+            }
+            if touch:
+                # Recency/frequency for LRU/LFU eviction
+                cursor.execute(
+                    "UPDATE search_cache SET last_access = ?, hit_count = hit_count + 1 WHERE query_hash = ?",
+                    (now.isoformat(), query_hash)
+                )
+                _bump_stats(cursor, hits=1)
+                conn.commit()
+    
+    conn.close()
+    return entry
+
+def get_cached_results(query: str, max_results: int = None):
+    """
+    Retrieves cached results for a query if they exist and haven't expired.
+    """
+    entry = get_cached_entry(query, max_results=max_results, max_stale_hours=0)
+    return entry["results"] if entry else None
 
-def save_to_cache(query: str, results: list, ttl_hours: int = 24):
+def save_to_cache(query: str, results: list, ttl_hours: float = DEFAULT_TTL_HOURS,
+                  max_results: int = None, search_depth: str = "basic", provider: str = "tavily"):
     """
     Saves search results to the cache.
+    
+    `max_results` is the number of results that were requested (defaults
+    to the number returned). A smaller result set never replaces a larger
+    entry that is still fresh.
     """
     if not results:
         return
+    if max_results is None:
+        max_results = len(results)
 
-    query_hash = get_query_hash(query)
+    query_hash = make_cache_key(query, search_depth=search_depth, provider=provider)
     expires_at = datetime.now() + timedelta(hours=ttl_hours)
     
-    conn = sqlite3.connect(CACHE_DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     
+    payload = _encode(results)
+    now = datetime.now().isoformat()
+    
+    # Upsert so a refresh keeps the entry's hit count (LFU)
     cursor.execute("""
-        INSERT OR REPLACE INTO search_cache (query_hash, query_text, results, timestamp, expires_at)
-        VALUES (?, ?, ?, ?, ?)
+        INSERT INTO search_cache
+            (query_hash, query_text, payload, size_bytes, timestamp, expires_at, last_access, hit_count, max_results)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?)
+        ON CONFLICT(query_hash) DO UPDATE SET
+            query_text = excluded.query_text,
+            payload = excluded.payload,
+            size_bytes = excluded.size_bytes,
+            timestamp = excluded.timestamp,
+            expires_at = excluded.expires_at,
+            last_access = excluded.last_access,
+            max_results = excluded.max_results
+        WHERE excluded.max_results >= search_cache.max_results
+           OR search_cache.expires_at <= excluded.timestamp
     """, (
         query_hash, 
         query, 
-        json.dumps(results), 
-        datetime.now().isoformat(), 
-        expires_at.isoformat()
+        payload, 
+        len(payload), 
+        now, 
+        expires_at.isoformat(),
+        now,
+        max_results
     ))
+    _bump_stats(cursor, writes=1)
+    _enforce_size_limit(cursor)
+    
+    conn.commit()
+    conn.close()
+
+def get_kv(namespace: str, key: str, touch: bool = True):
+    """
+    Reads an unexpired entry from the key/value cache.
+    
+    Used for small derived artifacts (query classifications, query
+    embeddings) that share the web cache's size bound and reaping.
+    
+    Returns:
+        dict | None: {"payload": bytes, "expires_at": datetime}, or None on a miss.
+    """
+    conn = _connect()
+    cursor = conn.cursor()
+    row = cursor.execute(
+        "SELECT payload, expires_at FROM kv_cache WHERE namespace = ? AND key = ?",
+        (namespace, key)
+    ).fetchone()
     
+    entry = None
+    now = datetime.now()
+    if row and now < datetime.fromisoformat(row[1]):
+        entry = {"payload": zlib.decompress(row[0]), "expires_at": datetime.fromisoformat(row[1])}
+        if touch:
+            cursor.execute(
+                "UPDATE kv_cache SET last_access = ?, hit_count = hit_count + 1 WHERE namespace = ? AND key = ?",
+                (now.isoformat(), namespace, key)
+            )
+            conn.commit()
+    conn.close()
+    return entry
+
+def set_kv(namespace: str, key: str, payload: bytes, ttl_hours: float = DEFAULT_TTL_HOURS):
+    """Writes (compressed) bytes to the key/value cache."""
+    stored = zlib.compress(payload, 6)
+    now = datetime.now()
+    
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO kv_cache (namespace, key, payload, size_bytes, timestamp, expires_at, last_access, hit_count)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+        ON CONFLICT(namespace, key) DO UPDATE SET
+            payload = excluded.payload,
+            size_bytes = excluded.size_bytes,
+            timestamp = excluded.timestamp,
+            expires_at = excluded.expires_at,
+            last_access = excluded.last_access
+    """, (
+        namespace,
+        key,
+        stored,
+        len(stored),
+        now.isoformat(),
+        (now + timedelta(hours=ttl_hours)).isoformat(),
+        now.isoformat()
+    ))
+    _bump_stats(cursor, writes=1)
+    _enforce_size_limit(cursor)
     conn.commit()
     conn.close()
@@ -0,0 +1,13 @@
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def load_env():
+    """
+    Loads variables from `.env` into the process environment, once.
+
+    Modules call this instead of `load_dotenv()` so that Streamlit reruns and
+    repeated imports do not re-read and re-parse the file.
+    """
+    from dotenv import load_dotenv
+    load_dotenv()
@@ -0,0 +1,222 @@
+import os
+import re
+import threading
+from collections import deque
+
+from utils.text import keywords
+
+# Turns kept per session, and the coverage rule deciding whether earlier
+# context already answers a (sub-)query: at least FOLLOW_UP_MIN_RESULTS
+# stored results containing FOLLOW_UP_MIN_OVERLAP of its keywords
+SESSION_MAX_TURNS = int(os.getenv("NEXUS_SESSION_MAX_TURNS", "5"))
+FOLLOW_UP_MIN_RESULTS = int(os.getenv("NEXUS_FOLLOW_UP_MIN_RESULTS", "2"))
+FOLLOW_UP_MIN_OVERLAP = float(os.getenv("NEXUS_FOLLOW_UP_MIN_OVERLAP", "0.6"))
+FOLLOW_UP_MAX_KB = 4
+FOLLOW_UP_MAX_WEB = 3
+FOLLOW_UP_MAX_WORDS = 12
+
+# Openings that only make sense as a continuation; "what/how about X" is
+# elliptical and gets the previous topic appended when resolved
+_FOLLOW_UP_START_RE = re.compile(r"^(?:what about|how about|what if|why is that|how come)\b", re.I)
+_ELLIPTICAL_RE = re.compile(r"^(?:what|how) about\b", re.I)
+# A leading conjunction alone ("So what is BERT?") does not make a follow-up
+_LEADING_CONJUNCTION_RE = re.compile(r"^(?:and|but|also|so|then)\b[\s,;:.\-]*", re.I)
+_PRONOUN_RE = re.compile(r"\b(?:it|its|that|this|they|them|their)\b", re.I)
+# Dummy "it" opening a clause: "is it true that ...", "it is possible to ..."
+_DUMMY_IT_RE = re.compile(
+    r"\b(?:(?:is|was|isn't|wasn't)\s+it|it(?:'s|\s+(?:is|was|seems|appears)))\s+\w+\s+(?:that|to|whether|if)\b",
+    re.I
+)
+# "that"/"this" only stand for the previous topic as a bare pronoun: after a
+# verb or preposition and before a verb or the end ("how does that compare",
+# "what about this?"), not as a relative ("the mechanism that transformers
+# use") or a determiner ("that model")
+_DEMONSTRATIVE_BEFORE_RE = re.compile(
+    r"(?:^|\b(?:is|was|are|does|do|did|about|of|with|to|for|on|than|explain|describe|use|using|mean|means))\s*$",
+    re.I
+)
+_DEMONSTRATIVE_AFTER_RE = re.compile(
+    r"^\s*(?:[?.!]|$|(?:is|was|does|do|did|compare|compares|work|works|differ|differs|mean|means|"
+    r"scale|scales|perform|performs|relate|relates|handle|handles|apply|applies)\b)",
+    re.I
+)
+_TOPIC_LEAD_RE = re.compile(
+    r"^(?:(?:what|who) (?:is|are|was|were)|explain|describe|define|tell me about|how does|how do)\s+"
+    r"(?:the |a |an )?", re.I
+)
+
+
+def _topic(query: str) -> str:
+    """The subject of a query, e.g. "RAG" for "What is RAG?"."""
+    return _TOPIC_LEAD_RE.sub("", query.strip().rstrip("?.! ")).strip()
+
+
+def _strip_conjunction(query: str):
+    """Drops a leading "and"/"also"/"so"/... (and punctuation after it); returns (text, stripped)."""
+    text = query.strip()
+    match = _LEADING_CONJUNCTION_RE.match(text)
+    if match and match.end() < len(text):
+        return text[match.end():], True
+    return text, False
+
+
+def _referring_pronoun(text: str):
+    """
+    The first pronoun in `text` that refers back to an earlier topic, or None.
+    
+    Skips dummy "it" ("is it true that ...") and "that"/"this" used as a
+    relative pronoun or determiner.
+    """
+    dummy = [m.span() for m in _DUMMY_IT_RE.finditer(text)]
+    for match in _PRONOUN_RE.finditer(text):
+        word = match.group(0).lower()
+        if word == "it" and any(start <= match.start() < end for start, end in dummy):
+            continue
+        if word in ("that", "this") and not (
+            _DEMONSTRATIVE_BEFORE_RE.search(text[:match.start()])
+            and _DEMONSTRATIVE_AFTER_RE.match(text[match.end():])
+        ):
+            continue
+        return match
+    return None
+
+
+def covering_results(query: str, context: dict, min_results: int = None, min_overlap: float = None):
+    """
+    Cheap sufficiency check: finds stored results that already cover a query.
+
+    A result covers the query if it contains at least `min_overlap` of the
+    query's keywords. No embedding or model call is made.
+
+    Args:
+        query (str): The (sub-)query to answer.
+        context (dict): Earlier "kb_results" and "web_results".
+        min_results (int): Covering results required (default NEXUS_FOLLOW_UP_MIN_RESULTS).
+        min_overlap (float): Keyword fraction required (default NEXUS_FOLLOW_UP_MIN_OVERLAP).
+
+    Returns:
+        dict | None: Covering "kb_results" and "web_results", or None if the
+            context is not enough and the query needs fresh retrieval.
+    """
+    min_results = min_results or FOLLOW_UP_MIN_RESULTS
+    min_overlap = min_overlap if min_overlap is not None else FOLLOW_UP_MIN_OVERLAP
+    terms = keywords(query)
+    if not terms or not context:
+        return None
+
+    def covers(res):
+        text = f"{res.get('title', '')} {res.get('content', '')}"
+        return len(terms & keywords(text)) / len(terms) >= min_overlap
+
+    kb_results = [res for res in context.get("kb_results", []) if covers(res)][:FOLLOW_UP_MAX_KB]
+    web_results = [res for res in context.get("web_results", []) if covers(res)][:FOLLOW_UP_MAX_WEB]
+    if len(kb_results) + len(web_results) < min_results:
+        return None
+    return {"kb_results": kb_results, "web_results": web_results}
+
+
+class ConversationSession:
+    """
+    Recent turns of one user session (queries, classification, retrieved
+    chunks, web results and answers), used to answer follow-up questions
+    from context that was fetched a moment earlier.
+
+    Args:
+        max_turns (int): Turns kept (default NEXUS_SESSION_MAX_TURNS).
+    """
+
+    def __init__(self, max_turns: int = None):
+        self.turns = deque(maxlen=max_turns or SESSION_MAX_TURNS)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+    @property
+    def last_turn(self):
+        with self._lock:
+            return self.turns[-1] if self.turns else None
+
+    def add_turn(self, query: str, resolved_query: str, classification: dict, strategy: str,
+                 kb_results: list, web_results: list, answer: str,
+                 where: dict = None, where_document: dict = None):
+        """Records a completed turn (the oldest is dropped past max_turns)."""
+        with self._lock:
+            self.turns.append({
+                "query": query,
+                "resolved_query": resolved_query,
+                "classification": classification,
+                "strategy": strategy,
+                "kb_results": kb_results,
+                "web_results": web_results,
+                "answer": answer,
+                "where": where or None,
+                "where_document": where_document or None,
+                # Subject of the conversation: a follow-up keeps the one it was
+                # resolved against, so chained follow-ups do not stack it
+                "topic": self.turns[-1]["topic"] if self.turns and self._refers_back(query)
+                         else _topic(resolved_query),
+            })
+
+    def clear(self):
+        with self._lock:
+            self.turns.clear()
+
+    @staticmethod
+    def _refers_back(query: str) -> bool:
+        """True if the query needs the previous topic to stand alone."""
+        text, continued = _strip_conjunction(query)
+        if _FOLLOW_UP_START_RE.match(text):
+            return True
+        if _referring_pronoun(text) is None:
+            return False
+        return continued or len(text.split()) <= FOLLOW_UP_MAX_WORDS
+
+    def is_follow_up(self, query: str) -> bool:
+        """
+        True if the query continues the previous turn: it opens with a
+        continuation ("what about", "how come", ...) or has a pronoun ("it",
+        "its", "that", ...) that can only refer back to it, in a short
+        question or after a leading "and"/"so"/... .
+        """
+        return bool(self.turns) and self._refers_back(query)
+
+    def resolve(self, query: str) -> str:
+        """
+        Rewrites a follow-up as a standalone query using the conversation's
+        topic, e.g. "and how does that compare to fine-tuning?" after "What
+        is RAG?" becomes "how does RAG compare to fine-tuning?". Only an
+        elliptical "what about X?" gets the topic appended; anything else
+        without a referring pronoun is returned without its leading
+        conjunction.
+        """
+        last = self.last_turn
+        text, _ = _strip_conjunction(query)
+        if last is None:
+            return text
+        topic = last.get("topic") or _topic(last["resolved_query"])
+        pronoun = _referring_pronoun(text)
+        if pronoun is not None:
+            word = pronoun.group(0).lower()
+            replacement = f"{topic}'s" if word in ("its", "their") else topic
+            return text[:pronoun.start()] + replacement + text[pronoun.end():]
+        if _ELLIPTICAL_RE.match(text):
+            return f"{text.rstrip('?')} ({topic})"
+        return text
+
+    def context(self, where: dict = None, where_document: dict = None) -> dict:
+        """
+        Results of the recent turns, most recent first.
+        
+        Only turns retrieved with the same KB filters are included, so a
+        filtered follow-up never reuses chunks its filters would exclude.
+        """
+        with self._lock:
+            turns = [
+                turn for turn in list(self.turns)[::-1]
+                if turn.get("where") == (where or None) and turn.get("where_document") == (where_document or None)
+            ]
+        return {
+            "kb_results": [res for turn in turns for res in turn["kb_results"]],
+            "web_results": [res for turn in turns for res in turn["web_results"]],
+        }
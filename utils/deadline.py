@@ -0,0 +1,87 @@
+import os
+import time
+import threading
+
+from utils.profiling import bind_to_request
+
+# End-to-end budget for one query, and the degradation thresholds (seconds)
+DEFAULT_DEADLINE_MS = int(os.getenv("NEXUS_DEADLINE_MS", "20000"))
+CLASSIFY_TIMEOUT_S = float(os.getenv("NEXUS_CLASSIFY_TIMEOUT_S", "3"))
+MIN_CLASSIFY_S = float(os.getenv("NEXUS_MIN_CLASSIFY_S", "0.75"))
+SYNTH_RESERVE_S = float(os.getenv("NEXUS_SYNTH_RESERVE_S", "5"))
+MIN_WEB_S = float(os.getenv("NEXUS_MIN_WEB_S", "0.5"))
+MIN_KB_S = float(os.getenv("NEXUS_MIN_KB_S", "0.5"))
+MIN_SYNTH_S = float(os.getenv("NEXUS_MIN_SYNTH_S", "2"))
+FULL_CONTEXT_S = float(os.getenv("NEXUS_FULL_CONTEXT_S", "8"))
+
+# Hard cap per LLM HTTP request, so a call abandoned on timeout still ends
+LLM_REQUEST_TIMEOUT_S = float(os.getenv("NEXUS_LLM_REQUEST_TIMEOUT_S", "30"))
+LLM_MAX_RETRIES = int(os.getenv("NEXUS_LLM_MAX_RETRIES", "1"))
+
+
+class Deadline:
+    """
+    Time budget for a single request, passed down through the agents.
+
+    Agents consult `remaining()` to size their own timeouts and call
+    `degrade()` to record any shortcut they took because time ran short;
+    the orchestrator reports those in the response metadata.
+
+    Args:
+        budget_ms (int): Total budget in milliseconds (default NEXUS_DEADLINE_MS).
+    """
+
+    def __init__(self, budget_ms: int = None):
+        self.budget_ms = budget_ms if budget_ms is not None else DEFAULT_DEADLINE_MS
+        self.expires_at = time.monotonic() + self.budget_ms / 1000.0
+        self.degradations = []
+
+    def remaining(self) -> float:
+        """Seconds left before the deadline (never negative)."""
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def has(self, seconds: float) -> bool:
+        """True if at least `seconds` of budget are left."""
+        return self.remaining() >= seconds
+
+    def degrade(self, name: str):
+        """Records a degradation rule that was applied (once per name)."""
+        if name not in self.degradations:
+            print(f"  [Deadline] {name} ({self.remaining():.2f}s left)")
+            self.degradations.append(name)
+
+
+def run_with_timeout(fn, timeout_s: float, *args, **kwargs):
+    """
+    Runs `fn(*args, **kwargs)` on its own worker thread and waits at most `timeout_s`.
+
+    The worker is not interrupted on timeout; its late result is discarded.
+    Each call gets a fresh daemon thread rather than a pooled worker, so an
+    abandoned call (bounded by NEXUS_LLM_REQUEST_TIMEOUT_S at the client)
+    never delays later requests. It runs in a copy of the caller's context
+    (e.g. its rate-limit priority and profiler, see bind_to_request).
+
+    Raises:
+        TimeoutError: If `fn` did not finish in time.
+    """
+    call = bind_to_request(fn)
+    outcome = {}
+    done = threading.Event()
+
+    def target():
+        try:
+            outcome["result"] = call(*args, **kwargs)
+        except BaseException as e:
+            outcome["error"] = e
+        finally:
+            done.set()
+
+    threading.Thread(target=target, name="nexus-deadline", daemon=True).start()
+    if not done.wait(max(timeout_s, 0.0)):
+        raise TimeoutError(f"{getattr(fn, '__name__', 'call')} exceeded {timeout_s:.2f}s")
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
@@ -1,4 +1,5 @@
 import os
+from bisect import bisect_right
 from pypdf import PdfReader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
@@ -27,6 +28,26 @@ def load_pdf(file_path):
         print(f"Error reading PDF {file_path}: {e}")
         return ""
 
+def load_pdf_pages(file_path):
+    """
+    Extracts the text of each page of a PDF file.
+    
+    Args:
+        file_path (str): Path to the PDF file.
+        
+    Returns:
+        list: Text of each page (empty string for pages without text).
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"File not found: {file_path}")
+        
+    try:
+        reader = PdfReader(file_path)
+        return [page.extract_text() or "" for page in reader.pages]
+    except Exception as e:
+        print(f"Error reading PDF {file_path}: {e}")
+        return []
+
 def chunk_text(text, chunk_size=1000, chunk_overlap=200):
     """
     Splits text into chunks using RecursiveCharacterTextSplitter.
@@ -64,3 +85,38 @@ def process_document(file_path, chunk_size=1000, chunk_overlap=200):
         
     chunks = chunk_text(text, chunk_size, chunk_overlap)
     return chunks
+
+def process_document_with_pages(file_path, chunk_size=1000, chunk_overlap=200):
+    """
+    Loads and chunks a document, recording the page each chunk starts on.
+    
+    Pages are joined as in load_pdf, so chunks match process_document and
+    may still span a page break.
+    
+    Args:
+        file_path (str): Path to the PDF file.
+        chunk_size (int): Chunk size.
+        chunk_overlap (int): Chunk overlap.
+        
+    Returns:
+        list: Dicts with the chunk "text" and its 1-based start "page".
+    """
+    text = ""
+    page_starts = []
+    for content in load_pdf_pages(file_path):
+        page_starts.append(len(text))
+        if content:
+            text += content + "\n"
+    if not text:
+        return []
+    
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separators=["\n\n", "\n", " ", ""],
+        add_start_index=True
+    )
+    return [
+        {"text": doc.page_content, "page": max(bisect_right(page_starts, doc.metadata["start_index"]), 1)}
+        for doc in splitter.create_documents([text])
+    ]
@@ -0,0 +1,308 @@
+import os
+import sys
+import json
+import time
+import random
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import Counter
+from datetime import datetime
+
+PROFILE_DIR = os.getenv("NEXUS_PROFILE_DIR", os.path.join(os.getcwd(), "data", "profiles"))
+PROFILE_SAMPLE_RATE = float(os.getenv("NEXUS_PROFILE_SAMPLE_RATE", "0") or 0)
+PROFILE_INTERVAL_MS = float(os.getenv("NEXUS_PROFILE_INTERVAL_MS", "5") or 5)
+
+# The profiler of the request running in this context; worker threads see it
+# through the copied context their calls run in (see bind_to_request)
+_active_profiler = contextvars.ContextVar("nexus_profiler", default=None)
+
+
+def should_profile(requested=None) -> bool:
+    """
+    Decides whether a request should be profiled.
+
+    Args:
+        requested (bool | None): Explicit per-request flag. None defers to
+            the NEXUS_PROFILE_SAMPLE_RATE sampling rate.
+
+    Returns:
+        bool: True if the request should run under the profiler.
+    """
+    if requested is not None:
+        return bool(requested)
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def _frame_label(code) -> str:
+    """Builds a readable frame name, trimming site-packages prefixes."""
+    filename = code.co_filename
+    marker = "site-packages" + os.sep
+    if marker in filename:
+        filename = filename.split(marker, 1)[1]
+    else:
+        filename = os.path.relpath(filename) if os.path.isabs(filename) else filename
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def _frame_package(label: str) -> str:
+    """Returns the top-level package of a frame label (e.g. 'langchain_core')."""
+    path = label.rsplit("(", 1)[-1].split(":", 1)[0]
+    head = path.replace("\\", "/").split("/", 1)[0]
+    return head[:-3] if head.endswith(".py") else head
+
+
+class _NullProfiler:
+    """Stand-in used when profiling is off; every hook is a no-op."""
+
+    enabled = False
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def finish(self):
+        return None
+
+
+NULL_PROFILER = _NullProfiler()
+
+
+class QueryProfiler:
+    """
+    Samples the stacks of the calling thread, and of the worker threads
+    running this request's calls, while a single query runs and records
+    wall time versus CPU time for each pipeline stage.
+
+    Stage CPU time is the `time.thread_time` of the request thread plus that
+    of the workers (see bind_to_request) finished during the stage, so the
+    gap between wall and CPU time is time the request spent blocked
+    (network, locks, sleeping) rather than executing Python code.
+    """
+
+    enabled = True
+
+    def __init__(self, query: str, output_dir: str = None, interval_ms: float = None):
+        self.query = query
+        self.output_dir = output_dir or PROFILE_DIR
+        self.interval = (interval_ms or PROFILE_INTERVAL_MS) / 1000.0
+        self.stages = []
+        self.samples = Counter()
+        self._thread_id = threading.get_ident()
+        self._workers = Counter()
+        self._worker_cpu_s = 0.0
+        self._lock = threading.Lock()
+        self._context_token = None
+        self._stop_event = threading.Event()
+        self._sampler = None
+        self._wall_start = None
+        self._cpu_start = None
+
+    def start(self):
+        """Starts the background sampler and makes this the context's active profiler."""
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.thread_time()
+        self._context_token = _active_profiler.set(self)
+        self._sampler = threading.Thread(target=self._sample_loop, name="nexus-profiler", daemon=True)
+        self._sampler.start()
+        return self
+
+    def _sample_loop(self):
+        while not self._stop_event.wait(self.interval):
+            with self._lock:
+                thread_ids = [self._thread_id] + list(self._workers)
+            frames = sys._current_frames()
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                if stack:
+                    self.samples[tuple(reversed(stack))] += 1
+
+    @contextmanager
+    def track_thread(self):
+        """Samples the current (worker) thread and counts its CPU time for this request."""
+        thread_id = threading.get_ident()
+        with self._lock:
+            self._workers[thread_id] += 1
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            cpu_s = time.thread_time() - cpu_start
+            with self._lock:
+                self._worker_cpu_s += cpu_s
+                self._workers[thread_id] -= 1
+                if self._workers[thread_id] <= 0:
+                    del self._workers[thread_id]
+
+    def _worker_cpu(self) -> float:
+        with self._lock:
+            return self._worker_cpu_s
+
+    @contextmanager
+    def stage(self, name: str):
+        """Times a pipeline stage (wall and CPU, including its workers) while it executes."""
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        worker_cpu_start = self._worker_cpu()
+        try:
+            yield
+        finally:
+            wall_ms = (time.perf_counter() - wall_start) * 1000
+            cpu_ms = (time.thread_time() - cpu_start + self._worker_cpu() - worker_cpu_start) * 1000
+            self.stages.append({
+                "name": name,
+                "wall_ms": round(wall_ms, 2),
+                "cpu_ms": round(cpu_ms, 2),
+                "wait_ms": round(max(wall_ms - cpu_ms, 0.0), 2),
+            })
+
+    def finish(self) -> dict:
+        """
+        Stops sampling and writes the profile artifacts.
+
+        Returns:
+            dict: Paths of the speedscope and summary files, plus stage timings.
+        """
+        self._stop_event.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        if self._context_token is not None:
+            try:
+                _active_profiler.reset(self._context_token)
+            except ValueError:
+                # Finished from another context; the request's context ends with it
+                pass
+            self._context_token = None
+
+        total_wall_ms = (time.perf_counter() - self._wall_start) * 1000
+        total_cpu_ms = (time.thread_time() - self._cpu_start + self._worker_cpu()) * 1000
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        base = os.path.join(self.output_dir, f"query-{stamp}")
+        speedscope_path = f"{base}.speedscope.json"
+        summary_path = f"{base}.summary.json"
+
+        with open(speedscope_path, "w") as f:
+            json.dump(self._speedscope_profile(), f)
+
+        summary = {
+            "query": self.query,
+            "created_at": datetime.now().isoformat(),
+            "interval_ms": self.interval * 1000,
+            "sample_count": sum(self.samples.values()),
+            "total_wall_ms": round(total_wall_ms, 2),
+            "total_cpu_ms": round(total_cpu_ms, 2),
+            "stages": self.stages,
+            "top_self": self._top_frames(inclusive=False),
+            "top_inclusive": self._top_frames(inclusive=True),
+            "self_by_package": self._self_by_package(),
+            "flamegraph_path": speedscope_path,
+        }
+        with open(summary_path, "w") as f:
+            json.dump(summary, f, indent=2)
+
+        return {
+            "summary_path": summary_path,
+            "flamegraph_path": speedscope_path,
+            "stages": self.stages,
+            "total_wall_ms": summary["total_wall_ms"],
+            "total_cpu_ms": summary["total_cpu_ms"],
+        }
+
+    def _top_frames(self, inclusive: bool, limit: int = 15) -> list:
+        counts = Counter()
+        for stack, n in self.samples.items():
+            if inclusive:
+                for label in set(stack):
+                    counts[label] += n
+            else:
+                counts[stack[-1]] += n
+        return [{"frame": label, "samples": n} for label, n in counts.most_common(limit)]
+
+    def _self_by_package(self) -> dict:
+        counts = Counter()
+        for stack, n in self.samples.items():
+            counts[_frame_package(stack[-1])] += n
+        return dict(counts.most_common())
+
+    def _speedscope_profile(self) -> dict:
+        """Converts the collected stacks into speedscope's 'sampled' format."""
+        frame_index = {}
+        frames = []
+        samples = []
+        weights = []
+        for stack, n in self.samples.items():
+            indices = []
+            for label in stack:
+                if label not in frame_index:
+                    frame_index[label] = len(frames)
+                    frames.append({"name": label})
+                indices.append(frame_index[label])
+            samples.append(indices)
+            weights.append(n * self.interval * 1000)
+
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": self.query[:80],
+                "unit": "milliseconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+            "name": f"Nexus query: {self.query[:80]}",
+            "exporter": "nexus-research-assistant",
+        }
+
+
+def _run_tracked(fn, *args, **kwargs):
+    profiler = _active_profiler.get()
+    if profiler is None:
+        return fn(*args, **kwargs)
+    with profiler.track_thread():
+        return fn(*args, **kwargs)
+
+
+def bind_to_request(fn):
+    """
+    Wraps `fn` to run in a copy of the caller's context (e.g. its rate-limit
+    priority) on whichever worker thread calls it.
+
+    If the request is being profiled, that worker's stack is sampled and its
+    CPU time counted for the request while the call runs. Bind once per
+    submitted call: a copied context cannot be entered by two threads at once.
+
+    Args:
+        fn: The call to run on a worker thread.
+
+    Returns:
+        Callable taking the same arguments as `fn`.
+    """
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.run(_run_tracked, fn, *args, **kwargs)
+    return run
+
+
+def get_profiler(query: str, enabled=None, output_dir: str = None):
+    """
+    Returns a started QueryProfiler if this request should be profiled,
+    otherwise the no-op NULL_PROFILER.
+
+    Args:
+        query (str): The query being processed (recorded in the artifacts).
+        enabled (bool | None): Per-request opt-in; None uses the sampling rate.
+        output_dir (str): Overrides NEXUS_PROFILE_DIR.
+    """
+    if not should_profile(enabled):
+        return NULL_PROFILER
+    return QueryProfiler(query, output_dir=output_dir).start()
@@ -0,0 +1,59 @@
+import os
+import json
+import threading
+from datetime import datetime
+
+from utils.cache import normalize_query
+
+QUERY_LOG_PATH = os.getenv("NEXUS_QUERY_LOG_PATH", os.path.join(os.getcwd(), "data", "query_log.jsonl"))
+QUERY_LOG_ENABLED = os.getenv("NEXUS_QUERY_LOG", "1") not in ("0", "false", "False", "")
+
+_log_lock = threading.Lock()
+
+def log_query(query: str, strategy: str, latency_ms: int):
+    """
+    Appends one processed query to the append-only JSONL query log.
+    
+    Args:
+        query (str): The raw user query (stored normalized).
+        strategy (str): The search strategy that was used.
+        latency_ms (int): End-to-end latency of the request.
+    """
+    if not QUERY_LOG_ENABLED:
+        return
+    
+    record = {
+        "ts": datetime.now().isoformat(),
+        "query": normalize_query(query),
+        "strategy": strategy,
+        "latency_ms": latency_ms
+    }
+    line = json.dumps(record, separators=(",", ":")) + "\n"
+    
+    try:
+        os.makedirs(os.path.dirname(QUERY_LOG_PATH), exist_ok=True)
+        with _log_lock:
+            with open(QUERY_LOG_PATH, "a", encoding="utf-8") as f:
+                f.write(line)
+    except OSError as e:
+        print(f"Error writing query log: {e}")
+
+def read_query_log(path: str = None, since: datetime = None):
+    """
+    Yields query log records, optionally only those at or after `since`.
+    
+    Malformed lines (e.g. a partially written last line) are skipped.
+    """
+    path = path or QUERY_LOG_PATH
+    if not os.path.exists(path):
+        return
+    
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                record["ts"] = datetime.fromisoformat(record["ts"])
+            except (ValueError, KeyError):
+                continue
+            if since is None or record["ts"] >= since:
+                yield record
@@ -0,0 +1,282 @@
+import os
+import time
+import heapq
+import random
+import itertools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+
+# Priority classes: lower is served first. Interactive queries always go
+# ahead of batch jobs (ingestion) and the cache warmer / background refreshes.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITY_WARMER = 2
+
+# Per-provider quotas (requests/min, tokens/min; 0 = not limited). Defaults
+# match the OpenAI tier-1 limits for gpt-4o-mini / text-embedding-3-small
+# and the Tavily development plan.
+PROVIDER_LIMITS = {
+    "openai_chat": (
+        int(os.getenv("NEXUS_OPENAI_CHAT_RPM", "500")),
+        int(os.getenv("NEXUS_OPENAI_CHAT_TPM", "200000")),
+    ),
+    "openai_embeddings": (
+        int(os.getenv("NEXUS_OPENAI_EMBED_RPM", "3000")),
+        int(os.getenv("NEXUS_OPENAI_EMBED_TPM", "1000000")),
+    ),
+    "tavily": (int(os.getenv("NEXUS_TAVILY_RPM", "100")), 0),
+}
+
+# Longest a call queues for its turn before giving up, and the share of each
+# bucket that batch / warmer calls leave untouched for interactive bursts
+RATE_LIMIT_MAX_WAIT_S = float(os.getenv("NEXUS_RATE_LIMIT_MAX_WAIT_S", "30"))
+RATE_LIMIT_RESERVE = float(os.getenv("NEXUS_RATE_LIMIT_RESERVE", "0.2"))
+# Retries after a provider throttling (429) response, and their base backoff
+RATE_LIMIT_RETRIES = int(os.getenv("NEXUS_RATE_LIMIT_RETRIES", "3"))
+RATE_LIMIT_BACKOFF_S = float(os.getenv("NEXUS_RATE_LIMIT_BACKOFF_S", "1"))
+
+_priority = ContextVar("nexus_priority", default=PRIORITY_INTERACTIVE)
+
+
+class RateLimitError(Exception):
+    """Raised when a call could not get a rate-limit slot within its wait budget."""
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+@contextmanager
+def priority(level: int):
+    """
+    Runs the enclosed calls (in this thread or context) at the given priority.
+
+    Worker pools that should inherit it submit through
+    utils.profiling.bind_to_request (as utils.deadline.run_with_timeout does).
+    """
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def estimate_tokens(*texts) -> int:
+    """Rough token count (about 4 characters per token) of the given texts."""
+    return sum(len(text or "") for text in texts) // 4 + 1
+
+
+class TokenBucket:
+    """
+    Refills continuously at `per_minute / 60` units per second, up to
+    `per_minute` units. Not thread-safe; ProviderLimiter holds the lock.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, amount: float, reserve: float = 0.0) -> float:
+        """Seconds until `amount` can be taken while leaving `reserve` in the bucket."""
+        missing = min(amount + reserve, self.capacity) - self.level
+        return max(missing, 0.0) / self.rate
+
+
+class ProviderLimiter:
+    """
+    Requests/min and tokens/min token buckets for one provider, with a
+    priority queue in front of them.
+
+    Callers block in `acquire()` until the buckets allow their call and no
+    higher-priority (or earlier, same-priority) caller is waiting, so load
+    beyond the quota queues up instead of reaching the provider as 429s.
+
+    Args:
+        name (str): Provider name (for logs and stats).
+        rpm (int): Requests per minute (0 = not limited).
+        tpm (int): Tokens per minute (0 = not limited).
+        reserve (float): Share of each bucket only interactive calls may use.
+    """
+
+    def __init__(self, name: str, rpm: int, tpm: int = 0, reserve: float = RATE_LIMIT_RESERVE):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.reserve = reserve
+        self.paused_until = 0.0
+        self.stats = {"acquired": 0, "queued": 0, "waited_s": 0.0, "timeouts": 0, "throttled": 0}
+        self._waiters = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _time_until_ready(self, tokens: int, level: int, now: float) -> float:
+        wait_s = max(self.paused_until - now, 0.0)
+        for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+            if bucket is None:
+                continue
+            bucket.refill(now)
+            reserve = bucket.capacity * self.reserve if level > PRIORITY_INTERACTIVE else 0.0
+            wait_s = max(wait_s, bucket.time_until(amount, reserve))
+        return wait_s
+
+    def _take(self, tokens: int):
+        if self.requests is not None:
+            self.requests.level -= 1
+        if self.tokens is not None:
+            # Calls larger than the whole bucket still go through, as a debt
+            self.tokens.level -= tokens
+
+    def acquire(self, tokens: int = 0, level: int = None, timeout: float = None) -> float:
+        """
+        Waits for a slot for one call of about `tokens` tokens.
+
+        Args:
+            tokens (int): Estimated tokens (prompt plus expected completion).
+            level (int): Priority class (default: the current context's).
+            timeout (float): Longest wait in seconds (default NEXUS_RATE_LIMIT_MAX_WAIT_S).
+
+        Returns:
+            float: Seconds spent queuing.
+
+        Raises:
+            RateLimitError: If no slot was granted within `timeout`.
+        """
+        level = current_priority() if level is None else level
+        timeout = RATE_LIMIT_MAX_WAIT_S if timeout is None else timeout
+        start = time.monotonic()
+        entry = (level, next(self._seq))
+
+        with self._cond:
+            heapq.heappush(self._waiters, entry)
+            granted = False
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait_s = None
+                    if self._waiters[0] == entry:
+                        wait_s = self._time_until_ready(tokens, level, now)
+                        if wait_s <= 0:
+                            heapq.heappop(self._waiters)
+                            self._take(tokens)
+                            granted = True
+                            break
+                    remaining = start + timeout - now
+                    if remaining <= 0:
+                        self.stats["timeouts"] += 1
+                        raise RateLimitError(
+                            f"{self.name}: no rate-limit slot within {timeout:.2f}s "
+                            f"({len(self._waiters)} calls queued)"
+                        )
+                    self._cond.wait(remaining if wait_s is None else min(wait_s, remaining))
+            finally:
+                if not granted:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                # The head changed either way: let the next waiter re-check
+                self._cond.notify_all()
+
+            waited = time.monotonic() - start
+            self.stats["acquired"] += 1
+            self.stats["waited_s"] += waited
+            if waited > 0.01:
+                self.stats["queued"] += 1
+        return waited
+
+    def try_acquire(self, tokens: int = 0, level: int = None) -> bool:
+        """Takes a slot only if one is free right now and nobody is queued; never waits."""
+        level = current_priority() if level is None else level
+        with self._cond:
+            if self._waiters or self._time_until_ready(tokens, level, time.monotonic()) > 0:
+                return False
+            self._take(tokens)
+            self.stats["acquired"] += 1
+            return True
+
+    def pause(self, seconds: float):
+        """Holds every queued call for `seconds` after the provider throttled us."""
+        with self._cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.stats["throttled"] += 1
+            self._cond.notify_all()
+
+    def get_stats(self) -> dict:
+        with self._cond:
+            stats = dict(self.stats)
+            stats["queue_depth"] = len(self._waiters)
+        stats["waited_s"] = round(stats["waited_s"], 3)
+        return stats
+
+
+@lru_cache(maxsize=None)
+def get_limiter(provider: str) -> ProviderLimiter:
+    """Returns the process-wide limiter of a provider (see PROVIDER_LIMITS)."""
+    rpm, tpm = PROVIDER_LIMITS.get(provider, (0, 0))
+    return ProviderLimiter(provider, rpm, tpm)
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """
+    True for provider throttling responses (HTTP 429): openai.RateLimitError,
+    Tavily's UsageLimitExceededError, or any error carrying a 429 status.
+    """
+    if isinstance(error, RateLimitError):
+        return False
+    if type(error).__name__ in ("RateLimitError", "UsageLimitExceededError"):
+        return True
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return status == 429
+
+
+def retry_after_s(error: Exception, attempt: int) -> float:
+    """The provider's Retry-After hint, else exponential backoff with jitter."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return RATE_LIMIT_BACKOFF_S * (2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def call_with_rate_limit(provider: str, fn, *args, tokens: int = 0, max_wait_s: float = None, **kwargs):
+    """
+    Calls `fn(*args, **kwargs)` once the provider's limiter grants a slot.
+
+    A throttling (429) response pauses the whole provider queue for the
+    Retry-After delay and the call is retried, up to NEXUS_RATE_LIMIT_RETRIES
+    times, within `max_wait_s` overall.
+
+    Args:
+        provider (str): Key of PROVIDER_LIMITS.
+        fn: The API call.
+        tokens (int): Estimated tokens of the call (see estimate_tokens).
+        max_wait_s (float): Longest total time spent queuing and backing off
+            (default NEXUS_RATE_LIMIT_MAX_WAIT_S).
+
+    Raises:
+        RateLimitError: If no slot was granted in time.
+    """
+    limiter = get_limiter(provider)
+    max_wait_s = RATE_LIMIT_MAX_WAIT_S if max_wait_s is None else max_wait_s
+    deadline = time.monotonic() + max_wait_s
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        limiter.acquire(tokens, timeout=max(deadline - time.monotonic(), 0.0))
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if not is_rate_limit_error(e) or attempt == RATE_LIMIT_RETRIES:
+                raise
+            delay = retry_after_s(e, attempt)
+            print(f"  [Rate Limit] {provider} throttled; pausing {delay:.2f}s")
+            limiter.pause(delay)
+
+
+def get_rate_limit_stats() -> dict:
+    """Queue depth, waits, timeouts and throttling counts per provider."""
+    return {provider: get_limiter(provider).get_stats() for provider in PROVIDER_LIMITS}
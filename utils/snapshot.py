@@ -0,0 +1,603 @@
+import os
+import re
+import json
+import mmap
+import shutil
+import itertools
+from collections import Counter
+from datetime import datetime
+from functools import lru_cache
+
+# Read-only knowledge base snapshot. Layout of the snapshot directory:
+#   manifest.json   format version, row count, dimension, dtype, shard and source counts
+#   embeddings.npy  (n, d) unit-normalized vectors, float32 or int8
+#   scales.npy      (n,) float32 per-row dequantization scales (int8 only)
+#   chunks.bin      concatenated UTF-8 JSON records {id, document, metadata, shard}
+#   offsets.npy     (n + 1,) int64 byte offsets of each record in chunks.bin
+#   column_*.npy    (n,) filterable metadata fields (see FILTER_COLUMNS): int32
+#                   codes into the manifest's value list, or float64 numbers
+#   ivf_*.npy       optional inverted-file ANN index (centroids, list offsets, row ids)
+# Every file is memory-mapped, so worker processes share pages through the
+# OS cache and loading costs no more than opening the files.
+SNAPSHOT_FORMAT_VERSION = 1
+KB_SNAPSHOT_DIR = os.getenv("NEXUS_KB_SNAPSHOT_DIR", os.path.join(os.getcwd(), "data", "kb_snapshot"))
+SNAPSHOT_NPROBE = int(os.getenv("NEXUS_KB_SNAPSHOT_NPROBE", "8"))
+FILTER_CACHE_SIZE = 128
+
+# Metadata fields stored as columns, so filters on them never decode chunk
+# records: "category" fields hold strings, "number" fields ints or floats
+FILTER_COLUMNS = {"source": "category", "doc_type": "category", "ingested_at": "number"}
+
+EXPORT_BATCH_SIZE = 1000
+SCORE_BLOCK_ROWS = 65536
+KMEANS_ITERATIONS = 10
+
+
+_COMPARISONS = {
+    "$eq": lambda value, operand: value == operand,
+    "$ne": lambda value, operand: value != operand,
+    "$gt": lambda value, operand: value is not None and value > operand,
+    "$gte": lambda value, operand: value is not None and value >= operand,
+    "$lt": lambda value, operand: value is not None and value < operand,
+    "$lte": lambda value, operand: value is not None and value <= operand,
+    "$in": lambda value, operand: value in operand,
+    "$nin": lambda value, operand: value not in operand,
+}
+
+
+def matches_where(metadata: dict, where: dict) -> bool:
+    """
+    Evaluates a Chroma `where` metadata filter against one chunk's metadata.
+
+    Supports $and/$or, implicit equality ({"source": "a.pdf"}) and the
+    operators $eq, $ne, $gt, $gte, $lt, $lte, $in and $nin.
+    """
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches_where(metadata, clause) for clause in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_where(metadata, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            for operator, operand in condition.items():
+                if operator not in _COMPARISONS:
+                    raise ValueError(f"Unsupported where operator: {operator}")
+                try:
+                    if not _COMPARISONS[operator](value, operand):
+                        return False
+                except TypeError:
+                    return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+
+def matches_where_document(document: str, where_document: dict) -> bool:
+    """
+    Evaluates a Chroma `where_document` filter against one chunk's text.
+
+    Supports $and/$or, $contains, $not_contains, $regex and $not_regex.
+    """
+    for operator, operand in where_document.items():
+        if operator == "$and":
+            matched = all(matches_where_document(document, clause) for clause in operand)
+        elif operator == "$or":
+            matched = any(matches_where_document(document, clause) for clause in operand)
+        elif operator == "$contains":
+            matched = operand in document
+        elif operator == "$not_contains":
+            matched = operand not in document
+        elif operator == "$regex":
+            matched = re.search(operand, document) is not None
+        elif operator == "$not_regex":
+            matched = re.search(operand, document) is None
+        else:
+            raise ValueError(f"Unsupported where_document operator: {operator}")
+        if not matched:
+            return False
+    return True
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _category_mask(codes, lookup: dict, operator: str, operand):
+    """Vectorized comparison of a category column (None if unsupported)."""
+    import numpy as np
+
+    def code_of(value):
+        if value is None:
+            return -1
+        return lookup.get(value, -2) if isinstance(value, str) else -2
+
+    if operator == "$eq":
+        return codes == code_of(operand)
+    if operator == "$ne":
+        return codes != code_of(operand)
+    if operator in ("$in", "$nin") and isinstance(operand, (list, tuple)):
+        mask = np.isin(codes, [code_of(value) for value in operand])
+        return mask if operator == "$in" else ~mask
+    return None
+
+
+def _number_mask(values, operator: str, operand):
+    """Vectorized comparison of a number column; NaN marks a missing value (None if unsupported)."""
+    import numpy as np
+
+    if operator in ("$in", "$nin"):
+        if not isinstance(operand, (list, tuple)) or not all(_is_number(v) for v in operand):
+            return None
+        mask = np.isin(values, list(operand))
+        return mask if operator == "$in" else ~mask
+    if not _is_number(operand):
+        return None
+    if operator == "$eq":
+        return values == operand
+    if operator == "$ne":
+        return ~(values == operand)
+    if operator == "$gt":
+        return values > operand
+    if operator == "$gte":
+        return values >= operand
+    if operator == "$lt":
+        return values < operand
+    if operator == "$lte":
+        return values <= operand
+    return None
+
+
+class KBSnapshot:
+    """
+    Memory-mapped, read-only view of an exported knowledge base.
+
+    Distances are cosine distances (1 - cosine similarity), matching a
+    Chroma collection in "cosine" space.
+
+    Args:
+        path (str): Snapshot directory written by export_snapshot.
+    """
+
+    def __init__(self, path: str):
+        import numpy as np
+
+        self.path = path
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("version") != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported KB snapshot version: {self.manifest.get('version')}")
+
+        self.embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+        self.scales = None
+        if self.manifest["dtype"] == "int8":
+            self.scales = np.load(os.path.join(path, "scales.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+
+        self._chunks_file = open(os.path.join(path, "chunks.bin"), "rb")
+        self._chunks = b""
+        if os.fstat(self._chunks_file.fileno()).st_size:
+            self._chunks = mmap.mmap(self._chunks_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.centroids = None
+        if self.manifest.get("ann"):
+            self.centroids = np.load(os.path.join(path, "ivf_centroids.npy"), mmap_mode="r")
+            self.list_offsets = np.load(os.path.join(path, "ivf_list_offsets.npy"), mmap_mode="r")
+            self.list_rows = np.load(os.path.join(path, "ivf_rows.npy"), mmap_mode="r")
+
+        self.columns = {}
+        for field, info in (self.manifest.get("columns") or {}).items():
+            self.columns[field] = (
+                info["type"],
+                np.load(os.path.join(path, f"column_{field}.npy"), mmap_mode="r"),
+                {value: code for code, value in enumerate(info.get("values", []))},
+            )
+
+        self._metadatas = None
+        self._filter_rows = lru_cache(maxsize=FILTER_CACHE_SIZE)(self._matching_rows)
+
+    def __len__(self) -> int:
+        return int(self.manifest["count"])
+
+    def vectors(self, rows):
+        """Returns the (dequantized) float32 vectors of the given rows."""
+        import numpy as np
+
+        block = np.asarray(self.embeddings[rows], dtype=np.float32)
+        if self.scales is not None:
+            block *= np.asarray(self.scales[rows], dtype=np.float32)[:, None]
+        return block
+
+    def record(self, row: int) -> dict:
+        """Decodes the chunk record (id, document, metadata, shard) of one row."""
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        return json.loads(bytes(self._chunks[start:end]).decode("utf-8"))
+
+    def metadatas(self) -> list:
+        """Metadata of every row, decoded once on first use (for filters on non-column fields)."""
+        if self._metadatas is None:
+            self._metadatas = [self.record(row)["metadata"] or {} for row in range(len(self))]
+        return self._metadatas
+
+    def _column_mask(self, where: dict):
+        """
+        Evaluates `where` on the metadata columns alone.
+
+        Returns:
+            Boolean row mask, or None if the filter uses a field or operator
+            the columns cannot answer.
+        """
+        import numpy as np
+
+        mask = np.ones(len(self), dtype=bool)
+        for key, condition in where.items():
+            if key in ("$and", "$or"):
+                masks = [self._column_mask(clause) for clause in condition]
+                if any(m is None for m in masks):
+                    return None
+                if key == "$and":
+                    for m in masks:
+                        mask &= m
+                else:
+                    mask &= np.logical_or.reduce(masks) if masks else False
+                continue
+            if key not in self.columns:
+                return None
+            kind, values, lookup = self.columns[key]
+            conditions = condition.items() if isinstance(condition, dict) else [("$eq", condition)]
+            for operator, operand in conditions:
+                if kind == "category":
+                    m = _category_mask(values, lookup, operator, operand)
+                else:
+                    m = _number_mask(values, operator, operand)
+                if m is None:
+                    return None
+                mask &= m
+        return mask
+
+    def _matching_rows(self, where_json: str, where_document_json: str):
+        """Rows passing the filters (cached per filter, keyed by their JSON)."""
+        import numpy as np
+
+        where = json.loads(where_json)
+        where_document = json.loads(where_document_json)
+        rows = range(len(self))
+        if where:
+            mask = self._column_mask(where)
+            if mask is not None:
+                rows = np.flatnonzero(mask).tolist()
+            else:
+                metadatas = self.metadatas()
+                rows = [row for row in rows if matches_where(metadatas[row], where)]
+        if where_document:
+            rows = [row for row in rows if matches_where_document(self.record(row)["document"], where_document)]
+        return np.asarray(list(rows), dtype=np.int64)
+
+    def _candidate_rows(self, query, nprobe: int):
+        """Rows in the nprobe IVF lists closest to the query (None = all rows)."""
+        import numpy as np
+
+        if self.centroids is None or nprobe >= len(self.centroids):
+            return None
+        nearest = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        return np.concatenate([
+            self.list_rows[self.list_offsets[c]:self.list_offsets[c + 1]] for c in nearest
+        ])
+
+    def _similarities(self, query, rows):
+        """Cosine similarity of the query to `rows` (or every row), in blocks."""
+        import numpy as np
+
+        if rows is not None:
+            rows = np.sort(rows)
+            return self.vectors(rows) @ query, rows
+        scores = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), SCORE_BLOCK_ROWS):
+            end = min(start + SCORE_BLOCK_ROWS, len(self))
+            scores[start:end] = self.vectors(slice(start, end)) @ query
+        return scores, np.arange(len(self))
+
+    def query(self, query_embedding, n_results: int = 5, include=None, nprobe: int = None,
+              where: dict = None, where_document: dict = None) -> dict:
+        """
+        Finds the nearest chunks to a query embedding.
+
+        Args:
+            query_embedding (list): The query embedding (one query).
+            n_results (int): Number of results to return.
+            include (list): Fields to return, as in Chroma's query().
+            nprobe (int): IVF lists to scan (default NEXUS_KB_SNAPSHOT_NPROBE);
+                ignored without an ANN index, which scans every row exactly.
+            where (dict): Chroma-style metadata filter (see matches_where).
+            where_document (dict): Chroma-style document filter.
+
+        Only rows passing the filters are scored. If the probed IVF lists
+        hold fewer than n_results matching rows, every matching row is
+        scored exactly instead.
+
+        Returns:
+            dict: Chroma-style results for one query (lists of lists), plus
+                "shards" naming the collection each result was exported from.
+        """
+        import numpy as np
+
+        include = list(include) if include is not None else ["documents", "metadatas", "distances"]
+        if len(self) == 0 or n_results <= 0:
+            return {field: [[]] for field in ["ids", "shards"] + include}
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        candidates = self._candidate_rows(query, nprobe or SNAPSHOT_NPROBE)
+        if where or where_document:
+            allowed = self._filter_rows(
+                json.dumps(where or {}, sort_keys=True), json.dumps(where_document or {}, sort_keys=True)
+            )
+            if candidates is not None:
+                candidates = np.intersect1d(candidates, allowed)
+            if candidates is None or len(candidates) < min(n_results, len(allowed)):
+                candidates = allowed
+            if len(candidates) == 0:
+                return {field: [[]] for field in ["ids", "shards"] + include}
+        scores, rows = self._similarities(query, candidates)
+        n = min(n_results, len(rows))
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        top_rows = rows[top]
+
+        records = [self.record(int(row)) for row in top_rows]
+        results = {
+            "ids": [[r["id"] for r in records]],
+            "shards": [[r["shard"] for r in records]],
+        }
+        if "documents" in include:
+            results["documents"] = [[r["document"] for r in records]]
+        if "metadatas" in include:
+            results["metadatas"] = [[r["metadata"] for r in records]]
+        if "distances" in include:
+            results["distances"] = [[float(1.0 - s) for s in scores[top]]]
+        if "embeddings" in include:
+            results["embeddings"] = [list(self.vectors(top_rows))]
+        return results
+
+    def sources(self) -> list:
+        """Sorted source document names (from the manifest when recorded)."""
+        if "sources" in self.manifest:
+            return sorted(self.manifest["sources"])
+        if self.columns.get("source", (None,))[0] == "category":
+            return sorted(self.manifest["columns"]["source"]["values"])
+        return sorted({m.get("source") for m in self.metadatas() if m.get("source")})
+
+    def shard_stats(self) -> list:
+        """Per-shard chunk counts recorded at export time."""
+        return [{"name": name, "count": count} for name, count in self.manifest["shards"].items()]
+
+
+@lru_cache(maxsize=None)
+def get_snapshot(path: str = None) -> KBSnapshot:
+    """Opens the KB snapshot (shared per process)."""
+    from utils.vectordb import EMBEDDING_MODEL
+
+    snapshot = KBSnapshot(path or KB_SNAPSHOT_DIR)
+    if snapshot.manifest.get("embedding_model") != EMBEDDING_MODEL:
+        raise ValueError(
+            f"KB snapshot was built with {snapshot.manifest.get('embedding_model')}, "
+            f"but queries are embedded with {EMBEDDING_MODEL}."
+        )
+    return snapshot
+
+
+def _quantize_int8(vectors):
+    """Symmetric per-row int8 quantization; returns (codes, scales)."""
+    import numpy as np
+
+    scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def _assign(vectors, centroids):
+    """Nearest centroid (by cosine) of each unit vector, in blocks."""
+    import numpy as np
+
+    labels = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), SCORE_BLOCK_ROWS):
+        labels[start:start + SCORE_BLOCK_ROWS] = np.argmax(
+            vectors[start:start + SCORE_BLOCK_ROWS] @ centroids.T, axis=1
+        )
+    return labels
+
+
+def build_ivf(vectors, nlist: int, iterations: int = KMEANS_ITERATIONS, seed: int = 0):
+    """
+    Clusters unit vectors with spherical k-means into an inverted-file index.
+
+    Returns:
+        tuple: (centroids (nlist, d), list offsets (nlist + 1,), row ids
+            grouped by list).
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    nlist = max(1, min(nlist, len(vectors)))
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        labels = _assign(vectors, centroids)
+        for c in range(nlist):
+            members = vectors[labels == c]
+            if len(members):
+                mean = members.mean(axis=0)
+                centroids[c] = mean / max(float(np.linalg.norm(mean)), 1e-12)
+
+    labels = _assign(vectors, centroids)
+    order = np.argsort(labels, kind="stable")
+    list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=nlist), out=list_offsets[1:])
+    return centroids.astype(np.float32), list_offsets, order.astype(np.int64)
+
+
+def export_snapshot(output_dir: str = None, dtype: str = "float32", ann: bool = False,
+                    nlist: int = None, collections=None) -> dict:
+    """
+    Exports the knowledge base shards into a read-only snapshot.
+
+    The snapshot is written to a temporary directory and swapped in at the
+    end, so serving processes never see a half-written snapshot. Vectors
+    are streamed into memory-mapped files sized from the collection counts,
+    so memory use does not grow with the corpus; the collections must not
+    be written to during the export.
+
+    Args:
+        output_dir (str): Destination (default NEXUS_KB_SNAPSHOT_DIR).
+        dtype (str): "float32" or "int8" (4x smaller, slightly lossy).
+        ann (bool): Also build an IVF index for sub-linear search.
+        nlist (int): IVF lists (default about sqrt(n)).
+        collections (list): Collections to export (default every KB shard).
+
+    Returns:
+        dict: The snapshot manifest.
+    """
+    import numpy as np
+    from utils.vectordb import get_shards, iter_collection, EMBEDDING_MODEL
+
+    if dtype not in ("float32", "int8"):
+        raise ValueError(f"Unsupported snapshot dtype: {dtype}")
+
+    output_dir = output_dir or KB_SNAPSHOT_DIR
+    staging_dir = f"{output_dir}.tmp"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+
+    collections = list(collections if collections is not None else get_shards())
+    counts = [collection.count() for collection in collections]
+    count = sum(counts)
+
+    def staged(name):
+        return os.path.join(staging_dir, name)
+
+    # float32 vectors go straight to embeddings.npy; int8 quantizes them from a scratch file
+    vectors_path = staged("embeddings.npy" if dtype == "float32" else "embeddings.f32.npy")
+
+    matrix = None
+    offsets = np.lib.format.open_memmap(staged("offsets.npy"), mode="w+", dtype=np.int64, shape=(count + 1,))
+    offsets[0] = 0
+    columns = {}
+    for field, kind in FILTER_COLUMNS.items():
+        column = np.lib.format.open_memmap(
+            staged(f"column_{field}.npy"), mode="w+",
+            dtype=np.int32 if kind == "category" else np.float64, shape=(count,)
+        )
+        column[:] = -1 if kind == "category" else np.nan
+        columns[field] = {"type": kind, "data": column, "lookup": {}, "valid": True}
+
+    row = 0
+    shard_counts = {}
+    source_counts = Counter()
+    with open(staged("chunks.bin"), "wb") as chunks:
+        for collection, expected in zip(collections, counts):
+            shard_counts[collection.name] = 0
+            for doc_id, document, metadata, embedding in itertools.islice(
+                iter_collection(collection, EXPORT_BATCH_SIZE), expected
+            ):
+                record = json.dumps(
+                    {"id": doc_id, "document": document, "metadata": metadata, "shard": collection.name},
+                    ensure_ascii=False, separators=(",", ":")
+                ).encode("utf-8")
+                chunks.write(record)
+                offsets[row + 1] = offsets[row] + len(record)
+
+                vector = np.asarray(embedding, dtype=np.float32)
+                if matrix is None:
+                    matrix = np.lib.format.open_memmap(
+                        vectors_path, mode="w+", dtype=np.float32, shape=(count, len(vector))
+                    )
+                matrix[row] = vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+                metadata = metadata or {}
+                for field, column in columns.items():
+                    value = metadata.get(field)
+                    if value is None or not column["valid"]:
+                        continue
+                    if column["type"] == "category" and isinstance(value, str):
+                        column["data"][row] = column["lookup"].setdefault(value, len(column["lookup"]))
+                    elif column["type"] == "number" and _is_number(value):
+                        column["data"][row] = value
+                    else:
+                        column["valid"] = False
+                if metadata.get("source"):
+                    source_counts[metadata["source"]] += 1
+                shard_counts[collection.name] += 1
+                row += 1
+            if shard_counts[collection.name] != expected:
+                raise ValueError(
+                    f"{collection.name} changed during export "
+                    f"({shard_counts[collection.name]} of {expected} chunks read)"
+                )
+
+    if matrix is None:
+        matrix = np.lib.format.open_memmap(vectors_path, mode="w+", dtype=np.float32, shape=(0, 0))
+    dim = matrix.shape[1]
+
+    if dtype == "int8":
+        codes = np.lib.format.open_memmap(staged("embeddings.npy"), mode="w+", dtype=np.int8, shape=matrix.shape)
+        scales = np.lib.format.open_memmap(staged("scales.npy"), mode="w+", dtype=np.float32, shape=(count,))
+        for start in range(0, count, SCORE_BLOCK_ROWS):
+            end = min(start + SCORE_BLOCK_ROWS, count)
+            codes[start:end], scales[start:end] = _quantize_int8(np.asarray(matrix[start:end]))
+        codes.flush()
+        scales.flush()
+        del codes, scales
+
+    ann_info = None
+    if ann and count:
+        nlist = nlist or max(1, int(np.sqrt(count)))
+        centroids, list_offsets, rows = build_ivf(matrix, nlist)
+        np.save(staged("ivf_centroids.npy"), centroids)
+        np.save(staged("ivf_list_offsets.npy"), list_offsets)
+        np.save(staged("ivf_rows.npy"), rows)
+        ann_info = {"type": "ivf", "nlist": len(centroids)}
+
+    matrix.flush()
+    offsets.flush()
+    del matrix, offsets
+    if dtype == "int8":
+        os.remove(vectors_path)
+
+    column_info = {}
+    for field, column in columns.items():
+        column["data"].flush()
+        del column["data"]
+        if not column["valid"]:
+            # Mixed value types: filters on this field decode the metadata instead
+            os.remove(staged(f"column_{field}.npy"))
+            continue
+        column_info[field] = {"type": column["type"]}
+        if column["type"] == "category":
+            column_info[field]["values"] = list(column["lookup"])
+
+    manifest = {
+        "version": SNAPSHOT_FORMAT_VERSION,
+        "created_at": datetime.now().isoformat(),
+        "embedding_model": EMBEDDING_MODEL,
+        "count": count,
+        "dim": dim,
+        "dtype": dtype,
+        "distance": "cosine",
+        "shards": shard_counts,
+        "sources": dict(source_counts),
+        "columns": column_info,
+        "ann": ann_info,
+    }
+    with open(os.path.join(staging_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    # Swap in the new snapshot; processes holding the old files keep their mappings
+    previous_dir = f"{output_dir}.old"
+    shutil.rmtree(previous_dir, ignore_errors=True)
+    if os.path.exists(output_dir):
+        os.replace(output_dir, previous_dir)
+    os.replace(staging_dir, output_dir)
+    shutil.rmtree(previous_dir, ignore_errors=True)
+    return manifest
@@ -0,0 +1,9 @@
+import re
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = {"a", "an", "the", "is", "are", "was", "what", "how", "why", "of", "to",
+             "in", "and", "or", "for", "on", "does", "do", "it", "that", "this", "with"}
+
+def keywords(text: str) -> set:
+    """Lowercased content words of a text (stopwords removed)."""
+    return {w for w in _WORD_RE.findall(text.lower()) if w not in STOPWORDS}
@@ -1,40 +1,287 @@
 import os
-import chromadb
-from chromadb.utils import embedding_functions
-from dotenv import load_dotenv
+import zlib
+import heapq
+import time
+import threading
+from array import array
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
-load_dotenv()
+from utils.config import load_env
+from utils.cache import get_kv, set_kv, normalize_query
+from utils.rate_limiter import call_with_rate_limit, estimate_tokens
+from utils.profiling import bind_to_request
+from utils.deadline import LLM_REQUEST_TIMEOUT_S, LLM_MAX_RETRIES
+
+load_env()
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_TTL_HOURS = float(os.getenv("NEXUS_EMBEDDING_TTL_HOURS", "720"))
+# Ingestion batches may queue this long for embedding quota (seconds)
+INGEST_MAX_WAIT_S = 600
+
+# Maximal Marginal Relevance: candidates fetched per query, relevance/diversity
+# trade-off (1.0 = pure relevance), and similarity above which a candidate is
+# treated as a duplicate of an already selected chunk and dropped
+MMR_FETCH_K = int(os.getenv("NEXUS_MMR_FETCH_K", "20"))
+MMR_LAMBDA = float(os.getenv("NEXUS_MMR_LAMBDA", "0.5"))
+MMR_DUPLICATE_THRESHOLD = float(os.getenv("NEXUS_MMR_DUPLICATE_THRESHOLD", "0.97"))
+
+# Knowledge base sharding: chunks are spread over NEXUS_KB_SHARDS collections,
+# partitioned by source document ("source", keeps a document's chunks together)
+# or by chunk id ("hash", spreads large documents evenly). With one shard the
+# original single collection name is used, so existing stores keep working.
+KB_COLLECTION_NAME = "nexus_knowledge_base"
+KB_NUM_SHARDS = max(int(os.getenv("NEXUS_KB_SHARDS", "1")), 1)
+KB_PARTITION = os.getenv("NEXUS_KB_PARTITION", "source")
+
+# HNSW index settings, applied when a collection is created. space, M and
+# construction_ef are fixed from then on; search_ef (the candidate list size
+# per query, the recall/latency knob) is persisted with the collection and
+# only changed by scripts/tune_hnsw.py --apply, never on open or per query.
+HNSW_SPACE = os.getenv("NEXUS_HNSW_SPACE", "cosine")
+HNSW_M = int(os.getenv("NEXUS_HNSW_M", "16"))
+HNSW_CONSTRUCTION_EF = int(os.getenv("NEXUS_HNSW_CONSTRUCTION_EF", "100"))
+HNSW_SEARCH_EF = int(os.getenv("NEXUS_HNSW_SEARCH_EF", "100"))
+
+# Where KB queries are served from: "chroma" (the shard collections) or
+# "snapshot" (the read-only, memory-mapped export from utils/snapshot.py)
+KB_BACKEND = os.getenv("NEXUS_KB_BACKEND", "chroma")
+
+_shard_executor = ThreadPoolExecutor(max_workers=min(KB_NUM_SHARDS, 16), thread_name_prefix="nexus-shard")
 
 # Define persistence directory
 PERSIST_DIRECTORY = os.path.join(os.getcwd(), "data", "chroma_db")
 
+# chromadb (and numpy/onnxruntime behind it) is imported inside the getters
+# below, and the client, embedding function and collections are cached per
+# process, so importing this module is cheap and reruns reuse open handles.
+# Creation is serialized: the warm-up thread, the UI and shard fan-out can
+# all ask for them at once, and concurrent PersistentClient construction fails.
+_chroma_lock = threading.RLock()
+
 def get_chroma_client():
-    """Returns a persistent ChromaDB client."""
+    """Returns a persistent ChromaDB client (shared per process)."""
+    with _chroma_lock:
+        return _create_chroma_client()
+
+@lru_cache(maxsize=None)
+def _create_chroma_client():
+    import chromadb
     return chromadb.PersistentClient(path=PERSIST_DIRECTORY)
 
+@lru_cache(maxsize=None)
 def get_embedding_function():
     """Returns the OpenAI embedding function."""
+    from chromadb.utils import embedding_functions
+
     openai_api_key = os.getenv("OPENAI_API_KEY")
     if not openai_api_key:
         raise ValueError("OPENAI_API_KEY not found in environment variables.")
     
     return embedding_functions.OpenAIEmbeddingFunction(
         api_key=openai_api_key,
-        model_name="text-embedding-3-small"
+        model_name=EMBEDDING_MODEL
     )
 
-def get_collection(name="nexus_knowledge_base"):
-    """Gets or creates the vector database collection."""
+def hnsw_configuration(space: str = None, m: int = None, construction_ef: int = None,
+                       search_ef: int = None) -> dict:
+    """
+    Builds a Chroma collection configuration for the HNSW index.
+    
+    Args:
+        space (str): Distance space, "cosine", "l2" or "ip" (default NEXUS_HNSW_SPACE).
+        m (int): Graph neighbors per node (default NEXUS_HNSW_M).
+        construction_ef (int): Candidate list size while building (default NEXUS_HNSW_CONSTRUCTION_EF).
+        search_ef (int): Candidate list size while querying (default NEXUS_HNSW_SEARCH_EF).
+        
+    Returns:
+        dict: Configuration for get_or_create_collection(configuration=...).
+    """
+    return {"hnsw": {
+        "space": space or HNSW_SPACE,
+        "max_neighbors": m or HNSW_M,
+        "ef_construction": construction_ef or HNSW_CONSTRUCTION_EF,
+        "ef_search": search_ef or HNSW_SEARCH_EF,
+    }}
+
+def get_hnsw_settings(collection) -> dict:
+    """Returns the collection's current HNSW settings (space, M, ef values)."""
+    hnsw = (collection.configuration or {}).get("hnsw") or {}
+    return {
+        "space": hnsw.get("space"),
+        "m": hnsw.get("max_neighbors"),
+        "construction_ef": hnsw.get("ef_construction"),
+        "search_ef": hnsw.get("ef_search"),
+    }
+
+def set_search_ef(collection, search_ef: int) -> bool:
+    """
+    Changes a collection's search-time ef (persisted with the collection).
+    
+    This writes the collection's configuration, so it is a tuning-time
+    operation (scripts/tune_hnsw.py), not something to do per query.
+    
+    Returns:
+        bool: True if the setting changed.
+    """
+    if get_hnsw_settings(collection)["search_ef"] == search_ef:
+        return False
+    collection.modify(configuration={"hnsw": {"ef_search": search_ef}})
+    return True
+
+def get_collection(name=KB_COLLECTION_NAME):
+    """
+    Gets or creates the vector database collection (cached per name).
+    
+    New collections are built with the NEXUS_HNSW_* settings; existing ones
+    keep the settings they were created (or last tuned) with: opening one
+    never rewrites its configuration.
+    """
+    with _chroma_lock:
+        return _open_collection(name)
+
+@lru_cache(maxsize=None)
+def _open_collection(name):
     client = get_chroma_client()
     embedding_fn = get_embedding_function()
-    return client.get_or_create_collection(
+    collection = client.get_or_create_collection(
         name=name,
-        embedding_function=embedding_fn
+        embedding_function=embedding_fn,
+        configuration=hnsw_configuration()
+    )
+    return collection
+
+def get_shard_names() -> list:
+    """Returns the collection names of all knowledge base shards."""
+    if KB_NUM_SHARDS == 1:
+        return [KB_COLLECTION_NAME]
+    return [f"{KB_COLLECTION_NAME}_shard{i:02d}" for i in range(KB_NUM_SHARDS)]
+
+def shard_for(source: str, chunk_id: str) -> str:
+    """
+    Picks the shard collection a chunk belongs to.
+    
+    Uses a stable hash (crc32) so the same chunk always routes to the same
+    shard across processes and re-ingestion.
+    
+    Args:
+        source (str): Source document name.
+        chunk_id (str): Unique chunk ID.
+        
+    Returns:
+        str: The shard's collection name.
+    """
+    names = get_shard_names()
+    key = source if KB_PARTITION == "source" else chunk_id
+    return names[zlib.crc32(key.encode("utf-8")) % len(names)]
+
+def get_shards() -> list:
+    """Gets or creates every shard collection (cached per name)."""
+    return [get_collection(name) for name in get_shard_names()]
+
+def get_shard_stats() -> list:
+    """
+    Returns per-shard metadata for display.
+    
+    Returns:
+        list: Dicts with the shard name and its chunk count.
+    """
+    if KB_BACKEND == "snapshot":
+        from utils.snapshot import get_snapshot
+        return get_snapshot().shard_stats()
+    return [{"name": collection.name, "count": collection.count()} for collection in get_shards()]
+
+def load_knowledge_base():
+    """Opens the configured KB backend ahead of the first query (see warm_up)."""
+    if KB_BACKEND == "snapshot":
+        from utils.snapshot import get_snapshot
+        return get_snapshot()
+    return get_shards()
+
+def _embedding_cache_key(text: str) -> str:
+    return f"{EMBEDDING_MODEL}|{normalize_query(text)}"
+
+def get_cached_embedding(text: str, touch: bool = True):
+    """
+    Returns the cached query embedding entry, or None.
+    
+    Returns:
+        dict | None: {"embedding": list, "expires_at": datetime}.
+    """
+    cached = get_kv("embedding", _embedding_cache_key(text), touch=touch)
+    if not cached:
+        return None
+    return {"embedding": array("f", cached["payload"]).tolist(), "expires_at": cached["expires_at"]}
+
+def _request_embedding(text: str, expires_at: float = None) -> list:
+    """
+    Embeds one text with the OpenAI client, capped at NEXUS_LLM_REQUEST_TIMEOUT_S
+    and at `expires_at` (time.monotonic()) if given, in which case the
+    client does not retry (a retry could not finish in time).
+    
+    Raises:
+        TimeoutError: If no time is left or the request timed out.
+    """
+    import openai
+
+    timeout_s, max_retries = LLM_REQUEST_TIMEOUT_S, LLM_MAX_RETRIES
+    if expires_at is not None:
+        max_retries = 0
+        timeout_s = min(timeout_s, expires_at - time.monotonic())
+        if timeout_s <= 0:
+            raise TimeoutError("no time left to embed the query")
+    client = get_embedding_function().client
+    try:
+        response = client.with_options(timeout=timeout_s, max_retries=max_retries).embeddings.create(
+            model=EMBEDDING_MODEL, input=[text]
+        )
+    except openai.APITimeoutError as e:
+        raise TimeoutError(f"query embedding exceeded {timeout_s:.2f}s") from e
+    return response.data[0].embedding
+
+def embed_query(text: str, use_cache: bool = True, timeout_s: float = None) -> list:
+    """
+    Embeds a search query, using the persistent embedding cache.
+    
+    The normalized query text is embedded so that cached and fresh
+    embeddings of equivalent queries are identical.
+    
+    Args:
+        text (str): The query string.
+        use_cache (bool): Serve from the cache if present (the result is
+            always written back).
+        timeout_s (float): Longest time for the rate-limit wait and the
+            embedding request together (e.g. the request's remaining budget).
+        
+    Returns:
+        list: The query embedding.
+        
+    Raises:
+        TimeoutError: If the embedding request did not finish in time.
+        RateLimitError: If no rate-limit slot was granted in time.
+    """
+    if use_cache:
+        cached = get_cached_embedding(text)
+        if cached is not None:
+            return cached["embedding"]
+    
+    normalized = normalize_query(text)
+    expires_at = time.monotonic() + timeout_s if timeout_s is not None else None
+    embedding = call_with_rate_limit(
+        "openai_embeddings", _request_embedding, normalized, expires_at,
+        tokens=estimate_tokens(normalized), max_wait_s=timeout_s
     )
+    set_kv(
+        "embedding", _embedding_cache_key(text),
+        array("f", embedding).tobytes(), ttl_hours=EMBEDDING_TTL_HOURS
+    )
+    return [float(x) for x in embedding]
 
 def add_documents_to_collection(collection, documents, metadatas, ids):
     """
-    Adds documents to the collection.
+    Adds documents to the collection, replacing the text and metadata of
+    any ID already present (so a re-ingest backfills new metadata fields).
     
     Args:
         collection: The ChromaDB collection object.
@@ -42,13 +289,87 @@ def add_documents_to_collection(collection, documents, metadatas, ids):
         metadatas (list): List of metadata dicts.
         ids (list): List of unique IDs.
     """
-    collection.add(
+    collection.upsert(
         documents=documents,
         metadatas=metadatas,
         ids=ids
     )
 
-def search_collection(collection, query_texts, n_results=5):
+def add_documents_to_shards(documents, metadatas, ids) -> dict:
+    """
+    Routes documents to their shards (see shard_for) and adds or updates them.
+    
+    Args:
+        documents (list): List of text strings.
+        metadatas (list): List of metadata dicts (with a "source" key).
+        ids (list): List of unique IDs.
+        
+    Returns:
+        dict: Number of chunks written per shard name.
+    """
+    batches = {}
+    for document, metadata, doc_id in zip(documents, metadatas, ids):
+        name = shard_for(metadata.get("source", ""), doc_id)
+        batch = batches.setdefault(name, ([], [], []))
+        batch[0].append(document)
+        batch[1].append(metadata)
+        batch[2].append(doc_id)
+    
+    for name, (shard_docs, shard_metas, shard_ids) in batches.items():
+        # Chroma embeds the batch on add, so it counts against the embedding quota
+        call_with_rate_limit(
+            "openai_embeddings", add_documents_to_collection, get_collection(name),
+            shard_docs, shard_metas, shard_ids,
+            tokens=estimate_tokens(*shard_docs), max_wait_s=INGEST_MAX_WAIT_S
+        )
+    return {name: len(batch[2]) for name, batch in batches.items()}
+
+def remove_stale_chunks(sources, keep_ids) -> int:
+    """
+    Deletes chunks of the given sources whose IDs are not in `keep_ids`,
+    e.g. the tail chunks left over when a re-ingested document now splits
+    into fewer chunks, and copies in a shard that shard_for no longer
+    routes them to (left behind when NEXUS_KB_SHARDS or
+    NEXUS_KB_PARTITION changed).
+    
+    Args:
+        sources (list): Source file names that were just re-ingested.
+        keep_ids (iterable): IDs written by that ingest.
+        
+    Returns:
+        int: Number of chunks deleted across all shards.
+    """
+    if not sources:
+        return 0
+    keep_ids = set(keep_ids)
+    removed = 0
+    for collection in get_shards():
+        existing = collection.get(where={"source": {"$in": list(sources)}}, include=["metadatas"])
+        stale = [
+            doc_id for doc_id, metadata in zip(existing["ids"], existing["metadatas"])
+            if doc_id not in keep_ids or shard_for((metadata or {}).get("source", ""), doc_id) != collection.name
+        ]
+        if stale:
+            collection.delete(ids=stale)
+            removed += len(stale)
+    return removed
+
+def iter_collection(collection, batch_size: int = 1000):
+    """Yields (id, document, metadata, embedding) for every chunk of a collection."""
+    offset = 0
+    while True:
+        batch = collection.get(
+            include=["documents", "metadatas", "embeddings"],
+            limit=batch_size, offset=offset
+        )
+        if not batch["ids"]:
+            return
+        for i, doc_id in enumerate(batch["ids"]):
+            yield doc_id, batch["documents"][i], batch["metadatas"][i], batch["embeddings"][i]
+        offset += len(batch["ids"])
+
+def search_collection(collection, query_texts=None, n_results=5, query_embeddings=None, include=None,
+                      where=None, where_document=None):
     """
     Queries the collection.
     
@@ -56,11 +377,193 @@ def search_collection(collection, query_texts, n_results=5):
         collection: The ChromaDB collection object.
         query_texts (list): List of query strings (usually just one).
         n_results (int): Number of results to return.
+        query_embeddings (list): Precomputed query embeddings, used instead
+            of query_texts (e.g. from embed_query's cache).
+        include (list): Fields to return (Chroma's default if None), e.g.
+            add "embeddings" for re-ranking.
+        where (dict): Metadata filter applied inside the index, e.g.
+            {"source": {"$in": ["a.pdf"]}} (see build_where).
+        where_document (dict): Document text filter, e.g. {"$contains": "llama"}.
         
     Returns:
         dict: Query results.
     """
-    return collection.query(
-        query_texts=query_texts,
-        n_results=n_results
+    kwargs = {"n_results": n_results}
+    if include is not None:
+        kwargs["include"] = include
+    if where:
+        kwargs["where"] = where
+    if where_document:
+        kwargs["where_document"] = where_document
+    if query_embeddings is not None:
+        return collection.query(query_embeddings=query_embeddings, **kwargs)
+    return collection.query(query_texts=query_texts, **kwargs)
+
+def search_shards(query_embedding, n_results=5, include=None, where=None, where_document=None):
+    """
+    Queries every shard in parallel and merges their top-k lists by distance.
+    
+    All shards share the embedding function and distance space, so their
+    distances are directly comparable. A shard that fails is logged and
+    skipped; the others still answer.
+    
+    Args:
+        query_embedding (list): The query embedding (one query).
+        n_results (int): Number of merged results to return.
+        include (list): Fields to return; "distances" is always added.
+        where (dict): Metadata filter, applied inside each shard's index.
+        where_document (dict): Document text filter.
+        
+    Returns:
+        dict: Chroma-style results for one query (lists of lists), plus
+            "shards" naming the collection each result came from.
+    """
+    include = list(include) if include is not None else ["documents", "metadatas", "distances"]
+    if "distances" not in include:
+        include.append("distances")
+    
+    def query_shard(collection):
+        return collection.name, search_collection(
+            collection, query_embeddings=[query_embedding], n_results=n_results, include=include,
+            where=where, where_document=where_document
+        )
+    
+    shards = get_shards()
+    if len(shards) == 1:
+        responses = [query_shard(shards[0])]
+    else:
+        futures = [_shard_executor.submit(bind_to_request(query_shard), collection) for collection in shards]
+        responses = []
+        for future in futures:
+            try:
+                responses.append(future.result())
+            except Exception as e:
+                print(f"Error searching knowledge base shard: {e}")
+    
+    candidates = []
+    for name, results in responses:
+        ids = results.get("ids") or [[]]
+        for i, distance in enumerate(results["distances"][0]):
+            row = {"shards": name, "ids": ids[0][i] if ids[0] else None, "distances": distance}
+            for field in include:
+                if field != "distances" and results.get(field) is not None:
+                    row[field] = results[field][0][i]
+            candidates.append(row)
+    
+    merged = heapq.nsmallest(n_results, candidates, key=lambda row: row["distances"])
+    fields = ["ids", "shards"] + include
+    return {field: [[row.get(field) for row in merged]] for field in fields}
+
+def query_knowledge_base(query_embedding, n_results=5, include=None, where=None, where_document=None):
+    """
+    Serves a KB query from the configured backend (NEXUS_KB_BACKEND).
+    
+    Both backends return Chroma-style results for one query with a
+    "shards" list and accept the same where/where_document filters, so
+    callers do not depend on where the chunks live.
+    """
+    if KB_BACKEND == "snapshot":
+        from utils.snapshot import get_snapshot
+        return get_snapshot().query(
+            query_embedding, n_results=n_results, include=include,
+            where=where, where_document=where_document
+        )
+    return search_shards(
+        query_embedding, n_results=n_results, include=include,
+        where=where, where_document=where_document
     )
+
+def build_where(sources=None, doc_types=None, ingested_after=None):
+    """
+    Builds a metadata filter from the common KB filter options.
+    
+    Args:
+        sources (list): Only chunks from these source documents.
+        doc_types (list): Only these document types (e.g. ["pdf"]).
+        ingested_after (float): Only chunks ingested at or after this Unix time.
+        
+    Returns:
+        dict | None: A Chroma `where` filter, or None for no filtering.
+    """
+    clauses = []
+    if sources:
+        clauses.append({"source": {"$in": list(sources)}})
+    if doc_types:
+        clauses.append({"doc_type": {"$in": list(doc_types)}})
+    if ingested_after is not None:
+        clauses.append({"ingested_at": {"$gte": int(ingested_after)}})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+def list_sources() -> list:
+    """Returns the sorted source document names in the knowledge base."""
+    if KB_BACKEND == "snapshot":
+        from utils.snapshot import get_snapshot
+        return get_snapshot().sources()
+    sources = set()
+    for collection in get_shards():
+        offset = 0
+        while True:
+            batch = collection.get(include=["metadatas"], limit=1000, offset=offset)
+            if not batch["ids"]:
+                break
+            sources.update(m.get("source") for m in batch["metadatas"] if m and m.get("source"))
+            offset += len(batch["ids"])
+    return sorted(sources)
+
+def max_marginal_relevance(query_embedding, candidate_embeddings, k: int,
+                           lambda_mult: float = None, duplicate_threshold: float = None):
+    """
+    Selects up to k diverse, relevant candidates with Maximal Marginal Relevance.
+    
+    All similarities are computed up front as two matrix products (query vs.
+    candidates, candidates vs. candidates); each greedy step is then a
+    vectorized argmax plus an elementwise max update, with no per-pair
+    Python loops. Candidates nearly identical to an already selected one
+    (cosine >= duplicate_threshold) are dropped, so fewer than k may return.
+    
+    Args:
+        query_embedding: Query vector, shape (d,).
+        candidate_embeddings: Candidate vectors, shape (n, d).
+        k (int): Maximum number of candidates to select.
+        lambda_mult (float): Relevance weight in [0, 1] (default NEXUS_MMR_LAMBDA).
+        duplicate_threshold (float): Cosine similarity treated as a duplicate.
+        
+    Returns:
+        tuple: (selected indices in selection order, their cosine relevance).
+    """
+    import numpy as np
+
+    if lambda_mult is None:
+        lambda_mult = MMR_LAMBDA
+    if duplicate_threshold is None:
+        duplicate_threshold = MMR_DUPLICATE_THRESHOLD
+
+    candidates = np.asarray(candidate_embeddings, dtype=np.float32)
+    if candidates.ndim != 2 or len(candidates) == 0 or k <= 0:
+        return [], []
+    query = np.asarray(query_embedding, dtype=np.float32)
+
+    candidates = candidates / np.maximum(np.linalg.norm(candidates, axis=1, keepdims=True), 1e-12)
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+    relevance = candidates @ query
+    similarity = candidates @ candidates.T
+
+    first = int(np.argmax(relevance))
+    selected = [first]
+    max_similarity = similarity[first].copy()
+    available = max_similarity < duplicate_threshold
+    available[first] = False
+
+    while len(selected) < k and available.any():
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        np.maximum(max_similarity, similarity[best], out=max_similarity)
+        available &= max_similarity < duplicate_threshold
+        available[best] = False
+
+    return selected, [float(relevance[i]) for i in selected]
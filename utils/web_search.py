@@ -1,38 +1,372 @@
 import os
-from tavily import TavilyClient
-from dotenv import load_dotenv
+import time
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import lru_cache
 
-load_dotenv()
+from utils.config import load_env
+from utils.cache import normalize_query
+from utils.rate_limiter import get_limiter, is_rate_limit_error, retry_after_s, RateLimitError
+from utils.profiling import bind_to_request
 
-# Initialize Tavily Client
-tavily_api_key = os.getenv("TAVILY_API_KEY")
-if not tavily_api_key:
-    # Warning or error, but for now just let it fail if called
-    pass
+load_env()
 
-tavily_client = TavilyClient(api_key=tavily_api_key) if tavily_api_key else None
+# Resilience settings (seconds unless noted)
+WEB_TIMEOUT_S = float(os.getenv("NEXUS_WEB_TIMEOUT_S", "8"))
+WEB_RETRIES = int(os.getenv("NEXUS_WEB_RETRIES", "2"))
+WEB_BACKOFF_S = float(os.getenv("NEXUS_WEB_BACKOFF_S", "0.25"))
+WEB_HEDGE_QUANTILE = float(os.getenv("NEXUS_WEB_HEDGE_QUANTILE", "0.95"))
+WEB_HEDGE_DEFAULT_S = float(os.getenv("NEXUS_WEB_HEDGE_DEFAULT_S", "2.0"))
+WEB_BREAKER_THRESHOLD = int(os.getenv("NEXUS_WEB_BREAKER_THRESHOLD", "5"))
+WEB_BREAKER_COOLDOWN_S = float(os.getenv("NEXUS_WEB_BREAKER_COOLDOWN_S", "30"))
+WEB_NEGATIVE_TTL_S = float(os.getenv("NEXUS_WEB_NEGATIVE_TTL_S", "30"))
 
-def tavily_search(query: str, max_results: int = 3):
+# Search parameters that change the result set (part of the cache key)
+WEB_PROVIDER = "tavily"
+WEB_SEARCH_DEPTH = os.getenv("NEXUS_WEB_SEARCH_DEPTH", "basic")
+
+
+class WebSearchError(Exception):
+    """Raised when a web search could not be completed."""
+
+
+class CircuitOpenError(WebSearchError):
+    """Raised without calling upstream while the circuit breaker is open."""
+
+
+def _is_retryable(error: Exception) -> bool:
+    """Auth, quota and bad-request errors will not succeed on retry."""
+    try:
+        from tavily.errors import (
+            BadRequestError, ForbiddenError, InvalidAPIKeyError, MissingAPIKeyError,
+        )
+    except ImportError:
+        return True
+    # Tavily raises UsageLimitExceededError for 429 (throttling), which is
+    # retried after the limiter pause; exhausted plans surface as ForbiddenError
+    fatal = (BadRequestError, ForbiddenError, InvalidAPIKeyError, MissingAPIKeyError, ValueError)
+    return not isinstance(error, fatal)
+
+
+def _is_timeout(error: Exception) -> bool:
+    """Our own deadline or an HTTP client timeout (requests/httpx ReadTimeout, ...)."""
+    return isinstance(error, TimeoutError) or "timeout" in type(error).__name__.lower()
+
+
+class LatencyTracker:
+    """Rolling window of successful call latencies, used to pick the hedge delay."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def quantile(self, q: float):
+        """Returns the q-quantile latency, or None until enough samples exist."""
+        with self._lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class CircuitBreaker:
     """
-    Executes a web search using Tavily API.
+    Fails fast after `threshold` consecutive failures.
+
+    The breaker stays open for `cooldown_s`, then lets a single trial call
+    through (half-open); its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, threshold: int = WEB_BREAKER_THRESHOLD, cooldown_s: float = WEB_BREAKER_COOLDOWN_S):
+        self.threshold = threshold
+        self.cooldown_s = cooldown_s
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown_s:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        """Frees a half-open trial slot whose call never reached upstream."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_flight or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+class ResilientSearchClient:
+    """
+    Wraps a blocking search function with deadlines, jittered retries,
+    hedged duplicate requests, a circuit breaker and short negative caching.
+
+    Args:
+        search_fn: Callable (query, max_results, timeout_s) -> list of results.
+        timeout_s (float): Default per-call deadline covering all attempts.
+        retries (int): Extra attempts after the first failure.
+        backoff_s (float): Base delay for exponential backoff with full jitter.
+        hedge_quantile (float): Latency quantile after which a duplicate request is sent.
+        negative_ttl_s (float): How long a failed query fails fast without calling upstream.
+        limiter (ProviderLimiter): Optional rate limiter. Each request waits
+            for a slot before it is sent; a hedge is only sent if a slot is
+            free at once. Running out of time in the limiter's queue is not an
+            upstream failure: it neither trips the breaker nor negative-caches.
+
+    A timeout counts against the breaker only when the full `timeout_s`
+    elapsed. When a caller's shorter budget cut the call short, the query is
+    not negative-cached either, so callers with a full budget still try it.
+    """
+
+    def __init__(self, search_fn, timeout_s: float = WEB_TIMEOUT_S, retries: int = WEB_RETRIES,
+                 backoff_s: float = WEB_BACKOFF_S, hedge_quantile: float = WEB_HEDGE_QUANTILE,
+                 hedge_default_s: float = WEB_HEDGE_DEFAULT_S, negative_ttl_s: float = WEB_NEGATIVE_TTL_S,
+                 breaker: CircuitBreaker = None, max_workers: int = 8, limiter=None):
+        self.search_fn = search_fn
+        self.limiter = limiter
+        self.timeout_s = timeout_s
+        self.retries = retries
+        self.backoff_s = backoff_s
+        self.hedge_quantile = hedge_quantile
+        self.hedge_default_s = hedge_default_s
+        self.negative_ttl_s = negative_ttl_s
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = LatencyTracker()
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "failures": 0,
+                      "negative_hits": 0, "breaker_rejections": 0, "rate_limited": 0}
+        self._negative = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="nexus-web")
+
+    def hedge_delay(self) -> float:
+        """Seconds to wait for the primary request before sending a hedge."""
+        observed = self.latency.quantile(self.hedge_quantile)
+        return observed if observed is not None else self.hedge_default_s
+
+    def search(self, query: str, max_results: int = 3, timeout: float = None) -> list:
+        """
+        Runs the search within `timeout` seconds (default `timeout_s`).
+
+        Raises:
+            WebSearchError: If every attempt failed, the deadline passed, the
+                query failed recently (negative cache), the circuit is open,
+                or no rate-limit slot was free in time.
+        """
+        key = (normalize_query(query), max_results)
+        deadline = time.monotonic() + (timeout if timeout is not None else self.timeout_s)
+        # A caller's short budget timing out says nothing about upstream health
+        budget_limited = timeout is not None and timeout < self.timeout_s
+
+        with self._lock:
+            self.stats["calls"] += 1
+            failed_until = self._negative.get(key)
+            if failed_until is not None:
+                if time.monotonic() < failed_until:
+                    self.stats["negative_hits"] += 1
+                    raise WebSearchError("query failed recently (negative cache)")
+                del self._negative[key]
+
+        last_error = None
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow():
+                with self._lock:
+                    self.stats["breaker_rejections"] += 1
+                raise CircuitOpenError("web search circuit breaker is open")
+
+            try:
+                results = self._hedged_call(query, max_results, deadline)
+                self.breaker.record_success()
+                return results
+            except RateLimitError as e:
+                # Local backpressure: the request never reached upstream
+                self.breaker.release_trial()
+                with self._lock:
+                    self.stats["rate_limited"] += 1
+                raise WebSearchError(f"web search rate limited: {e}") from e
+            except Exception as e:
+                last_error = e
+                if budget_limited and _is_timeout(e):
+                    self.breaker.release_trial()
+                    break
+                self.breaker.record_failure()
+                if not _is_retryable(e) or attempt == self.retries:
+                    break
+
+            # Exponential backoff with full jitter, never past the deadline
+            delay = random.uniform(0, self.backoff_s * (2 ** attempt))
+            if time.monotonic() + delay >= deadline:
+                break
+            with self._lock:
+                self.stats["retries"] += 1
+            time.sleep(delay)
+
+        with self._lock:
+            self.stats["failures"] += 1
+            if not (budget_limited and _is_timeout(last_error)):
+                self._negative[key] = time.monotonic() + self.negative_ttl_s
+        raise WebSearchError(f"web search failed: {last_error}") from last_error
+
+    def _timed_call(self, query, max_results, timeout_s):
+        start = time.monotonic()
+        results = self.search_fn(query, max_results, timeout_s)
+        self.latency.record(time.monotonic() - start)
+        return results
+
+    def _hedged_call(self, query, max_results, deadline) -> list:
+        """One logical attempt: primary request plus at most one hedge."""
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("web search deadline exceeded")
+        if self.limiter is not None:
+            # Queue in the caller's thread (and priority) before the hedge clock starts
+            self.limiter.acquire(timeout=remaining)
+            remaining = deadline - time.monotonic()
+
+        pending = {self._executor.submit(bind_to_request(self._timed_call), query, max_results, remaining)}
+        hedged = False
+        last_error = None
+
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            wait_for = remaining if hedged else min(self.hedge_delay(), remaining)
+            done, pending = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return future.result()
+                last_error = future.exception()
+
+            if not hedged and (pending or last_error is None):
+                # Primary is slower than the hedge delay: send a duplicate,
+                # but only with spare quota (a hedge never queues)
+                hedged = True
+                if self.limiter is not None and not self.limiter.try_acquire():
+                    continue
+                with self._lock:
+                    self.stats["hedges"] += 1
+                pending.add(self._executor.submit(
+                    bind_to_request(self._timed_call), query, max_results, deadline - time.monotonic()
+                ))
+
+        for future in pending:
+            future.cancel()
+        if last_error is not None and not pending:
+            raise last_error
+        raise TimeoutError("web search deadline exceeded")
+
+    def get_stats(self) -> dict:
+        """Returns counters, breaker state and observed latency quantiles."""
+        with self._lock:
+            stats = dict(self.stats)
+        stats["breaker_state"] = self.breaker.state
+        stats["p50_s"] = self.latency.quantile(0.5)
+        stats["p95_s"] = self.latency.quantile(0.95)
+        return stats
+
+
+@lru_cache(maxsize=None)
+def get_tavily_client():
+    """
+    Returns the shared Tavily client, created on first use.
+
+    Returns None if TAVILY_API_KEY is not configured.
+    """
+    tavily_api_key = os.getenv("TAVILY_API_KEY")
+    if not tavily_api_key:
+        return None
+
+    from tavily import TavilyClient
+    return TavilyClient(api_key=tavily_api_key)
+
+def _tavily_request(query: str, max_results: int, timeout_s: float) -> list:
+    """
+    Single raw Tavily call, bounded by `timeout_s` at the HTTP layer.
     
+    Rate-limit slots are taken by the ResilientSearchClient before each
+    call. A 429 response pauses the shared Tavily limiter for every caller
+    before the error reaches the client's retry loop.
+    """
+    try:
+        response = get_tavily_client().search(
+            query=query,
+            search_depth=WEB_SEARCH_DEPTH,
+            max_results=max_results,
+            timeout=max(timeout_s, 0.1)
+        )
+    except Exception as e:
+        if is_rate_limit_error(e):
+            get_limiter("tavily").pause(retry_after_s(e, 0))
+        raise
+    return response.get("results", [])
+
+@lru_cache(maxsize=None)
+def get_search_client() -> ResilientSearchClient:
+    """Returns the process-wide resilient Tavily search client."""
+    return ResilientSearchClient(_tavily_request, limiter=get_limiter("tavily"))
+
+def tavily_search(query: str, max_results: int = 3, timeout: float = None):
+    """
+    Executes a web search using Tavily API.
+
+    Calls go through the shared ResilientSearchClient (deadline, retries,
+    hedging, circuit breaker, negative cache). Failures are logged and
+    returned as an empty list.
+
     Args:
         query (str): The search query.
         max_results (int): Maximum number of results to return.
-        
+        timeout (float): Deadline in seconds for all attempts (default NEXUS_WEB_TIMEOUT_S).
+
     Returns:
-        dict: The search results from Tavily.
+        list: The search results from Tavily.
     """
+    tavily_client = get_tavily_client()
     if not tavily_client:
         raise ValueError("TAVILY_API_KEY not found in environment variables.")
-        
+
     try:
-        response = tavily_client.search(
-            query=query,
-            search_depth="basic",
-            max_results=max_results
-        )
-        return response.get("results", [])
-    except Exception as e:
-        print(f"Error executing access Tavily search: {e}")
+        return get_search_client().search(query, max_results=max_results, timeout=timeout)
+    except WebSearchError as e:
+        print(f"Error executing Tavily search: {e}")
         return []